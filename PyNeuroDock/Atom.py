@@ -23,10 +23,11 @@
 #    http://en.wikipedia.org/wiki/Covalent_radius
 
 import math
-from Axis3 import Axis3
+import numpy as np
+from Axis3 import Axis3, Axis3View
 from Constants import APPROX_ZERO
 
-class Atom:
+class Atom(object):
     # For atom type, please refer to bond_index column inside AD4.1_bound.dat
     # or AD4_parameters.dat file
     NUM_ATOM_TYPE = 7
@@ -48,10 +49,44 @@ class Atom:
                  charge = 0.0, branch = None):
         self.id = id
         self.type = type
+        # Coordinate array and row the coordinate is stored at, if bound
+        self.tcoord_array = None
+        self.tcoord_idx = 0
         self.tcoord = tcoord
         self.charge = charge
         self.branch = branch
 
+    # Once bound, assigning tcoord copies the coordinate into the array row
+    @property
+    def tcoord(self):
+        return self.tcoord_view
+    @tcoord.setter
+    def tcoord(self, value):
+        if self.tcoord_array is None:
+            self.tcoord_view = value
+        else:
+            self.tcoord_array[self.tcoord_idx] = value.xyz
+
+    # Store the coordinate at row idx of an (N, 3) coordinate array
+    def bind_tcoord(self, tcoord_array, idx):
+        tcoord_array[idx] = self.tcoord.xyz
+        self.tcoord_array = tcoord_array
+        self.tcoord_idx = idx
+        self.tcoord_view = Axis3View(tcoord_array, idx)
+
+    # Same atom with its own unbound coordinate
+    def copy(self):
+        return Atom(self.id, self.type, Axis3(*self.tcoord.xyz), self.charge, \
+                    self.branch)
+
+    # Bind coordinates of all atoms to a new (N, 3) array and return it
+    @staticmethod
+    def bind_tcoords(atoms):
+        tcoords = np.empty((len(atoms), 3), dtype = float)
+        for idx, atom in enumerate(atoms):
+            atom.bind_tcoord(tcoords, idx)
+        return tcoords
+
 class Branch:
     def __init__(self, id = 0, anchor_id = 0, link_id = 0, atom_ids = [], \
                  all_atom_ids = [], parent = None, children = []):
@@ -69,6 +104,114 @@ class Branch:
         self.parent = parent
         self.children = children
 
+# Flattened torsion tree of ligand and protein flexible branches. Torsions
+# are numbered by branch size ascendingly, the order torsion genes follow.
+# Atom indexes refer to ligand atoms followed by protein flexible atoms.
+# Branches of the same level never move each other's atoms, so each level can
+# be rotated at once, starting from level 0 (branches without sub-branches).
+class TorsionTree:
+    def __init__(self, ligand = None, protein = None):
+        self.ttl_torsions = 0
+        self.ttl_levels = 0
+        # Branches in torsion order
+        self.branches = []
+        # Anchor and link atom indexes, and level of each torsion
+        self.anchors = np.array([], dtype = int)
+        self.links = np.array([], dtype = int)
+        self.levels = np.array([], dtype = int)
+        # Rotated atom indexes of torsion i are
+        # atoms[atom_starts[i]:atom_starts[i + 1]]
+        self.atom_starts = np.array([0], dtype = int)
+        self.atoms = np.array([], dtype = int)
+        # Rotated atom indexes of level l and the torsion each of them belongs
+        # to are level_atoms[level_starts[l]:level_starts[l + 1]] and
+        # level_torsions[level_starts[l]:level_starts[l + 1]]
+        self.level_starts = np.array([0], dtype = int)
+        self.level_atoms = np.array([], dtype = int)
+        self.level_torsions = np.array([], dtype = int)
+        if ligand is not None and protein is not None:
+            self.build(ligand, protein)
+
+    def build(self, ligand, protein):
+        branches = []
+        for branch in ligand.branches:
+            branch.molecule = 'l' # l for ligand
+            branches.append(branch)
+        for branch in protein.flex_branches:
+            branch.molecule = 'p' # p for protein
+            branches.append(branch)
+        self.branches = sorted(branches, \
+                               key=lambda branch: len(branch.all_atom_ids))
+        self.ttl_torsions = len(self.branches)
+
+        ligand_idx = dict((atom.id, i) \
+                          for i, atom in enumerate(ligand.ori_atoms))
+        protein_idx = dict((atom.id, len(ligand.ori_atoms) + i) \
+                           for i, atom in enumerate(protein.ori_flex_atoms))
+
+        # Level is the height of the branch above its deepest sub-branch
+        levels = {}
+        def get_level(branch):
+            if branch not in levels:
+                levels[branch] = 0
+                for child in branch.children:
+                    levels[branch] = max(levels[branch], get_level(child) + 1)
+            return levels[branch]
+
+        anchors = []
+        links = []
+        atom_starts = [0]
+        atoms = []
+        for branch in self.branches:
+            if branch.molecule == 'l':
+                atom_idx = ligand_idx
+            else: # 'p'
+                atom_idx = protein_idx
+            anchors.append(atom_idx[branch.anchor_id])
+            links.append(atom_idx[branch.link_id])
+            # Anchor and link atoms are not for rotation
+            atoms += sorted(atom_idx[id] for id in branch.all_atom_ids \
+                            if id != branch.anchor_id and id != branch.link_id)
+            atom_starts.append(len(atoms))
+        self.anchors = np.array(anchors, dtype = int)
+        self.links = np.array(links, dtype = int)
+        self.levels = np.array([get_level(branch) for branch in self.branches], \
+                               dtype = int)
+        self.atom_starts = np.array(atom_starts, dtype = int)
+        self.atoms = np.array(atoms, dtype = int)
+
+        self.ttl_levels = int(self.levels.max()) + 1 if self.ttl_torsions else 0
+        level_starts = [0]
+        level_atoms = []
+        level_torsions = []
+        for level in xrange(self.ttl_levels):
+            for i in np.flatnonzero(self.levels == level):
+                branch_atoms = self.get_branch_atoms(i).tolist()
+                level_atoms += branch_atoms
+                level_torsions += [i] * len(branch_atoms)
+            level_starts.append(len(level_atoms))
+        self.level_starts = np.array(level_starts, dtype = int)
+        self.level_atoms = np.array(level_atoms, dtype = int)
+        self.level_torsions = np.array(level_torsions, dtype = int)
+
+    # Rotated atom indexes of torsion i
+    def get_branch_atoms(self, i):
+        return self.atoms[self.atom_starts[i]:self.atom_starts[i + 1]]
+
+    # Rotated atom indexes of level l and the torsion each of them belongs to
+    def get_level_atoms(self, l):
+        start = self.level_starts[l]
+        end = self.level_starts[l + 1]
+        return self.level_atoms[start:end], self.level_torsions[start:end]
+
+    def __repr__(self):
+        ret = "Torsion Tree:\n"
+        for i in xrange(self.ttl_torsions):
+            ret += "%2d: level %d, %2d-%-2d %s\n" % \
+                   (i, self.levels[i], self.anchors[i], self.links[i], \
+                    self.get_branch_atoms(i).tolist())
+        return ret
+
 # Atomic Bond
 class Bond:
     # Covalent bond distance tolerance
@@ -184,6 +327,23 @@ class Bond:
                 (self.atom1, self.atom_type1, self.atom2, self.atom_type2, \
                  self.non_bond_type, self.desolv, self.q1q2)
 
+    # Non-bond lists stored as parallel arrays, one element per pair
+    class NonBondArrays:
+        def __init__(self, atom_idx1 = [], atom_idx2 = [], type_pair = [], \
+                     non_bond_type = [], desolv = [], q1q2 = []):
+            # Zero-based indexes of ligand atoms followed by protein
+            # flexible atoms
+            self.atom_idx1 = np.array(atom_idx1, dtype = int)
+            self.atom_idx2 = np.array(atom_idx2, dtype = int)
+            # Row of the pair atom types in the compacted vdw_hb table
+            self.type_pair = np.array(type_pair, dtype = int)
+            self.non_bond_type = np.array(non_bond_type, dtype = int)
+            self.desolv = np.array(desolv, dtype = float)
+            self.q1q2 = np.array(q1q2, dtype = float)
+
+        def __len__(self):
+            return len(self.atom_idx1)
+
     def __init__(self):
         # By default, 1-4 interactions is disabled
         self.include_1_4_interactions = False
@@ -659,6 +819,53 @@ class Bond:
 
         return non_bond_ligand, non_bond_ligand_receptor, non_bond_receptor
 
+    # Row of atom types pair (type_idx1, type_idx2) in the compacted vdw_hb
+    # table. Only pairs with type_idx1 <= type_idx2 are stored, row by row.
+    # Also works on index arrays.
+    @staticmethod
+    def get_type_pair_idx(ttl_atom_types, type_idx1, type_idx2):
+        a1 = np.minimum(type_idx1, type_idx2)
+        a2 = np.maximum(type_idx1, type_idx2)
+        return (ttl_atom_types * a1) + a2 - ((a1 * (a1 + 1)) // 2)
+
+    # Compact vdw_hb energy table into a 2D array of atom types pair by
+    # NS_INTL, with rows as given by get_type_pair_idx
+    @staticmethod
+    def compact_vdw_hb(et, atom_types):
+        vdw_hb = []
+        for i, at_i in enumerate(atom_types):
+            for at_j in atom_types[i:]:
+                vdw_hb.append(et.vdw_hb[(at_i, at_j)])
+        return np.array(vdw_hb, dtype = float).reshape(-1, \
+                                                       Bond.EnergyTable.NS_INTL)
+
+    # Convert non-bond lists into NonBondArrays. Each list is given together
+    # with the index offsets of its first and second atoms, so that one-based
+    # atom ids turn into indexes of ligand atoms followed by protein flexible
+    # atoms.
+    def convert_non_bond_lists_to_arrays(self, non_bond_lists, atom_types):
+        atom_idx1 = []
+        atom_idx2 = []
+        type_idx1 = []
+        type_idx2 = []
+        non_bond_type = []
+        desolv = []
+        q1q2 = []
+        for non_bond_list, offset1, offset2 in non_bond_lists:
+            for nb in non_bond_list:
+                atom_idx1.append(offset1 + nb.atom1 - 1)
+                atom_idx2.append(offset2 + nb.atom2 - 1)
+                type_idx1.append(atom_types.index(nb.atom_type1))
+                type_idx2.append(atom_types.index(nb.atom_type2))
+                non_bond_type.append(nb.non_bond_type)
+                desolv.append(nb.desolv)
+                q1q2.append(nb.q1q2)
+        type_pair = self.get_type_pair_idx(len(atom_types), \
+                                           np.array(type_idx1, dtype = int), \
+                                           np.array(type_idx2, dtype = int))
+        return self.NonBondArrays(atom_idx1, atom_idx2, type_pair, \
+                                  non_bond_type, desolv, q1q2)
+
     def __repr__(self):
         ret = "Bonding Parameters:\n"
         ret += "Free energy coefficient for Van der Waals term    = %6.3f\n" % \
@@ -63,3 +63,38 @@ class Axis3(object):
             self.x /= mag_xyz
             self.y /= mag_xyz
             self.z /= mag_xyz
+
+# Axis3 backed by row idx of an (N, 3) coordinate array. Reading and writing
+# x, y and z go directly to the array.
+class Axis3View(Axis3):
+    @property
+    def xyz(self):
+        return self.tcoords[self.idx].tolist()
+    @xyz.setter
+    def xyz(self, value):
+        self.tcoords[self.idx] = value
+
+    @property
+    def x(self):
+        return float(self.tcoords[self.idx, 0])
+    @x.setter
+    def x(self, value):
+        self.tcoords[self.idx, 0] = value
+
+    @property
+    def y(self):
+        return float(self.tcoords[self.idx, 1])
+    @y.setter
+    def y(self, value):
+        self.tcoords[self.idx, 1] = value
+
+    @property
+    def z(self):
+        return float(self.tcoords[self.idx, 2])
+    @z.setter
+    def z(self, value):
+        self.tcoords[self.idx, 2] = value
+
+    def __init__(self, tcoords, idx):
+        self.tcoords = tcoords
+        self.idx = idx
@@ -19,6 +19,14 @@
 
 # To run: ./Benchmark.sh 2>&1 | tee Benchmark/Benchmark.txt
 
+echo "========================================================================="
+echo "Map Loading Benchmark"
+echo "========================================================================="
+echo ""
+
+/opt/local/bin/python2 BenchmarkMap.py
+echo "-------------------------------------------------------------------------"
+
 echo "========================================================================="
 echo "Run Time Benchmark Python Sequentially"
 echo "========================================================================="
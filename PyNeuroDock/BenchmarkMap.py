@@ -0,0 +1,100 @@
+# Copyright (C) 2013 by Eka A. Kurniawan
+# eka.a.kurniawan(ta)gmail(tod)com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+# Map loading benchmark comparing the line-splitting map readers against
+# GridMapReader (sequential and concurrent) on all hsg1_rigid maps.
+#
+# To run, on PyNeuroDock directory execute: python BenchmarkMap.py
+
+import sys
+import glob
+import operator
+from time import time
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from Grid import Field
+from Map import GridMapReader
+
+MAP_FILES = "./Maps/hsg1_rigid.*.map"
+FIELD_FILE = "./Parameters/hsg1_rigid.maps.fld"
+REPEAT = 5
+
+# Line-splitting map reader used before GridMapReader
+def read_map_by_line(filename, field):
+    p_file = open(filename, 'r')
+    for i in xrange(GridMapReader.HEADER_LEN):
+        p_file.readline()
+    volume = reduce(operator.mul, field.num_points1.xyz)
+    map = (np.array(p_file.read().split('\n')[:volume], \
+                    dtype = float)).reshape(field.num_points1.xyz)
+    p_file.close()
+    return map
+
+def read_map(filename, field):
+    return GridMapReader(filename, field).map
+
+def load_sequential(read_func, filenames, field):
+    return [read_func(filename, field) for filename in filenames]
+
+def load_concurrent(read_func, filenames, field):
+    pool = ThreadPool(min(len(filenames), cpu_count()))
+    try:
+        return pool.map(lambda filename: read_func(filename, field), filenames)
+    finally:
+        pool.close()
+        pool.join()
+
+def benchmark(title, load_func, read_func, filenames, field):
+    best = float("inf")
+    for i in xrange(REPEAT):
+        tic = time()
+        maps = load_func(read_func, filenames, field)
+        toc = time()
+        best = min(best, toc - tic)
+    print "%-40s: %8.3f s" % (title, best)
+    return best, maps
+
+def main():
+    filenames = sorted(glob.glob(MAP_FILES))
+    if not filenames:
+        print >>sys.stderr, "No map found at %s" % MAP_FILES
+        return 2
+    field = Field(FIELD_FILE)
+
+    print "Loading %d maps (best of %d runs)" % (len(filenames), REPEAT)
+    base, base_maps = benchmark("Line-splitting reader, sequential", \
+                                load_sequential, read_map_by_line, \
+                                filenames, field)
+    seq, seq_maps = benchmark("GridMapReader, sequential", \
+                              load_sequential, read_map, \
+                              filenames, field)
+    con, con_maps = benchmark("GridMapReader, thread pool", \
+                              load_concurrent, read_map, \
+                              filenames, field)
+    print "Speedup sequential : %6.2fx" % (base / seq)
+    print "Speedup thread pool: %6.2fx" % (base / con)
+
+    for base_map, seq_map, con_map in zip(base_maps, seq_maps, con_maps):
+        if not (np.array_equal(base_map, seq_map) and \
+                np.array_equal(base_map, con_map)):
+            print >>sys.stderr, "Map values differ between readers"
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
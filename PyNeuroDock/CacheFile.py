@@ -0,0 +1,50 @@
+# Copyright (C) 2013 by Eka A. Kurniawan
+# eka.a.kurniawan(ta)gmail(tod)com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+import os
+import tempfile
+
+# Cache Files
+# -----------
+# Map, program binary and work-group size caches are shared by concurrent
+# docking processes. Files are written into a temporary file in the same
+# directory followed by renaming it, so that other processes never see a
+# partially written file.
+
+# Create cache directory unless it exists
+def make_dirs(dir_name):
+    if not os.path.isdir(dir_name):
+        try:
+            os.makedirs(dir_name)
+        except OSError:
+            # Created by another process in the meantime
+            if not os.path.isdir(dir_name):
+                raise
+
+# Write filename by write_func(p_file) on a temporary file, which replaces
+# filename once completely written
+def write_atomic(filename, write_func, mode = 'wb'):
+    fd, tmp_filename = tempfile.mkstemp(dir = os.path.dirname(filename) or ".", \
+                                        suffix = ".tmp")
+    try:
+        with os.fdopen(fd, mode) as p_file:
+            write_func(p_file)
+        os.rename(tmp_filename, filename)
+    except:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
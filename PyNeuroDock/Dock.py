@@ -24,9 +24,11 @@ from Ligand import Ligand
 from Protein import Protein
 from Grid import Grid
 from Quaternion import Quaternion
-from Atom import Bond
+from Atom import Bond, TorsionTree
+from WorkGroupTuner import WorkGroupTuner
 import numpy as np
 import pyopencl as cl
+import os
 
 DEBUG = False
 
@@ -55,10 +57,14 @@ class Dock:
         # Sorted ligand and protein branches ascendingly based on number of
         # atoms in the branch
         self.sorted_branches = []
+        # Flattened torsion tree of sorted branches (Atom.TorsionTree)
+        self.torsion_tree = None
         # Bonding lists
         self.non_bond_ligand = []
         self.non_bond_ligand_receptor = []
         self.non_bond_receptor = []
+        # Non-bond lists as parallel arrays (Bond.NonBondArrays)
+        self.non_bond_arrays = None
 
         # Binding torsional free energy
         self.torsional_energy = 0.0
@@ -81,43 +87,25 @@ class Dock:
         ttl_atoms += len(self.protein.flex_atoms)
         return ttl_atoms
 
+    # Build torsion tree once, torsions follow its branch order
+    def get_torsion_tree(self):
+        if self.torsion_tree is None:
+            self.torsion_tree = TorsionTree(self.ligand, self.protein)
+            self.sorted_branches = self.torsion_tree.branches
+        return self.torsion_tree
+
     # Rotate rotatable branches/bonds for both ligand and protein.
     # Rotation is expected to be in radian.
     def rotate_branches(self, torsions):
-        if not self.sorted_branches:
-            for branch in self.ligand.branches:
-                branch.molecule = 'l' # l for ligand
-                self.sorted_branches.append(branch)
-            for branch in self.protein.flex_branches:
-                branch.molecule = 'p' # p for protein
-                self.sorted_branches.append(branch)
-            self.sorted_branches = sorted(self.sorted_branches, \
-                                          key=lambda branch: len(branch.all_atom_ids))
+        tree = self.get_torsion_tree()
+        molecule_atoms = self.ligand.atoms + self.protein.flex_atoms
 
         q_rotation = Quaternion()
-        rot_i = 0
-        for branch in self.sorted_branches:
-            atoms = []
-            atom_tcoords = []
-            # Get the atoms from either ligand or protein based on branch
-            # molecule information
-            if branch.molecule == 'l':
-                molecule_atoms = self.ligand.atoms
-            else: # 'p'
-                molecule_atoms = self.protein.flex_atoms
-            # Get atom coordinates
-            for atom in molecule_atoms:
-                if atom.id in [branch.anchor_id] + [branch.link_id] + \
-                              branch.all_atom_ids:
-                    # Anchor and link atoms are not for rotation
-                    if atom.id == branch.anchor_id:
-                        anchor_tcoord = atom.tcoord
-                        continue
-                    if atom.id == branch.link_id:
-                        link_tcoord = atom.tcoord
-                        continue
-                    atoms.append(atom)
-                    atom_tcoords.append(atom.tcoord - link_tcoord)
+        for rot_i in xrange(tree.ttl_torsions):
+            anchor_tcoord = molecule_atoms[tree.anchors[rot_i]].tcoord
+            link_tcoord = molecule_atoms[tree.links[rot_i]].tcoord
+            atoms = [molecule_atoms[idx] for idx in tree.get_branch_atoms(rot_i)]
+            atom_tcoords = [atom.tcoord - link_tcoord for atom in atoms]
             # Transform
             q_rotation.set_angle_axis(torsions[rot_i], \
                                       anchor_tcoord - link_tcoord)
@@ -126,8 +114,6 @@ class Dock:
             for i, atom in enumerate(atoms):
                 atom.tcoord = new_atom_tcoords[i]
 
-            rot_i += 1
-
     # Transform (translate and rotate) ligand root (whole body)
     def transform_ligand_root(self, translation, rotation):
         atom_tcoords = self.ligand.get_atom_tcoords()
@@ -203,6 +189,7 @@ class Dock:
                 self.bond.convert_non_bond_matrix_to_list(non_bond_matrix, \
                                                           self.ligand, \
                                                           self.protein)
+        self.non_bond_arrays = None
 
     def print_non_bond_matrix(self, non_bond_matrix):
         print "non_bond_matrix:"
@@ -222,278 +209,245 @@ class Dock:
         for nbi in non_bond_list:
             print " %5d-%-5d     %6.2f" % (nbi.atom1, nbi.atom2, nbi.q1q2)
 
+    # Transformed coordinates of ligand atoms followed by protein flexible
+    # atoms as an (N, 3) array
+    @staticmethod
+    def get_atom_tcoords_in_numpy(ligand, protein):
+        return np.vstack((ligand.tcoords, protein.flex_tcoords))
+
+    # Sum values along the last axis in order, one element after another.
+    # Unlike numpy pairwise summation, this gives the same totals as the
+    # scalar accumulation for any batch shape.
+    @staticmethod
+    def sum_in_order(values):
+        if values.shape[-1] == 0:
+            return np.zeros(values.shape[:-1])
+        return np.cumsum(values, axis = -1)[..., -1]
+
+    # 3D Linear Interpolation of coordinates tcoords (..., N, 3) at once.
+    # Returns the lower cell corners (u0, v0, w0) as an (..., N, 3) integer
+    # array and the corner weights p000 to p111 as an (..., N, 8) array.
+    @staticmethod
+    def calc_linInterp3_in_numpy(grid, tcoords):
+        uvw = (tcoords - np.array(grid.field.lo.xyz)) / grid.field.spacing
+        uvw0 = uvw.astype(int)
+        p0 = uvw - uvw0
+        p1 = (uvw0 + 1) - uvw
+        p0u, p0v, p0w = p0[..., 0], p0[..., 1], p0[..., 2]
+        p1u, p1v, p1w = p1[..., 0], p1[..., 1], p1[..., 2]
+        weights = np.stack((p0u * p0v * p0w, \
+                            p0u * p0v * p1w, \
+                            p0u * p1v * p0w, \
+                            p0u * p1v * p1w, \
+                            p1u * p0v * p0w, \
+                            p1u * p0v * p1w, \
+                            p1u * p1v * p0w, \
+                            p1u * p1v * p1w), axis = -1)
+        return uvw0, weights
+
+    # Flattened map (z, y, x) indices of the eight cell corners in the same
+    # order as weights p000 to p111
+    @staticmethod
+    def calc_corner_indices(grid, uvw0):
+        num_x = grid.field.num_points1.x
+        num_y = grid.field.num_points1.y
+        u0, v0, w0 = uvw0[..., 0], uvw0[..., 1], uvw0[..., 2]
+        u1, v1, w1 = u0 + 1, v0 + 1, w0 + 1
+        x = np.stack((u1, u0, u1, u0, u1, u0, u1, u0), axis = -1)
+        y = np.stack((v1, v1, v0, v0, v1, v1, v0, v0), axis = -1)
+        z = np.stack((w1, w1, w1, w1, w0, w0, w0, w0), axis = -1)
+        return (z * num_y + y) * num_x + x
+
     # 3D Linear Interpolation
     @staticmethod
     def calc_linInterp3(grid, ligand, protein):
-        lo_x, lo_y, lo_z = grid.field.lo.xyz
-        spacing = grid.field.spacing
-        atom_len = len(ligand.atoms) + len(protein.flex_atoms)
-
-        u = []
-        v = []
-        w = []
-        for atom in ligand.atoms:
-            u.append((atom.tcoord.x - lo_x) / spacing)
-            v.append((atom.tcoord.y - lo_y) / spacing)
-            w.append((atom.tcoord.z - lo_z) / spacing)
-        for atom in protein.flex_atoms:
-            u.append((atom.tcoord.x - lo_x) / spacing)
-            v.append((atom.tcoord.y - lo_y) / spacing)
-            w.append((atom.tcoord.z - lo_z) / spacing)
-
-        u0 = [int(i) for i in u]
-        v0 = [int(i) for i in v]
-        w0 = [int(i) for i in w]
-                
-        u1 = [i + 1 for i in u0]
-        v1 = [i + 1 for i in v0]
-        w1 = [i + 1 for i in w0]
-    
-        p0u = [u[i] - float(u0[i]) for i in xrange(atom_len)]
-        p0v = [v[i] - float(v0[i]) for i in xrange(atom_len)]
-        p0w = [w[i] - float(w0[i]) for i in xrange(atom_len)]
-
-        p1u = [float(u1[i]) - u[i] for i in xrange(atom_len)]
-        p1v = [float(v1[i]) - v[i] for i in xrange(atom_len)]
-        p1w = [float(w1[i]) - w[i] for i in xrange(atom_len)]
-
-        p000 = [p0u[i] * p0v[i] * p0w[i] for i in xrange(atom_len)]
-        p001 = [p0u[i] * p0v[i] * p1w[i] for i in xrange(atom_len)]
-        p010 = [p0u[i] * p1v[i] * p0w[i] for i in xrange(atom_len)]
-        p011 = [p0u[i] * p1v[i] * p1w[i] for i in xrange(atom_len)]
-        p100 = [p1u[i] * p0v[i] * p0w[i] for i in xrange(atom_len)]
-        p101 = [p1u[i] * p0v[i] * p1w[i] for i in xrange(atom_len)]
-        p110 = [p1u[i] * p1v[i] * p0w[i] for i in xrange(atom_len)]
-        p111 = [p1u[i] * p1v[i] * p1w[i] for i in xrange(atom_len)]
-
+        tcoords = Dock.get_atom_tcoords_in_numpy(ligand, protein)
+        uvw0, weights = Dock.calc_linInterp3_in_numpy(grid, tcoords)
+        u0, v0, w0 = uvw0.T.tolist()
+        u1, v1, w1 = (uvw0 + 1).T.tolist()
+        p000, p001, p010, p011, p100, p101, p110, p111 = weights.T.tolist()
         return u0, v0, w0, u1, v1, w1, \
                p000, p001, p010, p011, p100, p101, p110, p111
 
+    # Electrostatic and Van der Waals energies of every atom given atom
+    # coordinates of shape (..., N, 3)
+    def calc_intermolecular_energies(self, tcoords):
+        atoms = self.ligand.atoms + self.protein.flex_atoms
+        uvw0, weights = self.calc_linInterp3_in_numpy(self.grid, tcoords)
+        corners = self.calc_corner_indices(self.grid, uvw0)
+
+        # Gather electrostatic, desolvation and atom type map values of all
+        # corners for all atoms from the flattened maps, atoms of the same
+        # type at once
+        maps = self.grid.get_flat_maps()
+        values = np.empty(corners.shape[:-1] + (3, 8))
+        values[..., 0, :] = maps['e'][corners]
+        values[..., 1, :] = maps['d'][corners]
+        atom_types = np.array([atom.type for atom in atoms])
+        for type in set(atom_types.tolist()):
+            atom_idx = np.nonzero(atom_types == type)[0]
+            values[..., atom_idx, 2, :] = maps[type][corners[..., atom_idx, :]]
+        # Accumulate corner by corner to keep the summation order of the
+        # scalar interpolation
+        edms = np.zeros(values.shape[:-1])
+        for i in xrange(8):
+            edms += weights[..., i, np.newaxis] * values[..., i]
+        es, ds, ms = edms[..., 0], edms[..., 1], edms[..., 2]
+
+        charges = np.array([atom.charge for atom in atoms], dtype = float)
+        # Protein flexible atoms to be ignored contribute no energy
+        inters = np.array([True] * len(self.ligand.atoms) + \
+                          [atom.id not in self.protein.ignore_inter \
+                           for atom in self.protein.flex_atoms], dtype = bool)
+
+        elecs = np.where(inters, es * charges, 0.0)
+        emaps = np.where(inters, ms + ds * np.abs(charges), 0.0)
+        return elecs, emaps
+
     # Calculate free energy
     def calc_intermolecular_energy(self):
-        u0, v0, w0, u1, v1, w1, \
-            p000, p001, p010, p011, p100, p101, p110, p111 = \
-            self.calc_linInterp3(self.grid, self.ligand, self.protein)
-
-        atom_len = len(self.ligand.atoms) + len(self.protein.flex_atoms)
-        protein_idx = len(self.ligand.atoms)
-
-        es = [] # Electrostatic
-        for i in xrange(atom_len):
-            e = 0.0
-            e += p000[i] * self.grid.maps['e'][w1[i]][v1[i]][u1[i]]
-            e += p001[i] * self.grid.maps['e'][w1[i]][v1[i]][u0[i]]
-            e += p010[i] * self.grid.maps['e'][w1[i]][v0[i]][u1[i]]
-            e += p011[i] * self.grid.maps['e'][w1[i]][v0[i]][u0[i]]
-            e += p100[i] * self.grid.maps['e'][w0[i]][v1[i]][u1[i]]
-            e += p101[i] * self.grid.maps['e'][w0[i]][v1[i]][u0[i]]
-            e += p110[i] * self.grid.maps['e'][w0[i]][v0[i]][u1[i]]
-            e += p111[i] * self.grid.maps['e'][w0[i]][v0[i]][u0[i]]
-            es.append(e)
-
-        ds = [] # Desolvation
-        for i in xrange(atom_len):
-            d = 0.0
-            d += p000[i] * self.grid.maps['d'][w1[i]][v1[i]][u1[i]]
-            d += p001[i] * self.grid.maps['d'][w1[i]][v1[i]][u0[i]]
-            d += p010[i] * self.grid.maps['d'][w1[i]][v0[i]][u1[i]]
-            d += p011[i] * self.grid.maps['d'][w1[i]][v0[i]][u0[i]]
-            d += p100[i] * self.grid.maps['d'][w0[i]][v1[i]][u1[i]]
-            d += p101[i] * self.grid.maps['d'][w0[i]][v1[i]][u0[i]]
-            d += p110[i] * self.grid.maps['d'][w0[i]][v0[i]][u1[i]]
-            d += p111[i] * self.grid.maps['d'][w0[i]][v0[i]][u0[i]]
-            ds.append(d)
-
-        ms = [] # Atom Type
-        for i, atom in enumerate(self.ligand.atoms):
-            m = 0.0
-            type = atom.type
-            m += p000[i] * self.grid.maps[type][w1[i]][v1[i]][u1[i]]
-            m += p001[i] * self.grid.maps[type][w1[i]][v1[i]][u0[i]]
-            m += p010[i] * self.grid.maps[type][w1[i]][v0[i]][u1[i]]
-            m += p011[i] * self.grid.maps[type][w1[i]][v0[i]][u0[i]]
-            m += p100[i] * self.grid.maps[type][w0[i]][v1[i]][u1[i]]
-            m += p101[i] * self.grid.maps[type][w0[i]][v1[i]][u0[i]]
-            m += p110[i] * self.grid.maps[type][w0[i]][v0[i]][u1[i]]
-            m += p111[i] * self.grid.maps[type][w0[i]][v0[i]][u0[i]]
-            ms.append(m)
-        for idx, atom in enumerate(self.protein.flex_atoms):
-            m = 0.0
-            type = atom.type
-            i = protein_idx + idx
-            m += p000[i] * self.grid.maps[type][w1[i]][v1[i]][u1[i]]
-            m += p001[i] * self.grid.maps[type][w1[i]][v1[i]][u0[i]]
-            m += p010[i] * self.grid.maps[type][w1[i]][v0[i]][u1[i]]
-            m += p011[i] * self.grid.maps[type][w1[i]][v0[i]][u0[i]]
-            m += p100[i] * self.grid.maps[type][w0[i]][v1[i]][u1[i]]
-            m += p101[i] * self.grid.maps[type][w0[i]][v1[i]][u0[i]]
-            m += p110[i] * self.grid.maps[type][w0[i]][v0[i]][u1[i]]
-            m += p111[i] * self.grid.maps[type][w0[i]][v0[i]][u0[i]]
-            ms.append(m)
+        tcoords = self.get_atom_tcoords_in_numpy(self.ligand, self.protein)
+        elecs, emaps = self.calc_intermolecular_energies(tcoords)
 
         # Electrostatic
-        self.elecs = []
-        self.elec_total = 0.0
-        for i, atom in enumerate(self.ligand.atoms):
-            self.elec = es[i] * atom.charge
-            self.elecs.append(self.elec)
-            self.elec_total += self.elec
-        for idx, atom in enumerate(self.protein.flex_atoms):
-            if atom.id in self.protein.ignore_inter:
-                self.elec = 0.0
-            else:
-                i = protein_idx + idx
-                self.elec = es[i] * atom.charge
-            self.elecs.append(self.elec)
-            self.elec_total += self.elec
+        self.elecs = elecs.tolist()
+        self.elec_total = float(self.sum_in_order(elecs))
 
         # Van der Waals
-        self.emaps = []
-        self.emap_total = 0.0
-        for i, atom in enumerate(self.ligand.atoms):
-            self.emap = ms[i] + ds[i] * abs(atom.charge)
-            self.emaps.append(self.emap)
-            self.emap_total += self.emap
-        for idx, atom in enumerate(self.protein.flex_atoms):
-            if atom.id in self.protein.ignore_inter:
-                self.emap = 0.0
-            else:
-                i = protein_idx + idx
-                self.emap = ms[i] + ds[i] * abs(atom.charge)
-            self.emaps.append(self.emap)
-            self.emap_total += self.emap
+        self.emaps = emaps.tolist()
+        self.emap_total = float(self.sum_in_order(emaps))
 
         return self.elec_total + self.emap_total
 
-    def calc_intramolecular_energy(self):
+    # Non-bond lists as arrays together with the energy tables they index,
+    # set up on the first intramolecular energy calculation
+    def setup_non_bond_arrays(self):
+        ligand_len = len(self.ligand.atoms)
+        self.non_bond_arrays = self.bond.convert_non_bond_lists_to_arrays( \
+            [(self.non_bond_ligand, 0, 0), \
+             (self.non_bond_ligand_receptor, 0, ligand_len), \
+             (self.non_bond_receptor, ligand_len, ligand_len)], \
+            self.ligand.atom_types)
+        self.et_vdw_hb_np = self.bond.compact_vdw_hb(self.bond.bound_et, \
+                                                     self.ligand.atom_types)
+        self.et_solvation_np = np.array(self.bond.bound_et.solvation, \
+                                        dtype = float)
+        self.et_inv_r_epsilon_np = np.array(self.bond.bound_et.inv_r_epsilon, \
+                                            dtype = float)
+
+    # Internal energy of every non-bond pair given atom coordinates of shape
+    # (..., N, 3). Ligand, ligand-receptor and receptor pairs are all
+    # evaluated the same way.
+    def calc_non_bond_energies(self, tcoords):
+        nba = self.non_bond_arrays
         ns_intl_1 = self.bond.EnergyTable.NS_INTL - 1
         ns_el_1 = self.bond.EnergyTable.NS_EL - 1
 
-        total_e_internal = 0.0
-        # Intramolecular in the ligand
-        for nb in self.non_bond_ligand:
-            atom1 = nb.atom1 - 1
-            atom_type1 = nb.atom_type1
-            atom2 = nb.atom2 - 1
-            atom_type2 = nb.atom_type2
-            non_bond_type = nb.non_bond_type
-            desolv = nb.desolv
-            q1q2 = nb.q1q2
-
-            # Get atoms distance
-            atom_tcoord1 = self.ligand.atoms[atom1].tcoord
-            atom_tcoord2 = self.ligand.atoms[atom2].tcoord
-            r_tcoord2 = atom_tcoord1 - atom_tcoord2
-            r2 = r_tcoord2.sq_hypotenuse()
-            r2 = max(self.bond.RMIN_ELEC2, r2)  # Clamp r2 at RMIN_ELEC2
-            i = int(r2 * self.bond.EnergyTable.SQA_DIV)
-            # Make sure the indexes are not greater than NS_INTL -1 and
-            # NS_EL - 1 respectively
-            i_ns_intl = min(i, ns_intl_1)
-            i_ns_el = min(i, ns_el_1)
-
-            e_internal = 0.0
-            if self.dps.calc_inter_elec_e:
-                # Calculate Electrostatic Energy
-                e_elec = q1q2 * self.bond.bound_et.inv_r_epsilon[i_ns_el]
-                e_internal += e_elec
-            if r2 < self.bond.EnergyTable.NBC2:
-                # Calculate Desolvation Energy
-                e_desolv = desolv * self.bond.bound_et.solvation[i_ns_intl]
-                # Calculate Van der Waals and Hydrogen Bond Energies
-                if self.bond.include_1_4_interactions and non_bond_type == 4:
-                    e_internal += self.SCALE_1_4_INTERACTIONS + \
-                                  (self.bond.bound_et.vdw_hb[(atom_type1, atom_type2)][i_ns_intl] + e_desolv)
-                else:
-                    e_internal += self.bond.bound_et.vdw_hb[(atom_type1, atom_type2)][i_ns_intl] + e_desolv
-
-            total_e_internal += e_internal
-
-        # Intermolecular ligand-receptor
-        for nb in self.non_bond_ligand_receptor:
-            atom1 = nb.atom1 - 1
-            atom_type1 = nb.atom_type1
-            atom2 = nb.atom2 - 1
-            atom_type2 = nb.atom_type2
-            non_bond_type = nb.non_bond_type
-            desolv = nb.desolv
-            q1q2 = nb.q1q2
-
-            # Get atoms distance
-            atom_tcoord1 = self.ligand.atoms[atom1].tcoord
-            atom_tcoord2 = self.protein.flex_atoms[atom2].tcoord
-            r_tcoord2 = atom_tcoord1 - atom_tcoord2
-            r2 = r_tcoord2.sq_hypotenuse()
-            r2 = max(self.bond.RMIN_ELEC2, r2)  # Clamp r2 at RMIN_ELEC2
-            i = int(r2 * self.bond.EnergyTable.SQA_DIV)
-            # Make sure the indexes are not greater than NS_INTL -1 and
-            # NS_EL - 1 respectively
-            i_ns_intl = min(i, ns_intl_1)
-            i_ns_el = min(i, ns_el_1)
-
-            e_internal = 0.0
-            if self.dps.calc_inter_elec_e:
-                # Calculate Electrostatic Energy
-                e_elec = q1q2 * self.bond.bound_et.inv_r_epsilon[i_ns_el]
-                e_internal += e_elec
-            if r2 < self.bond.EnergyTable.NBC2:
-                # Calculate Desolvation Energy
-                e_desolv = desolv * self.bond.bound_et.solvation[i_ns_intl]
-                # Calculate Van der Waals and Hydrogen Bond Energies
-                if self.bond.include_1_4_interactions and non_bond_type == 4:
-                    e_internal += self.SCALE_1_4_INTERACTIONS + \
-                        (self.bond.bound_et.vdw_hb[(atom_type1, atom_type2)][i_ns_intl] + e_desolv)
-                else:
-                    e_internal += self.bond.bound_et.vdw_hb[(atom_type1, atom_type2)][i_ns_intl] + e_desolv
-
-            total_e_internal += e_internal
-
-        # Intramolecular in the receptor
-        for nb in self.non_bond_receptor:
-            atom1 = nb.atom1 - 1
-            atom2 = nb.atom2 - 1
-            atom_type1 = nb.atom_type1
-            atom_type2 = nb.atom_type2
-            non_bond_type = nb.non_bond_type
-            desolv = nb.desolv
-            q1q2 = nb.q1q2
-
-            # Get atoms distance
-            atom_tcoord1 = self.protein.flex_atoms[atom1].tcoord
-            atom_tcoord2 = self.protein.flex_atoms[atom2].tcoord
-            r_tcoord2 = atom_tcoord1 - atom_tcoord2
-            r2 = r_tcoord2.sq_hypotenuse()
-            r2 = max(self.bond.RMIN_ELEC2, r2)  # Clamp r2 at RMIN_ELEC2
-            i = int(r2 * self.bond.EnergyTable.SQA_DIV)
-            # Make sure the indexes are not greater than NS_INTL -1 and
-            # NS_EL - 1 respectively
-            i_ns_intl = min(i, ns_intl_1)
-            i_ns_el = min(i, ns_el_1)
-
-            e_internal = 0.0
-            if self.dps.calc_inter_elec_e:
-                # Calculate Electrostatic Energy
-                e_elec = q1q2 * self.bond.bound_et.inv_r_epsilon[i_ns_el]
-                e_internal += e_elec
-            if r2 < self.bond.EnergyTable.NBC2:
-                # Calculate Desolvation Energy
-                e_desolv = desolv * self.bond.bound_et.solvation[i_ns_intl]
-                # Calculate Van der Waals and Hydrogen Bond Energies
-                if self.bond.include_1_4_interactions and non_bond_type == 4:
-                    e_internal += self.SCALE_1_4_INTERACTIONS + \
-                        (self.bond.bound_et.vdw_hb[(atom_type1, atom_type2)][i_ns_intl] + e_desolv)
-                else:
-                    e_internal += self.bond.bound_et.vdw_hb[(atom_type1, atom_type2)][i_ns_intl] + e_desolv
-
-            total_e_internal += e_internal
+        # Get atoms distance
+        r_tcoords = tcoords[..., nba.atom_idx1, :] - \
+                    tcoords[..., nba.atom_idx2, :]
+        r2 = r_tcoords[..., 0] * r_tcoords[..., 0] + \
+             r_tcoords[..., 1] * r_tcoords[..., 1] + \
+             r_tcoords[..., 2] * r_tcoords[..., 2]
+        r2 = np.maximum(self.bond.RMIN_ELEC2, r2)  # Clamp r2 at RMIN_ELEC2
+        i = (r2 * self.bond.EnergyTable.SQA_DIV).astype(int)
+        # Make sure the indexes are not greater than NS_INTL -1 and
+        # NS_EL - 1 respectively
+        i_ns_intl = np.minimum(i, ns_intl_1)
+        i_ns_el = np.minimum(i, ns_el_1)
+
+        e_internals = np.zeros(r2.shape)
+        if self.dps.calc_inter_elec_e:
+            # Calculate Electrostatic Energy
+            e_internals += nba.q1q2 * self.et_inv_r_epsilon_np[i_ns_el]
+        # Calculate Desolvation, Van der Waals and Hydrogen Bond Energies
+        e_desolvs = nba.desolv * self.et_solvation_np[i_ns_intl]
+        e_vdw_hbs = self.et_vdw_hb_np[nba.type_pair, i_ns_intl] + e_desolvs
+        if self.bond.include_1_4_interactions:
+            e_vdw_hbs = np.where(nba.non_bond_type == 4, \
+                                 self.SCALE_1_4_INTERACTIONS + e_vdw_hbs, \
+                                 e_vdw_hbs)
+        e_internals += np.where(r2 < self.bond.EnergyTable.NBC2, e_vdw_hbs, 0.0)
+        return e_internals
 
-        return total_e_internal
+    def calc_intramolecular_energy(self):
+        if self.non_bond_arrays is None:
+            self.setup_non_bond_arrays()
+        tcoords = self.get_atom_tcoords_in_numpy(self.ligand, self.protein)
+        return float(self.sum_in_order(self.calc_non_bond_energies(tcoords)))
 
     def calc_energy(self):
         intermolecular_energy = self.calc_intermolecular_energy()
         intramolecular_energy = self.calc_intramolecular_energy()
         return intermolecular_energy + intramolecular_energy
 
+    # Set candidate binding modes of all genomes (P, 7 + T), laid out as
+    # translation (x, y, z), rotation (a, b, c, d) and torsions, from the
+    # original pose. Return atom coordinates of shape (P, N, 3).
+    def set_poses_in_numpy(self, genomes):
+        tree = self.get_torsion_tree()
+        ligand_len = len(self.ligand.ori_atoms)
+        ori_tcoords = np.vstack((self.ligand.ori_tcoords, \
+                                 self.protein.ori_flex_tcoords))
+        tcoords = np.tile(ori_tcoords, (len(genomes), 1, 1))
+
+        # Rotate rotatable branches/bonds for both ligand and protein, all
+        # atoms of a level at once with the rotation of their own branch
+        for level in xrange(tree.ttl_levels):
+            atom_idx, rot_idx = tree.get_level_atoms(level)
+            anchor_tcoords = tcoords[:, tree.anchors[rot_idx]]
+            link_tcoords = tcoords[:, tree.links[rot_idx]]
+            rotations = Quaternion.from_angle_axis_in_numpy( \
+                            genomes[:, 7 + rot_idx], \
+                            anchor_tcoords - link_tcoords)
+            tcoords[:, atom_idx] = Quaternion.transform_in_numpy( \
+                                       link_tcoords, rotations, \
+                                       (tcoords[:, atom_idx] - \
+                                        link_tcoords)[..., np.newaxis, :])[..., 0, :]
+
+        # Transform (translate and rotate) ligand root (whole body)
+        tcoords[:, :ligand_len] = Quaternion.transform_in_numpy( \
+                                      genomes[:, 0:3], genomes[:, 3:7], \
+                                      tcoords[:, :ligand_len])
+        return tcoords
+
+    # Array counterpart of check_out_of_grid for coordinates (..., N, 3)
+    def check_out_of_grid_in_numpy(self, tcoords):
+        lo = np.array(self.grid.field.lo.xyz)
+        hi = np.array(self.grid.field.hi.xyz)
+        return np.any((tcoords <= lo) | (tcoords >= hi), axis = (-2, -1))
+
+    # Build everything score_batch sets up on first use, so that the arrays can
+    # be shared read-only, e.g. by forked worker processes
+    def setup_scoring(self):
+        self.get_torsion_tree()
+        self.grid.get_flat_maps()
+        if self.non_bond_arrays is None:
+            self.setup_non_bond_arrays()
+
+    # Score all genomes (P, 7 + T) at once. Return P energies with infinity
+    # for poses out of grid.
+    def score_batch(self, genomes):
+        genomes = np.asarray(genomes, dtype = float).reshape( \
+                      -1, 7 + self.get_total_torsions())
+        if self.non_bond_arrays is None:
+            self.setup_non_bond_arrays()
+        tcoords = self.set_poses_in_numpy(genomes)
+        in_grid = np.logical_not(self.check_out_of_grid_in_numpy(tcoords))
+
+        energies = np.empty(len(genomes))
+        energies.fill(float("inf"))
+        if np.any(in_grid):
+            tcoords = tcoords[in_grid]
+            elecs, emaps = self.calc_intermolecular_energies(tcoords)
+            intermolecular_energies = self.sum_in_order(elecs) + \
+                                      self.sum_in_order(emaps)
+            intramolecular_energies = \
+                self.sum_in_order(self.calc_non_bond_energies(tcoords))
+            energies[in_grid] = intermolecular_energies + \
+                                intramolecular_energies
+        return energies
+
     def test_print(self):
         for i, atom in enumerate(self.ligand.atoms):
             print "%2s: %2s - %8.3f, %8.3f, %8.3f | %+9.2f | %+9.2f" % \
@@ -509,27 +463,79 @@ class Dock:
                  self.emaps[i], self.elecs[i])
 
 class DockOpenCL(Dock):
+    # Device buffers of a chunk of poses and the queue scoring them. Chunks
+    # of a population take turns on the buffer sets of a pool.
+    class ChunkBuffers:
+        def __init__(self, cl_queue = None):
+            self.cl_queue = cl_queue
+            # Poses holds total atoms + 1 due to starting index of 1
+            self.poses_buf = None
+            # Intermolecular energy
+            self.elecs_buf = None
+            self.emaps_buf = None
+            self.elec_totals_buf = None
+            self.emap_totals_buf = None
+            # Intramolecular energy
+            self.e_internals_buf = None
+            self.e_internal_totals_buf = None
+
+    # Share of the device global memory for the chunk buffer pool, leaving
+    # the rest to maps, tables and the genetic algorithm
+    CHUNK_MEMORY_FRACTION = 0.5
+    # Buffer sets of the pool when scoring in more than one chunk
+    CHUNK_POOL_SIZE = 2
+
     def __init__(self):
         Dock.__init__(self)
-        # Keep information about branches rotation sequence that contains
-        # atom IDs start from 1. Use 0 to denote a non-atom information.
-        self.longest_branch = 0
-        self.longest_branch_np = np.array([0], dtype = int)
-        self.longest_branch_buf = None
-        self.branches_rot_anchor_np = np.array([], dtype = int)
-        self.branches_rot_anchor_buf = None
-        self.branches_rot_link_np = np.array([], dtype = int)
-        self.branches_rot_link_buf = None
-        self.branches_rot_size_np = np.array([], dtype = int)
-        self.branches_rot_size_buf = None
-        self.branches_rot_seq_np = np.array([], dtype = int)
-        self.branches_rot_seq_buf = None
+        # Torsion tree in device buffers with atom IDs start from 1 as in
+        # poses. Rotated atoms and their torsions are kept per level.
+        self.torsion_anchors_buf = None
+        self.torsion_links_buf = None
+        self.level_atoms_bufs = []
+        self.level_torsions_bufs = []
+        # First level rotating each atom
+        self.atom_levels_np = np.array([], dtype = int)
+        self.atom_levels_buf = None
+        # All levels in single buffers for the fused scoring kernel
+        self.level_starts_buf = None
+        self.level_atoms_buf = None
+        self.level_torsions_buf = None
+
+        # Scoring pipeline, either separate kernels for each step ("multi") or
+        # a single kernel with one work-group per pose ("fused")
+        self.scoring = "multi"
+        self.individuals_buf = None
+        # Work-group size of kernels running one work-group per pose
+        self.pose_local_size = 64
+        # Keep per-atom and per-pair energies in device buffers instead of
+        # only reducing them into per-pose totals
+        self.energy_decomposition = False
+        # Storage of maps on the device (buffer, image). Images are sampled
+        # with linear filtering by the device, or interpolated from nearest
+        # texels otherwise.
+        self.map_storage = "buffer"
+        self.map_filter_linear = True
+        self.map_slab_depth = 0
+        # Floating-point precision of the kernels (fp64, fp32, mixed). Mixed
+        # keeps geometry, maps and energy tables in single precision while
+        # accumulating energies in double precision.
+        self.precision = "fp64"
+        # Largest number of poses scored at a time, or 0 for as many as the
+        # device memory holds
+        self.max_chunk_poses = 0
 
         # OpenCL
         self.cl_ctx = None
         self.cl_queue = None
         self.cl_filename = "./OpenCL/Dock.cl"
+        self.cl_code = ""
         self.cl_prg = None
+        # OpenCL program binary cache (disabled by default)
+        self.program_cache = None
+        # OpenCL work-group size tuner (disabled by default)
+        self.workgroup_tuner = None
+        # Poses written by tuning launches of kernels moving atoms in place
+        self.scratch_poses_buf = None
 
         # OpenCL device buffer
         self.num_points1_np = np.array([], dtype = int)
@@ -550,34 +556,27 @@ class DockOpenCL(Dock):
         self.electrostatic_lut_buf = None
         self.desolvation_lut_buf = None
         self.atom_type_map_lut_buf = None
+        # Buffer, or image with image map storage
         self.maps_buf = None
         self.ttl_maps_np = np.array([], dtype = int)
-        self.ttl_maps_buf = None
 
         self.ttl_atom_types_np = np.array([], dtype = int)
-        self.ttl_atom_types_buf = None
         # Collection of atom properties for all atoms in ligand and protein.
         # It's 2D array i by j for atom ID and atom properties (atom type,
         # charge).
         # Indexed for atom ID starts from 1 (index 0 is not in use).
         self.ttl_atom_properties_np = np.array([], dtype = int)
-        self.ttl_atom_properties_buf = None
         self.atoms_properties_np = np.array([], dtype = float)
         self.atoms_properties_buf = None
         self.ttl_torsions_np = np.array([], dtype = int)
-        self.ttl_torsions_buf = None
         self.ttl_ligand_atoms_np = np.array([], dtype = int)
-        self.ttl_ligand_atoms_buf = None
         self.ori_atom_tcoords_np = np.array([], dtype = float)
         self.ori_atom_tcoords_buf = None
         self.ttl_atoms_np = np.array([], dtype = int)
-        self.ttl_atoms_buf = None
 
         # Non-bond properties
         self.ttl_non_bond_properties_np = np.array([], dtype = int)
-        self.ttl_non_bond_properties_buf = None
         self.ttl_non_bond_list_np = np.array([], dtype = int)
-        self.ttl_non_bond_list_buf = None
         # Matrix of non-bond list by non-bond properties
         self.non_bond_list_np = np.array([], dtype = float)
         self.non_bond_list_buf = None
@@ -586,9 +585,7 @@ class DockOpenCL(Dock):
         self.bond_properties_np = np.array([], dtype = float)
         self.bond_properties_buf = None
         self.calc_inter_elec_e_np = np.array([], dtype = int)
-        self.calc_inter_elec_e_buf = None
         self.include_1_4_interactions_np = np.array([], dtype = int)
-        self.include_1_4_interactions_buf = None
         # Energy tables
         self.et_inv_r_epsilon_np = np.array([], dtype = float)
         self.et_inv_r_epsilon_buf = None
@@ -597,49 +594,139 @@ class DockOpenCL(Dock):
         self.et_vdw_hb_np = np.array([], dtype = float)
         self.et_vdw_hb_buf = None
 
-        # Collection of atom coordinates for entire population. It's a 3D array
-        # i by j by k for atom ID, individual and atom coordinate respectively.
+        # Collection of atom coordinates for a chunk of the population. It's a
+        # 3D array i by j by k for atom ID, individual and atom coordinate
+        # respectively.
         # Indexed for atom ID starts from 1 (index 0 is not in use).
+        # The population of ttl_population poses is scored in ttl_chunks
+        # chunks of ttl_poses_np poses, each on a buffer set of the pool.
+        self.ttl_population = 0
+        self.ttl_chunks = 1
         self.ttl_poses_np = np.array([], dtype = int)
-        self.ttl_poses_buf = None
-        self.ori_poses_np = None
-        self.ori_poses_buf = None
         self.poses_np = None
-        self.poses_buf = None
+        self.chunk_buffers = []
         self.protein_ignore_inter_np = np.array([], dtype = int)
         self.protein_ignore_inter_buf = None
         self.ttl_protein_ignore_inter_np = np.array([], dtype = int)
-        self.ttl_protein_ignore_inter_buf = None
 
         # Intermolecular energy
         self.elecs_np = None
-        self.elecs_buf = None
         self.emaps_np = None
-        self.emaps_buf = None
         self.elec_totals_np = None
-        self.elec_totals_buf = None
         self.emap_totals_np = None
-        self.emap_totals_buf = None
         # Intramolecular energy
         self.e_internals_np = None
-        self.e_internals_buf = None
         self.e_internal_totals_np = None
-        self.e_internal_totals_buf = None
-        # Total energy
+        # Total energy of the population
         self.e_totals_np = None
         self.e_totals_buf = None
 
+    # The program is built by setup_opencl_buffer once the sizes it is
+    # specialized for are known
     def setup_opencl(self, cl_ctx = None, cl_queue = None):
         self.cl_ctx = cl_ctx
         self.cl_queue = cl_queue
         fh = open(self.cl_filename, 'r')
-        cl_code = "".join(fh.readlines())
-        self.cl_prg = cl.Program(cl_ctx, cl_code).build()
+        self.cl_code = "".join(fh.readlines())
+
+    # Kernel PRECISION definition and numpy types of real_t (geometry, maps
+    # and energy tables) and accum_t (energy sums) of each precision
+    PRECISIONS = {"fp64": (0, np.float64, np.float64), \
+                  "fp32": (1, np.float32, np.float32), \
+                  "mixed": (2, np.float32, np.float64)}
+
+    def get_real_dtype(self):
+        return DockOpenCL.PRECISIONS[self.precision][1]
+
+    def get_accum_dtype(self):
+        return DockOpenCL.PRECISIONS[self.precision][2]
+
+    # Build options shared by the programs running on the buffers of this
+    # docking object
+    def get_precision_options(self):
+        options = ["-DPRECISION=%d" % DockOpenCL.PRECISIONS[self.precision][0]]
+        if self.precision != "fp64":
+            options.append("-cl-single-precision-constant")
+        return options
+
+    # Sizes and flags baked into the program as preprocessor definitions.
+    # Together they make up the signature of the ligand (atoms, torsions,
+    # non-bond pairs) and of the receptor (flexible atoms, maps), so each
+    # docking problem gets its own program.
+    def get_build_options(self):
+        tree = self.get_torsion_tree()
+        defines = [("TTL_POPULATION", self.ttl_population), \
+                   ("TTL_POSES", self.ttl_poses_np[0]), \
+                   ("TTL_ATOMS", self.ttl_atoms_np[0]), \
+                   ("TTL_LIGAND_ATOMS", self.ttl_ligand_atoms_np[0]), \
+                   ("TTL_TORSIONS", self.ttl_torsions_np[0]), \
+                   ("TTL_LEVELS", tree.ttl_levels), \
+                   ("TTL_MAPS", self.ttl_maps_np[0]), \
+                   ("TTL_ATOM_TYPES", self.ttl_atom_types_np[0]), \
+                   ("TTL_ATOM_PROPERTIES", int(self.ttl_atom_properties_np)), \
+                   ("TTL_PROTEIN_IGNORE_INTER", self.ttl_protein_ignore_inter_np[0]), \
+                   ("TTL_NON_BOND_LIST", self.ttl_non_bond_list_np[0]), \
+                   ("TTL_NON_BOND_PROPERTIES", self.ttl_non_bond_properties_np[0]), \
+                   ("CALC_INTER_ELEC_E", self.calc_inter_elec_e_np[0]), \
+                   ("INCLUDE_1_4_INTERACTIONS", self.include_1_4_interactions_np[0]), \
+                   ("MAP_IMAGE", self.map_storage == "image")]
+        if self.map_storage == "image":
+            defines += [("MAP_FILTER_LINEAR", self.map_filter_linear), \
+                        ("MAP_SLAB_DEPTH", self.map_slab_depth)]
+        return ["-D%s=%d" % (name, value) for name, value in defines] + \
+               self.get_precision_options()
+
+    # Programs already built in this process by context and build options
+    programs = {}
+
+    def build_program(self):
+        options = self.get_build_options()
+        key = (self.cl_ctx, tuple(options))
+        if key not in DockOpenCL.programs:
+            if self.program_cache:
+                cl_prg = self.program_cache.build(self.cl_ctx, self.cl_code, \
+                                                  os.path.basename(self.cl_filename), \
+                                                  options)
+            else:
+                cl_prg = cl.Program(self.cl_ctx, self.cl_code).build(options)
+            DockOpenCL.programs[key] = cl_prg
+        self.cl_prg = DockOpenCL.programs[key]
+
+    # 3D image of maps in RGBA float texels, each holding a grid point of 4
+    # maps. Groups of 4 maps are stacked along depth. None when any device of
+    # the context does not support images of that size.
+    def create_maps_image(self, cl_ctx):
+        ttl_maps = self.ttl_maps_np[0]
+        ttl_slabs = (ttl_maps + 3) // 4
+        # AutoDock uses z, y, x axis order for maps. Height and width are taken
+        # from the y and z point counts only because, as in the buffer
+        # indexing of the kernels, the layout assumes a cubic grid.
+        assert self.num_points1_np[0] == self.num_points1_np[1] == \
+               self.num_points1_np[2], "maps image needs a cubic grid"
+        height = self.num_points1_np[1]
+        width = self.num_points1_np[2]
+        maps = self.maps_np.reshape(-1, ttl_maps)
+        self.map_slab_depth = maps.shape[0] // (height * width)
+        for device in cl_ctx.devices:
+            if not device.image_support or \
+               width > device.image3d_max_width or \
+               height > device.image3d_max_height or \
+               ttl_slabs * self.map_slab_depth > device.image3d_max_depth:
+                return None
+
+        texels = np.zeros((ttl_slabs * 4, maps.shape[0]), dtype = np.float32)
+        texels[:ttl_maps] = np.transpose(maps)
+        texels = texels.reshape(ttl_slabs, 4, self.map_slab_depth, height, width)
+        texels = np.ascontiguousarray(texels.transpose(0, 2, 3, 4, 1))
+        texels = texels.reshape(ttl_slabs * self.map_slab_depth, height, width, 4)
+        return cl.image_from_array(cl_ctx, texels, 4)
 
     #TODO: Use self class cl_ctx and cl_queue
     def setup_opencl_buffer(self, ttl_poses = 0, \
                             cl_ctx = None, cl_queue = None):
         mf = cl.mem_flags
+        real_dtype = self.get_real_dtype()
+        accum_dtype = self.get_accum_dtype()
         #TODO: Move following variables into respective class
         # Field information (OpenCL device buffer)
         self.num_points1_np = np.array(self.grid.field.num_points1.xyz, \
@@ -647,11 +734,11 @@ class DockOpenCL(Dock):
         self.num_points1_buf = cl.Buffer(cl_ctx, \
                                          mf.READ_ONLY | mf.COPY_HOST_PTR, \
                                          hostbuf = self.num_points1_np)
-        self.lo_grid_np = np.array(self.grid.field.lo.xyz, dtype = float)
+        self.lo_grid_np = np.array(self.grid.field.lo.xyz, dtype = real_dtype)
         self.lo_grid_buf = cl.Buffer(cl_ctx, \
                                      mf.READ_ONLY | mf.COPY_HOST_PTR, \
                                      hostbuf = self.lo_grid_np)
-        self.hi_grid_np = np.array(self.grid.field.hi.xyz, dtype = float)
+        self.hi_grid_np = np.array(self.grid.field.hi.xyz, dtype = real_dtype)
         self.hi_grid_buf = cl.Buffer(cl_ctx, \
                                      mf.READ_ONLY | mf.COPY_HOST_PTR, \
                                      hostbuf = self.hi_grid_np)
@@ -659,7 +746,7 @@ class DockOpenCL(Dock):
         self.dist_grid_buf = cl.Buffer(cl_ctx, \
                                        mf.READ_ONLY | mf.COPY_HOST_PTR, \
                                        hostbuf = self.dist_grid_np)
-        self.field_spacing_np = np.array(self.grid.field.spacing, dtype = float)
+        self.field_spacing_np = np.array(self.grid.field.spacing, dtype = real_dtype)
         self.field_spacing_buf = cl.Buffer(cl_ctx, \
                                            mf.READ_ONLY | mf.COPY_HOST_PTR, \
                                            hostbuf = self.field_spacing_np)
@@ -678,7 +765,7 @@ class DockOpenCL(Dock):
                 self.atom_type_map_lut_np[self.ligand.atom_types.index(atom_type)] = map_idx
                 self.maps_np = np.vstack([self.maps_np, \
                                                     self.grid.maps[atom_type].ravel()])
-        self.maps_np = np.transpose(self.maps_np).ravel()
+        self.maps_np = np.transpose(self.maps_np).ravel().astype(real_dtype)
         self.ttl_maps_np = np.array([map_idx + 1], dtype = int)
 
         self.electrostatic_lut_buf = cl.Buffer(cl_ctx, \
@@ -690,23 +777,20 @@ class DockOpenCL(Dock):
         self.atom_type_map_lut_buf = cl.Buffer(cl_ctx, \
                                                mf.READ_ONLY | mf.COPY_HOST_PTR, \
                                                hostbuf = self.atom_type_map_lut_np)
-        self.maps_buf = cl.Buffer(cl_ctx, \
-                                  mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                  hostbuf = self.maps_np)
-        self.ttl_maps_buf = cl.Buffer(cl_ctx, \
+        if self.map_storage == "image":
+            self.maps_buf = self.create_maps_image(cl_ctx)
+            if self.maps_buf is None:
+                print "OpenCL images not supported, maps are stored in a buffer"
+                self.map_storage = "buffer"
+        if self.map_storage != "image":
+            self.maps_buf = cl.Buffer(cl_ctx, \
                                       mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                      hostbuf = self.ttl_maps_np)
+                                      hostbuf = self.maps_np)
 
         # Atoms properties (OpenCL device buffer)
         self.ttl_atom_types_np = np.array([len(self.ligand.atom_types)], dtype = int)
-        self.ttl_atom_types_buf = cl.Buffer(cl_ctx, \
-                                            mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                            hostbuf = self.ttl_atom_types_np)
         ttl_atom_properties = 2 # Atom type, charge
         self.ttl_atom_properties_np = np.array(ttl_atom_properties, dtype = int)
-        self.ttl_atom_properties_buf = cl.Buffer(cl_ctx, \
-                                                 mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                                 hostbuf = self.ttl_atom_properties_np)
         atoms_properties = [0.0 for i in xrange(ttl_atom_properties)]
         for atom in self.ligand.atoms:
             atoms_properties.append(float(self.ligand.atom_types.index(atom.type)))
@@ -714,7 +798,7 @@ class DockOpenCL(Dock):
         for atom in self.protein.flex_atoms:
             atoms_properties.append(float(self.ligand.atom_types.index(atom.type)))
             atoms_properties.append(atom.charge)
-        self.atoms_properties_np = np.array(atoms_properties, dtype = float)
+        self.atoms_properties_np = np.array(atoms_properties, dtype = real_dtype)
         self.atoms_properties_buf = cl.Buffer(cl_ctx, \
                                               mf.READ_ONLY | mf.COPY_HOST_PTR, \
                                               hostbuf = self.atoms_properties_np)
@@ -722,19 +806,13 @@ class DockOpenCL(Dock):
         protein_idx = len(self.ligand.atoms)
         self.ttl_torsions_np = np.array([self.get_total_torsions()], \
                                         dtype = int)
-        self.ttl_torsions_buf = cl.Buffer(cl_ctx, \
-                                          mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                          hostbuf = self.ttl_torsions_np)
         self.ttl_ligand_atoms_np = np.array([len(self.ligand.atoms)], \
                                             dtype = int)
-        self.ttl_ligand_atoms_buf = cl.Buffer(cl_ctx, \
-                                              mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                              hostbuf = self.ttl_ligand_atoms_np)
         self.ligand.reset_atoms()
         self.protein.reset_flex_atoms()
         self.ori_atom_tcoords_np = np.vstack([np.array([0., 0., 0.], dtype = float), \
                                               self.ligand.get_atom_tcoords_in_numpy(), \
-                                              self.protein.get_flex_atom_tcoords_in_numpy()])
+                                              self.protein.get_flex_atom_tcoords_in_numpy()]).astype(real_dtype)
         self.ori_atom_tcoords_buf = cl.Buffer(cl_ctx, \
                                               mf.READ_ONLY | mf.COPY_HOST_PTR, \
                                               hostbuf = self.ori_atom_tcoords_np)
@@ -771,14 +849,8 @@ class DockOpenCL(Dock):
             non_bond_list.append(nb.q1q2)
         self.ttl_non_bond_properties_np = np.array([ttl_non_bond_properties], \
                                                    dtype = int)
-        self.ttl_non_bond_properties_buf = cl.Buffer(cl_ctx, \
-                                                     mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                                     hostbuf = self.ttl_non_bond_properties_np)
         self.ttl_non_bond_list_np = np.array([ttl_non_bond_list], dtype = int)
-        self.ttl_non_bond_list_buf = cl.Buffer(cl_ctx, \
-                                               mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                               hostbuf = self.ttl_non_bond_list_np)
-        self.non_bond_list_np = np.array(non_bond_list, dtype = float)
+        self.non_bond_list_np = np.array(non_bond_list, dtype = real_dtype)
         self.non_bond_list_buf = cl.Buffer(cl_ctx, \
                                            mf.READ_ONLY | mf.COPY_HOST_PTR, \
                                            hostbuf = self.non_bond_list_np)
@@ -790,7 +862,7 @@ class DockOpenCL(Dock):
         bond_properties.append(self.bond.EnergyTable.SQA_DIV)
         bond_properties.append(self.bond.EnergyTable.NBC2)
         bond_properties.append(self.SCALE_1_4_INTERACTIONS)
-        self.bond_properties_np = np.array(bond_properties, dtype = float)
+        self.bond_properties_np = np.array(bond_properties, dtype = real_dtype)
         self.bond_properties_buf = cl.Buffer(cl_ctx, \
                                              mf.READ_ONLY | mf.COPY_HOST_PTR, \
                                              hostbuf = self.bond_properties_np)
@@ -799,26 +871,17 @@ class DockOpenCL(Dock):
             self.calc_inter_elec_e_np = np.array([1], dtype = int)
         else:
             self.calc_inter_elec_e_np = np.array([0], dtype = int)
-        self.calc_inter_elec_e_buf = cl.Buffer(cl_ctx, \
-                                               mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                               hostbuf = self.calc_inter_elec_e_np)
         if self.bond.include_1_4_interactions:
             self.include_1_4_interactions_np = np.array([1], dtype = int)
         else:
             self.include_1_4_interactions_np = np.array([0], dtype = int)
-        self.include_1_4_interactions_buf = cl.Buffer(cl_ctx, \
-                                                      mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                                      hostbuf = self.include_1_4_interactions_np)
         # Energy tables
         self.et_inv_r_epsilon_np = np.array(self.bond.bound_et.inv_r_epsilon, \
-                                            dtype = float)
+                                            dtype = real_dtype)
         self.et_solvation_np = np.array(self.bond.bound_et.solvation, \
-                                        dtype = float)
-        et_vdw_hb = []
-        for i, at_i in enumerate(self.ligand.atom_types):
-            for at_j in self.ligand.atom_types[i:]:
-                et_vdw_hb.append(self.bond.bound_et.vdw_hb[(at_i, at_j)])
-        self.et_vdw_hb_np = np.array(et_vdw_hb, dtype = float)
+                                        dtype = real_dtype)
+        self.et_vdw_hb_np = self.bond.compact_vdw_hb(self.bond.bound_et, \
+                                                     self.ligand.atom_types).astype(real_dtype)
 
         self.et_inv_r_epsilon_buf = cl.Buffer(cl_ctx, \
                                               mf.READ_ONLY | mf.COPY_HOST_PTR, \
@@ -833,21 +896,6 @@ class DockOpenCL(Dock):
         # Poses (OpenCL device buffer)
         ttl_atoms = self.get_total_atoms()
         self.ttl_atoms_np = np.array([ttl_atoms], dtype = int)
-        self.ttl_atoms_buf = cl.Buffer(cl_ctx, \
-                                       mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                       hostbuf = self.ttl_atoms_np)
-        self.ttl_poses_np = np.array([ttl_poses], dtype = int)
-        self.ttl_poses_buf = cl.Buffer(cl_ctx, \
-                                       mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                       hostbuf = self.ttl_poses_np)
-        self.ori_poses_np = np.hstack([self.ori_atom_tcoords_np] * ttl_poses).ravel()
-        self.ori_poses_buf = cl.Buffer(cl_ctx, \
-                                       mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                       hostbuf = self.ori_poses_np)
-        # Poses holds total atoms + 1 due to starting index of 1
-        self.poses_buf = cl.array.zeros(cl_queue, \
-                                        ((ttl_atoms + 1) * ttl_poses * 3), \
-                                        dtype = float)
         protein_ignore_inter = []
         for id in self.protein.ignore_inter:
             protein_ignore_inter.append(protein_idx + id)
@@ -858,38 +906,95 @@ class DockOpenCL(Dock):
                                                   hostbuf = self.protein_ignore_inter_np)
         self.ttl_protein_ignore_inter_np = np.array([len(protein_ignore_inter)], \
                                                     dtype = int)
-        self.ttl_protein_ignore_inter_buf = cl.Buffer(cl_ctx, \
-                                                      mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                                      hostbuf = self.ttl_protein_ignore_inter_np)
-        # Intermolecular energy
-        self.elecs_buf = cl.array.zeros(cl_queue, \
-                                        ((ttl_atoms + 1) * ttl_poses), \
-                                        dtype = float)
-        self.emaps_buf = cl.array.zeros(cl_queue, \
-                                        ((ttl_atoms + 1) * ttl_poses), \
-                                        dtype = float)
-        self.elec_totals_buf = cl.array.zeros(cl_queue, (ttl_poses), \
-                                              dtype = float)
-        self.emap_totals_buf = cl.array.zeros(cl_queue, (ttl_poses), \
-                                              dtype = float)
-        # Intramolecular energy
-        self.e_internals_buf = cl.array.zeros(cl_queue, (ttl_poses * ttl_non_bond_list), \
-                                              dtype = float)
-        self.e_internal_totals_buf = cl.array.zeros(cl_queue, (ttl_poses), \
-                                                    dtype = float)
+        # Poses are scored in chunks fitting into the device memory, each
+        # chunk on its own buffer set. With more than one chunk, a second
+        # buffer set on a second queue lets a chunk be scored while the
+        # previous one is still running.
+        self.ttl_population = ttl_poses
+        chunk_size = self.get_chunk_size(ttl_poses, cl_queue.device)
+        self.ttl_chunks = (ttl_poses + chunk_size - 1) // chunk_size
+        self.ttl_poses_np = np.array([chunk_size], dtype = int)
+        self.chunk_buffers = [self.ChunkBuffers(cl_queue)]
+        if self.ttl_chunks > 1:
+            for i in xrange(1, self.CHUNK_POOL_SIZE):
+                self.chunk_buffers.append( \
+                    self.ChunkBuffers(cl.CommandQueue(cl_ctx, cl_queue.device)))
+        # Per-atom and per-pair energies are only needed for decomposition
+        decomposition = self.energy_decomposition or DEBUG
+        for buffers in self.chunk_buffers:
+            queue = buffers.cl_queue
+            buffers.poses_buf = cl.array.zeros(queue, \
+                                               ((ttl_atoms + 1) * chunk_size * 3), \
+                                               dtype = real_dtype)
+            # Intermolecular energy
+            if decomposition:
+                buffers.elecs_buf = cl.array.zeros(queue, \
+                                                   ((ttl_atoms + 1) * chunk_size), \
+                                                   dtype = real_dtype)
+                buffers.emaps_buf = cl.array.zeros(queue, \
+                                                   ((ttl_atoms + 1) * chunk_size), \
+                                                   dtype = real_dtype)
+            buffers.elec_totals_buf = cl.array.zeros(queue, (chunk_size), \
+                                                     dtype = accum_dtype)
+            buffers.emap_totals_buf = cl.array.zeros(queue, (chunk_size), \
+                                                     dtype = accum_dtype)
+            # Intramolecular energy
+            if decomposition:
+                buffers.e_internals_buf = cl.array.zeros(queue, \
+                                                         (chunk_size * ttl_non_bond_list), \
+                                                         dtype = real_dtype)
+            buffers.e_internal_totals_buf = cl.array.zeros(queue, (chunk_size), \
+                                                           dtype = accum_dtype)
         # Total energy
-        self.e_totals_buf = cl.array.zeros(cl_queue, (ttl_poses), dtype = float)
+        self.e_totals_buf = cl.array.zeros(cl_queue, (ttl_poses), dtype = accum_dtype)
         # Protein and ligand orientations and comformations (OpenCL device
         # buffer)
-        self.set_branches_rotation_sequence(cl_ctx)
-
+        self.setup_torsion_tree_buffer(cl_ctx)
+        # Program specialized for the docked molecules and number of poses
+        self.build_program()
+        # Poses start at the reference coordinates. Atoms moved by set_poses
+        # are rewritten from the reference coordinates every time.
+        for buffers in self.chunk_buffers:
+            self.cl_prg.init_poses(buffers.cl_queue, \
+                                   ((ttl_atoms + 1) * chunk_size,), None, \
+                                   self.ori_atom_tcoords_buf, \
+                                   buffers.poses_buf.data)
+
+    # Poses per chunk, as many as the buffer pool holds within the share of
+    # the device global memory and the largest buffer the device allocates,
+    # limited by max_chunk_poses. Chunks of a population are of even size.
+    # Fused scoring keeps poses in local memory and scores all poses at once.
+    def get_chunk_size(self, ttl_poses, device):
+        if self.scoring == "fused" or ttl_poses == 0:
+            return ttl_poses
+        real_size = np.dtype(self.get_real_dtype()).itemsize
+        accum_size = np.dtype(self.get_accum_dtype()).itemsize
+        ttl_atoms = self.get_total_atoms()
+        # Bytes per pose of each chunk buffer
+        buffer_bytes = [(ttl_atoms + 1) * 3 * real_size] + [accum_size] * 3
+        if self.energy_decomposition or DEBUG:
+            buffer_bytes += [(ttl_atoms + 1) * real_size] * 2 + \
+                            [int(self.ttl_non_bond_list_np[0]) * real_size]
+        pool_bytes = device.global_mem_size * self.CHUNK_MEMORY_FRACTION
+        max_poses = min(int(pool_bytes) // (self.CHUNK_POOL_SIZE * sum(buffer_bytes)), \
+                        device.max_mem_alloc_size // max(buffer_bytes))
+        if self.max_chunk_poses:
+            max_poses = min(max_poses, self.max_chunk_poses)
+        max_poses = max(max_poses, 1)
+        ttl_chunks = (ttl_poses + max_poses - 1) // max_poses
+        return (ttl_poses + ttl_chunks - 1) // ttl_chunks
+
+    # Pose of an individual of the last scored chunks, the ones still held by
+    # the buffer pool
     def get_pose(self, idx = 0):
-        self.poses_np = self.poses_buf.get()
         ttl_poses = self.ttl_poses_np[0]
+        chunk_idx = idx // ttl_poses
+        buffers = self.chunk_buffers[chunk_idx % len(self.chunk_buffers)]
+        self.poses_np = buffers.poses_buf.get()
         ttl_atoms = self.get_total_atoms() + 1
         pose = []
         for i in xrange(ttl_atoms):
-            start_idx = (i * ttl_poses * 3) + (idx * 3)
+            start_idx = (i * ttl_poses * 3) + ((idx % ttl_poses) * 3)
             pose.append([self.poses_np[start_idx + 0], \
                          self.poses_np[start_idx + 1], \
                          self.poses_np[start_idx + 2]])
@@ -900,235 +1005,431 @@ class DockOpenCL(Dock):
         for i, coord in enumerate(pose_np):
             print "[%2d] %7.3f %7.3f %7.3f" % (i, coord[0], coord[1], coord[2])
 
-    def get_longest_branch(self):
-        longest_branch = 0
-        for branch in self.ligand.branches:
-            branch_len = len(branch.all_atom_ids)
-            if branch_len > longest_branch:
-                longest_branch = branch_len
-        for branch in self.protein.flex_branches:
-            branch_len = len(branch.all_atom_ids)
-            if branch_len > longest_branch:
-                longest_branch = branch_len
-        return longest_branch
-        
-    # Branches rotation sequence starts from the closest to leaf
-    def set_branches_rotation_sequence(self, cl_ctx = None):
-        for branch in self.ligand.branches:
-            branch.molecule = 'l' # l for ligand
-            self.sorted_branches.append(branch)
-        for branch in self.protein.flex_branches:
-            branch.molecule = 'p' # p for protein
-            self.sorted_branches.append(branch)
-        self.sorted_branches = sorted(self.sorted_branches, \
-                                      key=lambda branch: len(branch.all_atom_ids))
-
-        self.longest_branch = self.get_longest_branch()
-        protein_idx = len(self.ligand.atoms)
-        branches_rot_anchor = []
-        branches_rot_link = []
-        branches_rot_size = []
-        branches_rot_seq = []
-        for branch in self.sorted_branches:
-            branch_rot_seq = [0 for i in xrange(self.longest_branch)]
-            # Get the atoms from either ligand or protein based on branch
-            # molecule information
-            if branch.molecule == 'l':
-                molecule_atoms = self.ligand.atoms
-                shift_atom_id = 0
-            else: # 'p'
-                molecule_atoms = self.protein.flex_atoms
-                shift_atom_id = protein_idx
-            # Get atom coordinates
-            seq_idx = 0
-            for atom in molecule_atoms:
-                if atom.id in [branch.anchor_id] + [branch.link_id] + \
-                    branch.all_atom_ids:
-                        # Anchor and link atoms are not for rotation
-                        if atom.id == branch.anchor_id:
-                            branches_rot_anchor.append(atom.id + shift_atom_id)
-                            continue
-                        if atom.id == branch.link_id:
-                            branches_rot_link.append(atom.id + shift_atom_id)
-                            continue
-                        branch_rot_seq[seq_idx] = atom.id + shift_atom_id
-                        seq_idx += 1
-            branches_rot_size.append(seq_idx)
-            branches_rot_seq.append(branch_rot_seq)
-
+    # Copy torsion tree into device buffers
+    def setup_torsion_tree_buffer(self, cl_ctx = None):
+        tree = self.get_torsion_tree()
         mf = cl.mem_flags
-        self.longest_branch_np = np.array([self.longest_branch], dtype = int)
-        self.longest_branch_buf = cl.Buffer(cl_ctx, \
+        # Atom IDs start from 1
+        self.torsion_anchors_buf = cl.Buffer(cl_ctx, \
+                                             mf.READ_ONLY | mf.COPY_HOST_PTR, \
+                                             hostbuf = tree.anchors + 1)
+        self.torsion_links_buf = cl.Buffer(cl_ctx, \
+                                           mf.READ_ONLY | mf.COPY_HOST_PTR, \
+                                           hostbuf = tree.links + 1)
+        # First level rotating each atom, total levels for atoms outside of
+        # any branch
+        self.atom_levels_np = np.empty(self.get_total_atoms() + 1, dtype = int)
+        self.atom_levels_np.fill(tree.ttl_levels)
+        for level in reversed(xrange(tree.ttl_levels)):
+            level_atoms, level_torsions = tree.get_level_atoms(level)
+            self.atom_levels_np[level_atoms + 1] = level
+        self.atom_levels_buf = cl.Buffer(cl_ctx, \
+                                         mf.READ_ONLY | mf.COPY_HOST_PTR, \
+                                         hostbuf = self.atom_levels_np)
+        self.level_atoms_bufs = []
+        self.level_torsions_bufs = []
+        for level in xrange(tree.ttl_levels):
+            level_atoms, level_torsions = tree.get_level_atoms(level)
+            if not len(level_atoms):
+                self.level_atoms_bufs.append(None)
+                self.level_torsions_bufs.append(None)
+                continue
+            self.level_atoms_bufs.append( \
+                cl.Buffer(cl_ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, \
+                          hostbuf = level_atoms + 1))
+            self.level_torsions_bufs.append( \
+                cl.Buffer(cl_ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, \
+                          hostbuf = level_torsions.copy()))
+        # Device buffers cannot be empty
+        level_atoms = tree.level_atoms + 1
+        level_torsions = tree.level_torsions
+        if not len(level_atoms):
+            level_atoms = np.zeros(1, dtype = int)
+            level_torsions = np.zeros(1, dtype = int)
+        self.level_starts_buf = cl.Buffer(cl_ctx, \
+                                          mf.READ_ONLY | mf.COPY_HOST_PTR, \
+                                          hostbuf = tree.level_starts)
+        self.level_atoms_buf = cl.Buffer(cl_ctx, \
+                                         mf.READ_ONLY | mf.COPY_HOST_PTR, \
+                                         hostbuf = level_atoms)
+        self.level_torsions_buf = cl.Buffer(cl_ctx, \
                                             mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                            hostbuf = self.longest_branch_np)
-        self.branches_rot_anchor_np = np.array(branches_rot_anchor, dtype = int)
-        self.branches_rot_anchor_buf = cl.Buffer(cl_ctx, \
-                                                 mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                                 hostbuf = self.branches_rot_anchor_np)
-        self.branches_rot_link_np = np.array(branches_rot_link, dtype = int)
-        self.branches_rot_link_buf = cl.Buffer(cl_ctx, \
-                                               mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                               hostbuf = self.branches_rot_link_np)
-        self.branches_rot_size_np = np.array(branches_rot_size, dtype = int)
-        self.branches_rot_size_buf = cl.Buffer(cl_ctx, \
-                                               mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                               hostbuf = self.branches_rot_size_np)
-        self.branches_rot_seq_np = np.array(branches_rot_seq, dtype = int).ravel()
-        self.branches_rot_seq_buf = cl.Buffer(cl_ctx, \
-                                              mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                              hostbuf = self.branches_rot_seq_np)
-
-    def print_branches_rotation_sequence(self):
-        print "Branches Rotation Sequence Table:"
-        for i in xrange(self.get_total_torsions()):
-            print "%2d %2d (%2d) %s" % (self.branches_rot_anchor_np[i], \
-                                        self.branches_rot_link_np[i], \
-                                        self.branches_rot_size_np[i], \
-                                        self.branches_rot_seq_np[(i * self.longest_branch): \
-                                                                 ((i + 1) * self.longest_branch)])
-
-    #TODO: Use self class cl_queue
-    def set_poses(self, ttl_poses = 0, individuals_buf = None, \
-                  cl_queue = None):
+                                            hostbuf = level_torsions)
+
+    def print_torsion_tree(self):
+        print self.get_torsion_tree()
+
+    # Set poses of the chunk starting from individual first_pose in its
+    # buffer set
+    def set_poses(self, first_pose = 0, buffers = None):
         # Rotate rotatable branches/bonds for both ligand and protein.
-        # Rotation is expected to be in radian.
-        self.cl_prg.rotate_branches(cl_queue, \
-                                    (ttl_poses,), None, \
-                                    self.ttl_torsions_buf, \
-                                    individuals_buf.data, \
-
-                                    self.longest_branch_buf, \
-                                    self.branches_rot_anchor_buf, \
-                                    self.branches_rot_link_buf, \
-                                    self.branches_rot_size_buf, \
-                                    self.branches_rot_seq_buf, \
-
-                                    self.ttl_poses_buf, \
-                                    self.poses_buf.data)
+        # Rotation is expected to be in radian. All atoms of a level in all
+        # poses are rotated in parallel, level by level.
+        ttl_poses = int(self.ttl_poses_np[0])
+        cl_queue = buffers.cl_queue
+        individuals_buf = self.individuals_buf
+        tree = self.get_torsion_tree()
+        for level in xrange(tree.ttl_levels):
+            level_atoms, level_torsions = tree.get_level_atoms(level)
+            if not len(level_atoms): continue
+            kernel = self.cl_prg.rotate_branches
+            global_size = len(level_atoms) * ttl_poses
+            def launch(local_size, poses_buf = buffers.poses_buf):
+                return kernel(cl_queue, (global_size,), \
+                              local_size and (local_size,), \
+                              individuals_buf.data, \
+                              self.ori_atom_tcoords_buf, \
+                              self.atom_levels_buf, \
+                              np.int64(level), \
+                              np.int64(first_pose), \
+
+                              self.torsion_anchors_buf, \
+                              self.torsion_links_buf, \
+                              self.level_atoms_bufs[level], \
+                              self.level_torsions_bufs[level], \
+
+                              poses_buf.data)
+            launch(self.get_flat_local_size(kernel, global_size, \
+                                            self.get_scratch_launch(launch, \
+                                                                    buffers), \
+                                            cl_queue))
         ttl_ligand_atoms = int(self.ttl_ligand_atoms_np[0])
         # Transform (translate and rotate) ligand root (whole body)
-        self.cl_prg.transform_ligand_root(cl_queue, \
-                                          (ttl_ligand_atoms * ttl_poses,), \
-                                          None, \
-                                          self.ttl_ligand_atoms_buf, \
-                                          individuals_buf.data, \
-                                          self.ttl_torsions_buf, \
-                                          self.ttl_poses_buf, \
-                                          self.poses_buf.data)
+        kernel = self.cl_prg.transform_ligand_root
+        global_size = ttl_ligand_atoms * ttl_poses
+        def launch(local_size, poses_buf = buffers.poses_buf):
+            return kernel(cl_queue, (global_size,), \
+                          local_size and (local_size,), \
+                          individuals_buf.data, \
+                          self.ori_atom_tcoords_buf, \
+                          self.atom_levels_buf, \
+                          np.int64(first_pose), \
+                          poses_buf.data)
+        launch(self.get_flat_local_size(kernel, global_size, \
+                                        self.get_scratch_launch(launch, buffers), \
+                                        cl_queue))
 
+        if DEBUG:
+            self.poses_np = buffers.poses_buf.get()
+            print "New:"
+            for i in xrange(self.ttl_atoms_np[0] + 1):
+                print self.poses_np[((i * ttl_poses * 3) + 447):((i * ttl_poses * 3) + 450)]
+
+    # Poses are set from individuals_buf chunk by chunk while scoring them
     #TODO: Use self class cl_ctx and cl_queue
     def reset_poses(self, ttl_poses = 0, individuals_buf = None, \
                     cl_ctx = None, cl_queue = None):
-        cl.enqueue_copy(cl_queue, self.poses_buf.data, self.ori_poses_buf)
+        self.individuals_buf = individuals_buf
 
         if DEBUG:
-            self.poses_np = self.poses_buf.get()
             print "Ori:"
             for i in xrange(self.ttl_atoms_np[0] + 1):
-                print self.poses_np[(i * ttl_poses * 3):((i * ttl_poses * 3) + 3)]
-        
-        self.set_poses(ttl_poses, individuals_buf, cl_queue)
-
-        if DEBUG:
-            self.poses_np = self.poses_buf.get()
-            print "New:"
-            for i in xrange(self.ttl_atoms_np[0] + 1):
-                print self.poses_np[((i * ttl_poses * 3) + 447):((i * ttl_poses * 3) + 450)]
+                print self.ori_atom_tcoords_np[i]
 
     # Calculate free energy
-    def calc_intermolecular_energy(self):
+    def calc_intermolecular_energy(self, buffers = None):
+        if buffers.elecs_buf is None:
+            self.calc_intermolecular_energy_totals(buffers)
+            return
+
         ttl_atoms = int(self.ttl_atoms_np[0])
         ttl_poses = int(self.ttl_poses_np[0])
-        self.cl_prg.calc_inter_energy(self.cl_queue, \
-                                      (ttl_atoms * ttl_poses,), None, \
-                                      self.ttl_poses_buf, \
-                                      self.lo_grid_buf, \
-                                      self.hi_grid_buf, \
-                                      self.field_spacing_buf, \
-                                      self.poses_buf.data, \
-
-                                      self.num_points1_buf, \
-                                      self.ttl_maps_buf, \
-                                      self.electrostatic_lut_buf, \
-                                      self.desolvation_lut_buf, \
-                                      self.atom_type_map_lut_buf, \
-                                      self.maps_buf, \
-
-                                      self.ttl_atom_properties_buf, \
-                                      self.atoms_properties_buf, \
-                                      self.protein_ignore_inter_buf, \
-                                      self.ttl_protein_ignore_inter_buf, \
-
-                                      self.elecs_buf.data, \
-                                      self.emaps_buf.data)
-        self.cl_prg.calc_total_inter_energy(self.cl_queue, \
-                                            (2 * ttl_poses,), None, \
-                                            self.ttl_atoms_buf, \
-                                            self.ttl_poses_buf, \
-                                            self.elecs_buf.data, \
-                                            self.emaps_buf.data, \
-
-                                            self.elec_totals_buf.data, \
-                                            self.emap_totals_buf.data)
+        kernel = self.cl_prg.calc_inter_energy
+        def launch(local_size):
+            return kernel(buffers.cl_queue, (ttl_atoms * ttl_poses,), \
+                          local_size and (local_size,), \
+                          self.lo_grid_buf, \
+                          self.hi_grid_buf, \
+                          self.field_spacing_buf, \
+                          buffers.poses_buf.data, \
+
+                          self.num_points1_buf, \
+                          self.electrostatic_lut_buf, \
+                          self.desolvation_lut_buf, \
+                          self.atom_type_map_lut_buf, \
+                          self.maps_buf, \
+
+                          self.atoms_properties_buf, \
+                          self.protein_ignore_inter_buf, \
+
+                          buffers.elecs_buf.data, \
+                          buffers.emaps_buf.data)
+        launch(self.get_flat_local_size(kernel, ttl_atoms * ttl_poses, launch, \
+                                        buffers.cl_queue))
+        kernel = self.cl_prg.calc_total_inter_energy
+        def launch(local_size):
+            return kernel(buffers.cl_queue, (2 * ttl_poses,), \
+                          local_size and (local_size,), \
+                          buffers.elecs_buf.data, \
+                          buffers.emaps_buf.data, \
+
+                          buffers.elec_totals_buf.data, \
+                          buffers.emap_totals_buf.data)
+        launch(self.get_flat_local_size(kernel, 2 * ttl_poses, launch, \
+                                        buffers.cl_queue))
 
         if DEBUG:
-            self.elec_totals_np = self.elec_totals_buf.get()
+            self.elec_totals_np = buffers.elec_totals_buf.get()
             print self.elec_totals_np
-            self.emap_totals_np = self.emap_totals_buf.get()
+            self.emap_totals_np = buffers.emap_totals_buf.get()
             print self.emap_totals_np
-    
-    def calc_intramolecular_energy(self):
+
+    # Intermolecular energy totals reduced within one work-group per pose
+    # without per-atom energies
+    def calc_intermolecular_energy_totals(self, buffers = None):
         ttl_poses = int(self.ttl_poses_np[0])
-        ttl_non_bond_list = int(self.ttl_non_bond_list_np[0])
-        self.cl_prg.calc_intra_energy(self.cl_queue, \
-                                      (ttl_poses * ttl_non_bond_list,), None, \
-                                      self.ttl_poses_buf, \
-                                      self.poses_buf.data, \
-                                      self.lo_grid_buf, \
-                                      self.hi_grid_buf, \
+        kernel = self.cl_prg.calc_inter_energy_totals
+        float_size = buffers.elec_totals_buf.dtype.itemsize
+        local_bytes = lambda local_size: local_size * 2 * float_size
+        def launch(local_size):
+            return kernel(buffers.cl_queue, \
+                          (ttl_poses * local_size,), (local_size,), \
+                          self.lo_grid_buf, \
+                          self.hi_grid_buf, \
+                          self.field_spacing_buf, \
+                          buffers.poses_buf.data, \
+
+                          self.num_points1_buf, \
+                          self.electrostatic_lut_buf, \
+                          self.desolvation_lut_buf, \
+                          self.atom_type_map_lut_buf, \
+                          self.maps_buf, \
+
+                          self.atoms_properties_buf, \
+                          self.protein_ignore_inter_buf, \
+
+                          cl.LocalMemory(local_bytes(local_size)), \
+
+                          buffers.elec_totals_buf.data, \
+                          buffers.emap_totals_buf.data)
+        launch(self.get_pose_local_size(kernel, int(self.ttl_atoms_np[0]), \
+                                        launch, local_bytes, \
+                                        buffers.cl_queue))
+
+    def calc_intramolecular_energy(self, buffers = None):
+        if buffers.e_internals_buf is None:
+            self.calc_intramolecular_energy_totals(buffers)
+            return
 
-                                      self.ttl_non_bond_list_buf, \
-                                      self.ttl_non_bond_properties_buf, \
-                                      self.non_bond_list_buf, \
+        ttl_poses = int(self.ttl_poses_np[0])
+        ttl_non_bond_list = int(self.ttl_non_bond_list_np[0])
+        kernel = self.cl_prg.calc_intra_energy
+        def launch(local_size):
+            return kernel(buffers.cl_queue, \
+                          (ttl_poses * ttl_non_bond_list,), \
+                          local_size and (local_size,), \
+                          buffers.poses_buf.data, \
+                          self.lo_grid_buf, \
+                          self.hi_grid_buf, \
 
-                                      self.ttl_atom_types_buf, \
-                                      self.bond_properties_buf, \
+                          self.non_bond_list_buf, \
 
-                                      self.calc_inter_elec_e_buf, \
-                                      self.include_1_4_interactions_buf, \
+                          self.bond_properties_buf, \
 
-                                      self.et_inv_r_epsilon_buf, \
-                                      self.et_solvation_buf, \
-                                      self.et_vdw_hb_buf, \
+                          self.et_inv_r_epsilon_buf, \
+                          self.et_solvation_buf, \
+                          self.et_vdw_hb_buf, \
 
-                                      self.e_internals_buf.data)
+                          buffers.e_internals_buf.data)
+        launch(self.get_flat_local_size(kernel, ttl_poses * ttl_non_bond_list, \
+                                        launch, buffers.cl_queue))
 
         if DEBUG:
-            self.e_internals_np = self.e_internals_buf.get()
+            self.e_internals_np = buffers.e_internals_buf.get()
             print self.e_internals_np
 
-        self.cl_prg.calc_total_intra_energy(self.cl_queue, \
-                                            (ttl_poses,), None, \
-                                            self.ttl_poses_buf, \
-                                            self.ttl_non_bond_list_buf, \
-                                            self.e_internals_buf.data, \
+        kernel = self.cl_prg.calc_total_intra_energy
+        def launch(local_size):
+            return kernel(buffers.cl_queue, (ttl_poses,), \
+                          local_size and (local_size,), \
+                          buffers.e_internals_buf.data, \
 
-                                            self.e_internal_totals_buf.data)
+                          buffers.e_internal_totals_buf.data)
+        launch(self.get_flat_local_size(kernel, ttl_poses, launch, \
+                                        buffers.cl_queue))
 
         if DEBUG:
-            self.e_internal_totals_np = self.e_internal_totals_buf.get()
+            self.e_internal_totals_np = buffers.e_internal_totals_buf.get()
             print self.e_internal_totals_np
 
-    def calc_total_energy(self):
+    # Intramolecular energy totals reduced within one work-group per pose
+    # without per-pair energies
+    def calc_intramolecular_energy_totals(self, buffers = None):
+        ttl_poses = int(self.ttl_poses_np[0])
+        kernel = self.cl_prg.calc_intra_energy_totals
+        float_size = buffers.e_internal_totals_buf.dtype.itemsize
+        local_bytes = lambda local_size: local_size * float_size
+        def launch(local_size):
+            return kernel(buffers.cl_queue, \
+                          (ttl_poses * local_size,), (local_size,), \
+                          buffers.poses_buf.data, \
+                          self.lo_grid_buf, \
+                          self.hi_grid_buf, \
+
+                          self.non_bond_list_buf, \
+
+                          self.bond_properties_buf, \
+
+                          self.et_inv_r_epsilon_buf, \
+                          self.et_solvation_buf, \
+                          self.et_vdw_hb_buf, \
+
+                          cl.LocalMemory(local_bytes(local_size)), \
+
+                          buffers.e_internal_totals_buf.data)
+        launch(self.get_pose_local_size(kernel, \
+                                        int(self.ttl_non_bond_list_np[0]), \
+                                        launch, local_bytes, \
+                                        buffers.cl_queue))
+
+    # Total energies of the chunk poses within the population into e_totals
+    def calc_total_energy(self, first_pose = 0, buffers = None):
+        ttl_poses = min(int(self.ttl_poses_np[0]), \
+                        self.ttl_population - first_pose)
+        kernel = self.cl_prg.calc_total_energy
+        def launch(local_size):
+            return kernel(buffers.cl_queue, (ttl_poses,), \
+                          local_size and (local_size,), \
+                          buffers.elec_totals_buf.data, \
+                          buffers.emap_totals_buf.data, \
+                          buffers.e_internal_totals_buf.data, \
+                          np.int64(first_pose), \
+                          self.e_totals_buf.data)
+        launch(self.get_flat_local_size(kernel, ttl_poses, launch, \
+                                        buffers.cl_queue))
+
+    # Local size of a kernel launch over global_size work items, left to the
+    # driver (None) unless the work-group tuner is enabled. launch(local_size)
+    # enqueues the launch for tuning on cl_queue, the docking queue by
+    # default.
+    def get_flat_local_size(self, kernel, global_size, launch, \
+                            cl_queue = None):
+        if not self.workgroup_tuner:
+            return None
+        if cl_queue is None:
+            cl_queue = self.cl_queue
+        candidates = WorkGroupTuner.get_flat_candidates(kernel, \
+                                                        cl_queue.device, \
+                                                        global_size)
+        return self.workgroup_tuner.get_local_size(cl_queue, kernel, \
+                                                   global_size, candidates, \
+                                                   launch)
+
+    # Work-group size of a kernel running one work-group per pose, limited by
+    # the device. With the work-group tuner enabled, the number of work items
+    # sharing the ttl_items atoms or pairs of a pose is tuned instead, using
+    # local_bytes(local_size) bytes of local memory per work-group.
+    def get_pose_local_size(self, kernel, ttl_items = 0, launch = None, \
+                            local_bytes = None, cl_queue = None):
+        if cl_queue is None:
+            cl_queue = self.cl_queue
+        if self.workgroup_tuner and launch is not None:
+            candidates = WorkGroupTuner.get_group_candidates(kernel, \
+                                                             cl_queue.device, \
+                                                             ttl_items, \
+                                                             local_bytes)
+            return self.workgroup_tuner.get_local_size(cl_queue, kernel, \
+                                                       int(self.ttl_poses_np[0]), \
+                                                       candidates, launch)
+        max_local_size = kernel.get_work_group_info( \
+                             cl.kernel_work_group_info.WORK_GROUP_SIZE, \
+                             cl_queue.device)
+        return min(self.pose_local_size, max_local_size)
+
+    # Tuning launch of a kernel moving atoms of poses in place, writing into
+    # scratch poses instead, so that repeating it leaves the poses of the
+    # chunk buffers intact
+    def get_scratch_launch(self, launch, buffers = None):
+        def scratch_launch(local_size):
+            if self.scratch_poses_buf is None:
+                self.scratch_poses_buf = buffers.poses_buf.copy()
+            return launch(local_size, self.scratch_poses_buf)
+        return scratch_launch
+
+    # Set poses from individuals_buf given to reset_poses and calculate their
+    # total energies in a single kernel launch
+    def calc_fused_energy(self):
+        ttl_atoms = int(self.ttl_atoms_np[0])
         ttl_poses = int(self.ttl_poses_np[0])
-        self.cl_prg.calc_total_energy(self.cl_queue, (ttl_poses,), None, \
-                                      self.elec_totals_buf.data, \
-                                      self.emap_totals_buf.data, \
-                                      self.e_internal_totals_buf.data, \
-                                      self.e_totals_buf.data)
+        kernel = self.cl_prg.score_poses
+        real_size = self.ori_atom_tcoords_np.itemsize
+        accum_size = self.e_totals_buf.dtype.itemsize
+        local_bytes = lambda local_size: ((ttl_atoms + 1) * 3 * real_size) + \
+                                         (local_size * 3 * accum_size)
+        def launch(local_size):
+            return kernel(self.cl_queue, \
+                          (ttl_poses * local_size,), (local_size,), \
+                          self.individuals_buf.data, \
+                          self.ori_atom_tcoords_buf, \
+
+                          self.level_starts_buf, \
+                          self.level_atoms_buf, \
+                          self.level_torsions_buf, \
+                          self.torsion_anchors_buf, \
+                          self.torsion_links_buf, \
+
+                          self.lo_grid_buf, \
+                          self.hi_grid_buf, \
+                          self.field_spacing_buf, \
+
+                          self.num_points1_buf, \
+                          self.electrostatic_lut_buf, \
+                          self.desolvation_lut_buf, \
+                          self.atom_type_map_lut_buf, \
+                          self.maps_buf, \
+
+                          self.atoms_properties_buf, \
+                          self.protein_ignore_inter_buf, \
+
+                          self.non_bond_list_buf, \
+
+                          self.bond_properties_buf, \
+
+                          self.et_inv_r_epsilon_buf, \
+                          self.et_solvation_buf, \
+                          self.et_vdw_hb_buf, \
+
+                          cl.LocalMemory((ttl_atoms + 1) * 3 * real_size), \
+                          cl.LocalMemory(local_size * 3 * accum_size), \
+
+                          self.e_totals_buf.data)
+        launch(self.get_pose_local_size(kernel, \
+                                        max(ttl_atoms, \
+                                            int(self.ttl_non_bond_list_np[0])), \
+                                        launch, local_bytes))
 
+        if DEBUG:
+            self.e_totals_np = self.e_totals_buf.get()
+            print self.e_totals_np
+
+    # Set poses from individuals_buf given to reset_poses and calculate their
+    # total energies chunk by chunk. Consecutive chunks alternate between the
+    # buffer sets of the pool, each on its own queue, so that a chunk does not
+    # wait for the previous one to complete. The other queues start once the
+    # individuals are ready on the docking queue, which continues once all
+    # chunks are scored.
     def calc_energy(self):
-        self.calc_intermolecular_energy()
-        self.calc_intramolecular_energy()
-        self.calc_total_energy()
+        if self.scoring == "fused":
+            self.calc_fused_energy()
+            return
+        other_buffers = self.chunk_buffers[1:]
+        if other_buffers:
+            start = cl.enqueue_marker(self.cl_queue)
+            self.cl_queue.flush()
+            for buffers in other_buffers:
+                cl.enqueue_barrier(buffers.cl_queue, wait_for = [start])
+        ttl_poses = int(self.ttl_poses_np[0])
+        for chunk_idx in xrange(self.ttl_chunks):
+            buffers = self.chunk_buffers[chunk_idx % len(self.chunk_buffers)]
+            first_pose = chunk_idx * ttl_poses
+            self.set_poses(first_pose, buffers)
+            self.calc_intermolecular_energy(buffers)
+            self.calc_intramolecular_energy(buffers)
+            self.calc_total_energy(first_pose, buffers)
+        if other_buffers:
+            ends = [cl.enqueue_marker(buffers.cl_queue) \
+                    for buffers in other_buffers]
+            cl.enqueue_barrier(self.cl_queue, wait_for = ends)
+            for buffers in other_buffers:
+                buffers.cl_queue.flush()
 
@@ -20,6 +20,7 @@
 #    http://autodock.scripps.edu
 
 from Axis3 import Axis3
+import numpy as np
 
 class Field:
     def __init__(self, filename = None):
@@ -84,3 +85,20 @@ class Grid:
     def __init__(self):
         self.maps = {}
         self.field = None
+        # Maps flattened (z, y, x order) by map type for vectorized lookup,
+        # and the map arrays they were flattened from. Flattening gives views
+        # of the map arrays, so memory-mapped maps from the map cache are
+        # not copied.
+        self.flat_maps = {}
+        self.flat_map_sources = {}
+
+    # Flatten maps on first use or whenever a map has been added, removed or
+    # replaced
+    def get_flat_maps(self):
+        if len(self.flat_map_sources) != len(self.maps) or \
+           any(self.flat_map_sources.get(type) is not map \
+               for type, map in self.maps.items()):
+            self.flat_map_sources = dict(self.maps)
+            self.flat_maps = dict((type, np.asarray(map, dtype = float).ravel()) \
+                                  for type, map in self.maps.items())
+        return self.flat_maps
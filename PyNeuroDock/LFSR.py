@@ -31,6 +31,7 @@
 # and 2^n are exclusive.
 
 
+import numpy as np
 import Constants as const
 
 class LFSR:
@@ -58,6 +59,51 @@ class LFSR:
         self.lfsr = (self.lfsr >> 1) | (bit << self.bit_len_dec)
         return self.lfsr
 
+    # A register update is affine over GF(2): the new register is the XOR of
+    # a constant and the columns selected by the bits set in the old register.
+    # Returns the columns and the constant of a single generate call.
+    def get_update(self):
+        lfsr = self.lfsr
+        self.lfsr = 0
+        constant = self.generate()
+        columns = []
+        for i in xrange(self.bit_len):
+            self.lfsr = 1 << i
+            columns.append(self.generate() ^ constant)
+        self.lfsr = lfsr
+        return columns, constant
+
+    @staticmethod
+    def apply_update(update, lfsr):
+        columns, value = update
+        for column in columns:
+            if lfsr == 0:
+                break
+            if lfsr & 1:
+                value ^= column
+            lfsr >>= 1
+        return value
+
+    # Update equivalent to applying first and then second
+    @staticmethod
+    def compose_updates(first, second):
+        constant = LFSR.apply_update(second, 0)
+        columns = [LFSR.apply_update(second, column) ^ constant \
+                   for column in first[0]]
+        return columns, LFSR.apply_update(second, first[1])
+
+    # Advances the register as if generate was called steps times, in
+    # logarithmic time by repeatedly squaring the single step update. Used to
+    # split the sequence into non-overlapping streams.
+    def jump(self, steps):
+        update = self.get_update()
+        while steps > 0:
+            if steps & 1:
+                self.lfsr = self.apply_update(update, self.lfsr)
+            steps >>= 1
+            if steps > 0:
+                update = self.compose_updates(update, update)
+
     # This implementation follows genunf function from AutoDock that takes two
     # parameters (low and high) and returns uniform distribution in between
     # them. Note that the low and high boundaries are exclusive. In this case,
@@ -66,6 +112,17 @@ class LFSR:
         # For fixed bit length, the denominator is implemented as constant
         return (self.generate() / self.denominator)
 
+    # Array of zero_to_one numbers of the given shape, filled in row-major
+    # order so that the same numbers are drawn as by repeated zero_to_one
+    # calls
+    def zero_to_one_in_numpy(self, shape):
+        rands = np.empty(shape)
+        flat_rands = rands.reshape(-1)
+        for i in xrange(flat_rands.size):
+            flat_rands[i] = self.generate()
+        rands /= self.denominator
+        return rands
+
     # This implementation follows genunf function from AutoDock that takes two
     # parameters (low and high) and returns uniform distribution in between
     # them. Note that the low and high boundaries are exclusive. In this case,
@@ -24,7 +24,6 @@
 
 from Atom import Atom, Branch
 from Axis3 import Axis3
-from copy import deepcopy
 import numpy as np
 
 class Ligand:
@@ -33,6 +32,9 @@ class Ligand:
         self.ori_atoms = []
         # Modified atom locations for energy calculation
         self.atoms = []
+        # Coordinates of ori_atoms and atoms as (N, 3) arrays
+        self.ori_tcoords = np.zeros((0, 3), dtype = float)
+        self.tcoords = np.zeros((0, 3), dtype = float)
         # All atom types found in this ligand
         self.atom_types = []
         self.branches = []
@@ -105,10 +107,21 @@ class Ligand:
     def write_pdbqt(self, filename):
         pass
 
-    # Reset atoms information (including location) from original atoms
-    # information
+    # Create atoms from original atoms, with coordinates of both stored in
+    # arrays
+    def setup_atoms(self):
+        self.ori_tcoords = Atom.bind_tcoords(self.ori_atoms)
+        self.atoms = [atom.copy() for atom in self.ori_atoms]
+        self.tcoords = Atom.bind_tcoords(self.atoms)
+
+    # Reset atom locations from original atoms. Atoms are created once, after
+    # that only their coordinates are copied.
     def reset_atoms(self):
-        self.atoms = deepcopy(self.ori_atoms)
+        if len(self.atoms) != len(self.ori_atoms) or \
+           len(self.ori_tcoords) != len(self.ori_atoms):
+            self.setup_atoms()
+        else:
+            self.tcoords[:] = self.ori_tcoords
 
     def update_tcoord_model(self, filename):
         self.reset_atoms()
@@ -128,11 +141,7 @@ class Ligand:
         return tcoords
 
     def get_atom_tcoords_in_numpy(self):
-        tcoords = np.array([[0., 0., 0.] for i in xrange(len(self.atoms))], \
-                           dtype = float)
-        for idx, atom in enumerate(self.atoms):
-            tcoords[idx] = atom.tcoord.xyz
-        return tcoords
+        return self.tcoords.copy()
 
     def set_atom_tcoords(self, tcoords):
         for i, tcoord in enumerate(tcoords):
@@ -18,132 +18,249 @@
 # References:
 #  - AutoDock 4.2.3 Source Code (readmap.cc)
 #    http://autodock.scripps.edu
+#  - NumPy memory-mapped file support (numpy.load with mmap_mode)
+#    http://docs.scipy.org/doc/numpy/reference/generated/numpy.load.html
 
+from Axis3 import Axis3
 import numpy as np
 import operator
+import os
+import hashlib
+from CacheFile import make_dirs, write_atomic
+
+class GridMapError(Exception):
+    def __init__(self, msg):
+        Exception.__init__(self, msg)
+        self.msg = msg
+
+# AutoGrid Map Reader
+# -------------------
+# Reads electrostatic, desolvation and atom type maps. The header is parsed by
+# keyword and the map values are converted by NumPy in a single call.
+class GridMapReader:
+    # Total header lines written by AutoGrid
+    HEADER_LEN = 6
+    # Tolerance for comparing spacing and center against grid field
+    TOLERANCE = 1e-6
 
-class ElectrostaticMap:
     def __init__(self, filename = None, field = None):
         self.map = []
+        self.spacing = 0.0
+        self.num_points = Axis3(0, 0, 0)
+        self.center = Axis3(0.0, 0.0, 0.0)
         if filename:
             self.read(filename, field)
 
-    def read(self, filename, field):
-        p_file = open(filename, 'r')
-
-        # Parsing Header
-        # --------------
-        # 1. Grid Parameter File (GPF)
-        #    Example: GRID_PARAMETER_FILE hsg1.gpf
-        p_file.readline()
-        # 2. Grid Data File
-        #    Example: GRID_DATA_FILE hsg1_rigid.maps.fld
-        p_file.readline()
-        # 3. Macromolecule File
-        #    Example: MACROMOLECULE hsg1_rigid.pdbqt
-        p_file.readline()
-        # 4. Spacing
-        #    Example: SPACING 0.375
-        p_file.readline()
-        # 5. Map Size
-        #    Example: NELEMENTS 60 60 60
-        p_file.readline()
-        # 6. Map Center
-        #    Example: CENTER 2.500 6.500 -7.500
-        p_file.readline()
-
-        # Get Map Values
-        # --------------
-        volume = reduce(operator.mul, field.num_points1.xyz)
-        # Axis allocation: map[z][y][x]
-        self.map = (np.array(p_file.read().split('\n')[:volume], \
-                             dtype = float)).reshape(field.num_points1.xyz)
-        p_file.close()
+    # Parsing Header
+    # --------------
+    # 1. Grid Parameter File (GPF)
+    #    Example: GRID_PARAMETER_FILE hsg1.gpf
+    # 2. Grid Data File
+    #    Example: GRID_DATA_FILE hsg1_rigid.maps.fld
+    # 3. Macromolecule File
+    #    Example: MACROMOLECULE hsg1_rigid.pdbqt
+    # 4. Spacing
+    #    Example: SPACING 0.375
+    # 5. Map Size
+    #    Example: NELEMENTS 60 60 60
+    # 6. Map Center
+    #    Example: CENTER 2.500 6.500 -7.500
+    def read_header(self, p_file, filename = ""):
+        header = {}
+        for i in xrange(self.HEADER_LEN):
+            words = p_file.readline().split()
+            if words:
+                header[words[0]] = words[1:]
+        try:
+            self.spacing = float(header["SPACING"][0])
+            self.num_points.xyz = [int(n) for n in header["NELEMENTS"][:3]]
+            self.center.xyz = [float(c) for c in header["CENTER"][:3]]
+        except (KeyError, IndexError, ValueError):
+            raise GridMapError("Invalid AutoGrid map header in %s" % filename)
 
-    def test_print(self):
-        for i in xrange(-10, -0):
-            print self.map[60][60][i]
+    # Make sure the map is generated for the same grid field
+    def check_field(self, field, filename = ""):
+        if abs(self.spacing - field.spacing) > self.TOLERANCE:
+            raise GridMapError("Spacing of %s (%s) does not match grid field (%s)" % \
+                               (filename, self.spacing, field.spacing))
+        if self.num_points.xyz != field.num_points.xyz:
+            raise GridMapError("Map size of %s (%s) does not match grid field (%s)" % \
+                               (filename, self.num_points.xyz, \
+                                field.num_points.xyz))
+        for map_center, field_center in zip(self.center.xyz, field.center.xyz):
+            if abs(map_center - field_center) > self.TOLERANCE:
+                raise GridMapError("Center of %s (%s) does not match grid field (%s)" % \
+                                   (filename, self.center.xyz, \
+                                    field.center.xyz))
 
-class DesolvationMap:
-    def __init__(self, filename = None, field = None):
-        self.map = []
-        if filename:
-            self.read(filename, field)
+    def read(self, filename, field = None):
+        with open(filename, 'r') as p_file:
+            self.read_header(p_file, filename)
+            if field:
+                self.check_field(field, filename)
+
+            # Get Map Values
+            # --------------
+            # AutoGrid always adds number of elements with one for each
+            # dimension as the center point
+            num_points1 = [n + 1 for n in self.num_points.xyz]
+            volume = reduce(operator.mul, num_points1)
+            try:
+                values = np.fromstring(p_file.read(), dtype = float, \
+                                       count = volume, sep = ' ')
+            except ValueError:
+                raise GridMapError("%s has less than %d map values" % \
+                                   (filename, volume))
 
-    def read(self, filename, field):
-        p_file = open(filename, 'r')
-
-        # Parsing Header
-        # --------------
-        # 1. Grid Parameter File (GPF)
-        #    Example: GRID_PARAMETER_FILE hsg1.gpf
-        p_file.readline()
-        # 2. Grid Data File
-        #    Example: GRID_DATA_FILE hsg1_rigid.maps.fld
-        p_file.readline()
-        # 3. Macromolecule File
-        #    Example: MACROMOLECULE hsg1_rigid.pdbqt
-        p_file.readline()
-        # 4. Spacing
-        #    Example: SPACING 0.375
-        p_file.readline()
-        # 5. Map Size
-        #    Example: NELEMENTS 60 60 60
-        p_file.readline()
-        # 6. Map Center
-        #    Example: CENTER 2.500 6.500 -7.500
-        p_file.readline()
-
-        # Get Map Values
-        # --------------
-        volume = reduce(operator.mul, field.num_points1.xyz)
         # Axis allocation: map[z][y][x]
-        self.map = (np.array(p_file.read().split('\n')[:volume], \
-                             dtype = float)).reshape(field.num_points1.xyz)
-        p_file.close()
+        self.map = values.reshape(num_points1[::-1])
 
     def test_print(self):
         for i in xrange(-10, -0):
             print self.map[60][60][i]
 
-class AtomTypeMap:
-    def __init__(self, filename = None, field = None):
-        self.map = []
-        if filename:
-            self.read(filename, field)
+class ElectrostaticMap(GridMapReader):
+    pass
 
-    def read(self, filename, field):
-        p_file = open(filename, 'r')
-
-        # Parsing Header
-        # --------------
-        # 1. Grid Parameter File (GPF)
-        #    Example: GRID_PARAMETER_FILE hsg1.gpf
-        p_file.readline()
-        # 2. Grid Data File
-        #    Example: GRID_DATA_FILE hsg1_rigid.maps.fld
-        p_file.readline()
-        # 3. Macromolecule File
-        #    Example: MACROMOLECULE hsg1_rigid.pdbqt
-        p_file.readline()
-        # 4. Spacing
-        #    Example: SPACING 0.375
-        p_file.readline()
-        # 5. Map Size
-        #    Example: NELEMENTS 60 60 60
-        p_file.readline()
-        # 6. Map Center
-        #    Example: CENTER 2.500 6.500 -7.500
-        p_file.readline()
-
-        # Get Map Values
-        # --------------
-        volume = reduce(operator.mul, field.num_points1.xyz)
-        # Axis allocation: map[z][y][x]
-        self.map = (np.array(p_file.read().split('\n')[:volume], \
-                             dtype = float)).reshape(field.num_points1.xyz)
-        p_file.close()
+class DesolvationMap(GridMapReader):
+    pass
 
-    def test_print(self):
-        for i in xrange(-10, -0):
-            print self.map[60][60][i]
+class AtomTypeMap(GridMapReader):
+    pass
+
+# Binary Map Cache
+# ----------------
+# Parsing ASCII AutoGrid maps dominates startup of short docking jobs. The
+# cache converts each map once into a binary NumPy array file and memory-maps
+# it on later runs. As the mapping is read-only, concurrent processes docking
+# against the same receptor share the same physical pages.
+#
+# Each cached map consists of two files inside the cache directory:
+#  - <map name>.<path digest>.npy: map values in binary
+#  - <map name>.<path digest>.key: source path, size, modification time,
+#    content hash and map shape of the source map, and spacing, size and
+#    center from its header
+# A cached map is reused directly when path, size and modification time match.
+# Otherwise, the content hash decides whether the source has to be re-parsed.
+# Cached maps are checked against the grid field from their header as parsed
+# maps are.
+class MapCache:
+    DEFAULT_DIR = "./Maps/Cache"
+    HASH_BLOCK_SIZE = 1 << 20
+
+    def __init__(self, cache_dir = DEFAULT_DIR):
+        self.cache_dir = cache_dir
+        # Cache statistics
+        self.hits = 0
+        self.misses = 0
+
+    def get_cache_filenames(self, filename):
+        path = os.path.abspath(filename)
+        digest = hashlib.sha1(path).hexdigest()[:16]
+        basename = "%s.%s" % (os.path.basename(filename), digest)
+        basename = os.path.join(self.cache_dir, basename)
+        return basename + ".npy", basename + ".key"
+
+    @staticmethod
+    def calc_content_hash(filename):
+        content_hash = hashlib.sha1()
+        with open(filename, 'rb') as p_file:
+            while True:
+                block = p_file.read(MapCache.HASH_BLOCK_SIZE)
+                if not block:
+                    break
+                content_hash.update(block)
+        return content_hash.hexdigest()
+
+    # Key format (one item per line): path, size, mtime, content hash, shape,
+    # spacing, number of elements, center
+    @staticmethod
+    def read_key(key_filename):
+        try:
+            with open(key_filename, 'r') as p_file:
+                lines = p_file.read().split('\n')
+            return {'path': lines[0], \
+                    'size': int(lines[1]), \
+                    'mtime': float(lines[2]), \
+                    'hash': lines[3], \
+                    'shape': tuple(int(i) for i in lines[4].split()), \
+                    'spacing': float(lines[5]), \
+                    'num_points': [int(i) for i in lines[6].split()], \
+                    'center': [float(c) for c in lines[7].split()]}
+        except (IOError, IndexError, ValueError):
+            return None
+
+    def write_key(self, key_filename, key):
+        def write_func(p_file):
+            p_file.write("%s\n%d\n%r\n%s\n%s\n%r\n%s\n%s\n" % \
+                         (key['path'], key['size'], key['mtime'], \
+                          key['hash'], " ".join(str(i) for i in key['shape']), \
+                          key['spacing'], \
+                          " ".join(str(i) for i in key['num_points']), \
+                          " ".join(repr(c) for c in key['center'])))
+        write_atomic(key_filename, write_func, 'w')
+
+    def write_map(self, npy_filename, map):
+        def write_func(p_file):
+            np.save(p_file, np.ascontiguousarray(map, dtype = float))
+        write_atomic(npy_filename, write_func)
+
+    @staticmethod
+    def load_map(npy_filename):
+        # Return plain ndarray view of the read-only memory-mapped file to
+        # avoid memmap subclass overhead on element access
+        return np.asarray(np.load(npy_filename, mmap_mode = 'r'))
+
+    # Check header of a cached map against the grid field the same way as
+    # map_class does when parsing
+    @staticmethod
+    def check_field(key, filename, field, map_class):
+        reader = map_class()
+        reader.spacing = key['spacing']
+        reader.num_points.xyz = key['num_points']
+        reader.center.xyz = key['center']
+        reader.check_field(field, filename)
+
+    # Return map values of filename parsed by map_class (GridMapReader or its
+    # subclasses)
+    def read(self, filename, field, map_class):
+        make_dirs(self.cache_dir)
+        npy_filename, key_filename = self.get_cache_filenames(filename)
+        stat = os.stat(filename)
+        path = os.path.abspath(filename)
+        shape = tuple(field.num_points1.xyz[::-1])
+        key = self.read_key(key_filename)
+        cached = key is not None and key['shape'] == shape and \
+                 os.path.exists(npy_filename)
+
+        # Fast path: unchanged path, size and modification time
+        if cached and key['path'] == path and key['size'] == stat.st_size and \
+           key['mtime'] == stat.st_mtime:
+            self.check_field(key, filename, field, map_class)
+            self.hits += 1
+            return self.load_map(npy_filename)
+
+        # Source has been touched or moved. Reuse the binary if the content is
+        # still the same.
+        content_hash = self.calc_content_hash(filename)
+        new_key = {'path': path, \
+                   'size': stat.st_size, \
+                   'mtime': stat.st_mtime, \
+                   'hash': content_hash, \
+                   'shape': shape}
+        if cached and key['hash'] == content_hash:
+            self.check_field(key, filename, field, map_class)
+            self.hits += 1
+            for name in ('spacing', 'num_points', 'center'):
+                new_key[name] = key[name]
+            self.write_key(key_filename, new_key)
+            return self.load_map(npy_filename)
+
+        self.misses += 1
+        reader = map_class(filename, field)
+        new_key['spacing'] = reader.spacing
+        new_key['num_points'] = reader.num_points.xyz
+        new_key['center'] = reader.center.xyz
+        self.write_map(npy_filename, reader.map)
+        self.write_key(key_filename, new_key)
+        return self.load_map(npy_filename)
@@ -23,15 +23,23 @@
 
 import sys
 import getopt
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from Grid import Field
 from Dock import Dock, DockOpenCL
-from Map import ElectrostaticMap, DesolvationMap, AtomTypeMap
+from Map import ElectrostaticMap, DesolvationMap, AtomTypeMap, MapCache, \
+                GridMapError
+from ProgramCache import ProgramCache
+from WorkGroupTuner import WorkGroupTuner
 from Axis3 import Axis3
 import Optimization
 
 class NeuroDock:
-    def __init__(self, docking_parameter_file = None):
+    def __init__(self, docking_parameter_file = None, \
+                 retune_workgroups = False):
         self.docking_parameter_file = docking_parameter_file
+        # Tune work-group sizes again instead of reusing the profile
+        self.retune_workgroups = retune_workgroups
         self.dock = None
         self.optimization = None
         self.accelerator = ""
@@ -43,6 +51,39 @@ class NeuroDock:
         self.desolvation_map_file = ""
         self.ligand_file = ""
         self.protein_file = ""
+        # Binary grid map cache (disabled by default)
+        self.map_cache = None
+        # OpenCL program binary cache (disabled by default)
+        self.program_cache = None
+        # Maps waiting to be loaded concurrently. List of map filename, map
+        # type and map reader class.
+        self.pending_maps = []
+
+    # Read grid map either directly from AutoGrid map file or through binary
+    # map cache if enabled
+    def read_map(self, filename, map_class):
+        if self.map_cache:
+            return self.map_cache.read(filename, self.dock.grid.field, \
+                                       map_class)
+        return map_class(filename, self.dock.grid.field).map
+
+    # Load all pending maps concurrently
+    def load_maps(self):
+        if not self.pending_maps:
+            return
+        def read_pending_map(pending_map):
+            filename, type, map_class = pending_map
+            return self.read_map(filename, map_class)
+
+        pool = ThreadPool(min(len(self.pending_maps), cpu_count()))
+        try:
+            maps = pool.map(read_pending_map, self.pending_maps)
+        finally:
+            pool.close()
+            pool.join()
+        for (filename, type, map_class), map in zip(self.pending_maps, maps):
+            self.dock.grid.maps[type] = map
+        self.pending_maps = []
 
     def run(self):
         with open(self.docking_parameter_file, 'r') as p_file:
@@ -68,15 +109,26 @@ class NeuroDock:
                     filename = line.split()[1]
                     type = filename.split('.')[1]
                     self.atom_type_map_files[type] = "./Maps/" + filename
-                    self.dock.grid.maps[type] = AtomTypeMap(self.atom_type_map_files[type], self.dock.grid.field).map
+                    self.pending_maps.append((self.atom_type_map_files[type], \
+                                              type, AtomTypeMap))
 
                 if line.startswith("elecmap"):
                     self.electrostatic_map_file = "./Maps/" + line.split()[1]
-                    self.dock.grid.maps['e'] = ElectrostaticMap(self.electrostatic_map_file, self.dock.grid.field).map
+                    self.pending_maps.append((self.electrostatic_map_file, \
+                                              'e', ElectrostaticMap))
 
                 if line.startswith("desolvmap"):
                     self.desolvation_map_file = "./Maps/" + line.split()[1]
-                    self.dock.grid.maps['d'] = DesolvationMap(self.desolvation_map_file, self.dock.grid.field).map
+                    self.pending_maps.append((self.desolvation_map_file, \
+                                              'd', DesolvationMap))
+
+                # Binary grid map cache. Has to be defined before any map.
+                if line.startswith("cache_maps"):
+                    words = line.split('#')[0].split()
+                    if len(words) > 1:
+                        self.map_cache = MapCache(words[1])
+                    else:
+                        self.map_cache = MapCache()
 
                 # Set movable molecule (ligand)
                 if line.startswith("move"):
@@ -126,13 +178,20 @@ class NeuroDock:
                         if self.accelerator == "sequential":
                             self.optimization = \
                                 Optimization.GeneticAlgorithm(self.dock)
-                        if self.accelerator == "opencl":
+                        if self.accelerator == "opencl" and \
+                           self.cl_device_type == "all":
+                            self.optimization = \
+                                Optimization.GeneticAlgorithmMultiDevice(self.dock, \
+                                                                         self.program_cache)
+                        elif self.accelerator == "opencl":
                             self.optimization = \
                                 Optimization.GeneticAlgorithmOpenCL(self.dock, \
-                                                                    self.cl_device_type)
+                                                                    self.cl_device_type, \
+                                                                    self.program_cache)
 
                 # Run optimization
                 if line.startswith("opt_run"):
+                    self.load_maps()
                     self.optimization.run()
 
                 #------------------------------------ Opt: Genetic Algorithm ---
@@ -146,6 +205,14 @@ class NeuroDock:
                         self.optimization.population_size = int(value)
                     if type == "num_generations":
                         self.optimization.num_gen = int(value)
+                    if type == "num_workers":
+                        self.optimization.num_workers = int(value)
+                    # Size of the device elite archive (OpenCL)
+                    if type == "elite_size":
+                        self.optimization.elite_size = int(value)
+                    # Communities run together on the device (OpenCL)
+                    if type == "batch_size":
+                        self.optimization.batch_size = int(value)
 
                 #----------------------------------------------- Accelerator ---
                 # Define parallel processing accelerator
@@ -160,18 +227,78 @@ class NeuroDock:
                 if line.startswith("ocl_device_type"):
                     self.cl_device_type = line.split()[1]
 
+                # Define OpenCL scoring pipeline (multi, fused)
+                if line.startswith("ocl_scoring"):
+                    if self.accelerator == "opencl":
+                        self.dock.scoring = line.split()[1]
+
+                # OpenCL program binary cache. Has to be defined before the
+                # optimization.
+                if line.startswith("cache_programs"):
+                    words = line.split('#')[0].split()
+                    if len(words) > 1:
+                        self.program_cache = ProgramCache(words[1])
+                    else:
+                        self.program_cache = ProgramCache()
+                    if self.accelerator == "opencl":
+                        self.dock.program_cache = self.program_cache
+
+                # OpenCL work-group size tuning with the tuned sizes kept in a
+                # profile. Has to be defined before the optimization runs.
+                if line.startswith("ocl_autotune"):
+                    words = line.split('#')[0].split()
+                    if len(words) > 1:
+                        profile_filename = words[1]
+                    else:
+                        profile_filename = WorkGroupTuner.DEFAULT_PROFILE
+                    if self.accelerator == "opencl":
+                        self.dock.workgroup_tuner = \
+                            WorkGroupTuner(profile_filename, \
+                                           self.retune_workgroups)
+
+                # Storage of maps on the OpenCL device (buffer, image) and
+                # image sampling (linear, nearest)
+                if line.startswith("ocl_map_storage"):
+                    words = line.split('#')[0].split()
+                    if self.accelerator == "opencl":
+                        self.dock.map_storage = words[1]
+                        if len(words) > 2:
+                            self.dock.map_filter_linear = words[2] == "linear"
+
+                # Floating-point precision of the OpenCL kernels (fp64, fp32,
+                # mixed)
+                if line.startswith("ocl_precision"):
+                    if self.accelerator == "opencl":
+                        self.dock.precision = line.split('#')[0].split()[1]
+
+                # Largest number of poses scored at a time on the OpenCL
+                # device, or 0 for as many as the device memory holds
+                if line.startswith("ocl_chunk_poses"):
+                    if self.accelerator == "opencl":
+                        self.dock.max_chunk_poses = \
+                            int(line.split('#')[0].split()[1])
+
+                # Keep per-atom and per-pair energies on the OpenCL device
+                if line.startswith("ocl_energy_decomposition"):
+                    if self.accelerator == "opencl":
+                        self.dock.energy_decomposition = True
+
+            # Maps defined without running any optimization
+            self.load_maps()
+
 class Usage(Exception):
     def __init__(self, msg):
         self.msg = msg
 
 def main(argv = None):
     docking_parameter_file = ""         # docking parameter file
+    retune_workgroups = False           # ignore tuned work-group sizes
 
     if argv is None:
         argv = sys.argv
     try:
         try:
-            opts, args = getopt.getopt(argv[1:], "hp:", ["help"])
+            opts, args = getopt.getopt(argv[1:], "hp:r", ["help", "retune"])
         except getopt.error, msg:
             raise Usage(msg)
 
@@ -179,13 +306,17 @@ def main(argv = None):
             if o in ("-h", "--help"):
                 print "To run, execute: " + \
                       "python NeuroDock.py -p docking_parameter_file.dpf"
+                print "To tune OpenCL work-group sizes again (ocl_autotune), " + \
+                      "add -r or --retune"
                 sys.exit(0)
             if o in ("-p"):
                 docking_parameter_file = a
+            if o in ("-r", "--retune"):
+                retune_workgroups = True
 
         if docking_parameter_file == "":
             docking_parameter_file = "./Parameters/ind.dpf"
-        neuroDock = NeuroDock(docking_parameter_file)
+        neuroDock = NeuroDock(docking_parameter_file, retune_workgroups)
         neuroDock.run()
 
     except Usage, err:
@@ -193,6 +324,10 @@ def main(argv = None):
         print >>sys.stderr, "for help use --help"
         return 2
 
+    except GridMapError, err:
+        print >>sys.stderr, err.msg
+        return 2
+
 if __name__ == "__main__":
     sys.exit(main())
 
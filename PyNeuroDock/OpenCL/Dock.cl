@@ -19,7 +19,34 @@
 // - Converting a Triangular Matrix to an Array
 //   http://jamesmccaffrey.wordpress.com/2010/05/14/converting-a-triangular-matrix-to-an-array/
 
+// Floating-point precision is chosen at build time (-D PRECISION):
+//  - PRECISION_FP64: everything in double
+//  - PRECISION_FP32: everything in float
+//  - PRECISION_MIXED: geometry, maps and energy tables in float (real_t)
+//    while energies are accumulated in double (accum_t)
+// Without fp64, the program is built with -cl-single-precision-constant so
+// that literals do not promote float arithmetic to double.
+#define PRECISION_FP64  0
+#define PRECISION_FP32  1
+#define PRECISION_MIXED 2
+
+#if PRECISION != PRECISION_FP32
 #pragma OPENCL EXTENSION cl_khr_fp64 : enable
+#endif
+
+#if PRECISION == PRECISION_FP64
+typedef double real_t;
+typedef double3 real3_t;
+#else
+typedef float real_t;
+typedef float3 real3_t;
+#endif
+
+#if PRECISION == PRECISION_FP32
+typedef float accum_t;
+#else
+typedef double accum_t;
+#endif
 
 //TODO: Add few characters in front of definition names to act like namespace
 // Geometry index
@@ -48,238 +75,170 @@
 #define NBC2_IDX                    4
 #define SCALE_1_4_INTERACTIONS_IDX  5
 
+// Sizes and flags of the docked molecules and the population are defined at
+// build time (-D options), so that loops over them have constant bounds:
+//  - TTL_POPULATION, TTL_POSES, TTL_ATOMS, TTL_LIGAND_ATOMS, TTL_TORSIONS,
+//    TTL_LEVELS
+//  - TTL_MAPS, TTL_ATOM_TYPES, TTL_ATOM_PROPERTIES, TTL_PROTEIN_IGNORE_INTER
+//  - TTL_NON_BOND_LIST, TTL_NON_BOND_PROPERTIES
+//  - CALC_INTER_ELEC_E, INCLUDE_1_4_INTERACTIONS (0 or 1)
+//  - MAP_IMAGE (0 or 1), and with images MAP_FILTER_LINEAR (0 or 1) and
+//    MAP_SLAB_DEPTH
+//  - PRECISION (see above)
+// Poses are scored in chunks of TTL_POSES out of the TTL_POPULATION
+// individuals, starting from individual first_pose. Pose buffers and energy
+// totals hold a chunk while individuals and e_totals hold the population.
+// The last chunk may run beyond the population.
 
-__kernel void rotate_branches(__global const long *ttl_torsions,
-                              __global const double *individuals,
+// Map storage. Maps are either interleaved in a buffer of real_t, TTL_MAPS
+// values per grid point, or stored in a 3D image of RGBA float texels, each
+// holding a grid point of 4 maps. Groups of 4 maps are stacked along the
+// image depth in slabs of MAP_SLAB_DEPTH grid points.
+#if MAP_IMAGE
+#define MAPS_T __read_only image3d_t
+#else
+#define MAPS_T __global const real_t *
+#endif
 
-                              __global const long *longest_branch,
-                              __global const long *branches_rot_anchor_buf,
-                              __global const long *branches_rot_link_buf,
-                              __global const long *branches_rot_size_buf,
-                              __global const long *branches_rot_seq_buf,
-
-                              __global const long *ttl_poses,
-                              __global double *poses)
+// Rotate tcoord by a normalized quaternion rotation (a, b, c, d)
+void rotate_tcoord(const real_t *rotation, const real_t *tcoord,
+                   real_t *new_tcoord)
 {
-    // Thread ID (Pose ID or individual ID)
-    long pose_id = get_global_id(0);
-    // Branch rotation, i axis or torsion index
-    for (long br_i = 0; br_i < ttl_torsions[0]; br_i++) {
-        for (long br_j = 0; br_j < longest_branch[0]; br_j++) {
-            // If atom ID equals 0, skip the conversion
-            long atom_tcoord_id = branches_rot_seq_buf[(br_i * longest_branch[0]) +
-                                                       br_j];
-            if (atom_tcoord_id == 0) continue;
-            // Torsion angle
-            double tor_angle = individuals[(pose_id * (3 + 4 + ttl_torsions[0])) +
-                                           TORSION_START_IDX + br_i];
-            // Torsion axis
-            double anchor_tcoord[3];
-            double link_tcoord[3];
-            double3 tor_axis;
-            long anchor_tcoord_id = branches_rot_anchor_buf[br_i];
-            long link_tcoord_id =  branches_rot_link_buf[br_i];
-            for (long i = 0; i < 3; i++) {
-                anchor_tcoord[i] = poses[(anchor_tcoord_id * ttl_poses[0] * 3) +
-                                         (pose_id * 3) + i];
-                link_tcoord[i] = poses[(link_tcoord_id * ttl_poses[0] * 3) +
-                                       (pose_id * 3) + i];
-                tor_axis[i] = anchor_tcoord[i] - link_tcoord[i];
-            }
-            // Rotation in quaternion
-            double rotation[4];
-            double half_tor_angle = tor_angle / 2;
-            rotation[0] = cos(half_tor_angle);
-            tor_axis = normalize(tor_axis);
-            double s = sin(half_tor_angle);
-            rotation[1] = tor_axis[0] * s;
-            rotation[2] = tor_axis[1] * s;
-            rotation[3] = tor_axis[2] * s;
-            // Transform
-            double atom_tcoord[3];
-            for (long i = 0; i < 3; i++) {
-                atom_tcoord[i] = poses[(atom_tcoord_id * ttl_poses[0] * 3) +
-                                       (pose_id * 3) + i] -
-                link_tcoord[i];
-            }
-            double a = rotation[0];
-            double b = rotation[1];
-            double c = rotation[2];
-            double d = rotation[3];
-
-            double db = b + b;
-            double dc = c + c;
-            double dd = d + d;
-
-            double a_db = a * db;
-            double a_dc = a * dc;
-            double a_dd = a * dd;
-
-            double b_db_i = 1.0 - (b * db);
-
-            double c_db = c * db;
-            double c_dc = c * dc;
-            double c_dc_i = 1.0 - c_dc;
-
-            double d_db = d * db;
-            double d_dc = d * dc;
-            double d_dd = d * dd;
-
-            double r_xx = c_dc_i - d_dd;
-            double r_xy = c_db   + a_dd;
-            double r_xz = d_db   - a_dc;
-            double r_yx = c_db   - a_dd;
-            double r_yy = b_db_i - d_dd;
-            double r_yz = d_dc   + a_db;
-            double r_zx = d_db   + a_dc;
-            double r_zy = d_dc   - a_db;
-            double r_zz = b_db_i - c_dc;
-
-            double new_atom_tcoord[3];
-            new_atom_tcoord[0] =  atom_tcoord[0] * r_xx;
-            new_atom_tcoord[0] += atom_tcoord[1] * r_xy;
-            new_atom_tcoord[0] += atom_tcoord[2] * r_xz;
-
-            new_atom_tcoord[1] =  atom_tcoord[0] * r_yx;
-            new_atom_tcoord[1] += atom_tcoord[1] * r_yy;
-            new_atom_tcoord[1] += atom_tcoord[2] * r_yz;
-
-            new_atom_tcoord[2] =  atom_tcoord[0] * r_zx;
-            new_atom_tcoord[2] += atom_tcoord[1] * r_zy;
-            new_atom_tcoord[2] += atom_tcoord[2] * r_zz;
+    real_t a = rotation[0];
+    real_t b = rotation[1];
+    real_t c = rotation[2];
+    real_t d = rotation[3];
 
-            for (long i = 0; i < 3; i++) {
-                poses[(atom_tcoord_id * ttl_poses[0] * 3) + (pose_id * 3) + i] =
-                new_atom_tcoord[i] + link_tcoord[i];
-            }
-        }
-        barrier(CLK_LOCAL_MEM_FENCE | CLK_GLOBAL_MEM_FENCE);
-    }
+    real_t db = b + b;
+    real_t dc = c + c;
+    real_t dd = d + d;
+
+    real_t a_db = a * db;
+    real_t a_dc = a * dc;
+    real_t a_dd = a * dd;
+
+    real_t b_db_i = 1.0 - (b * db);
+
+    real_t c_db = c * db;
+    real_t c_dc = c * dc;
+    real_t c_dc_i = 1.0 - c_dc;
+
+    real_t d_db = d * db;
+    real_t d_dc = d * dc;
+    real_t d_dd = d * dd;
+
+    real_t r_xx = c_dc_i - d_dd;
+    real_t r_xy = c_db   + a_dd;
+    real_t r_xz = d_db   - a_dc;
+    real_t r_yx = c_db   - a_dd;
+    real_t r_yy = b_db_i - d_dd;
+    real_t r_yz = d_dc   + a_db;
+    real_t r_zx = d_db   + a_dc;
+    real_t r_zy = d_dc   - a_db;
+    real_t r_zz = b_db_i - c_dc;
+
+    new_tcoord[0] =  tcoord[0] * r_xx;
+    new_tcoord[0] += tcoord[1] * r_xy;
+    new_tcoord[0] += tcoord[2] * r_xz;
+
+    new_tcoord[1] =  tcoord[0] * r_yx;
+    new_tcoord[1] += tcoord[1] * r_yy;
+    new_tcoord[1] += tcoord[2] * r_yz;
+
+    new_tcoord[2] =  tcoord[0] * r_zx;
+    new_tcoord[2] += tcoord[1] * r_zy;
+    new_tcoord[2] += tcoord[2] * r_zz;
 }
 
-__kernel void transform_ligand_root(__global const long *ttl_ligand_atoms,
-                                    __global const double *individuals,
-                                    __global const long *ttl_torsions,
-                                    __global const long *ttl_poses,
-                                    __global double *poses)
+// Rotation in quaternion of tor_angle around the axis from link to anchor
+void get_torsion_rotation(real_t tor_angle,
+                          const real_t *anchor_tcoord,
+                          const real_t *link_tcoord,
+                          real_t *rotation)
 {
-    long thread_id = get_global_id(0);
-    // Atom ID starts from index 1
-    long atom_id = (thread_id / ttl_poses[0]) + 1;
-    // Pose ID or individual ID
-    long pose_id = thread_id % ttl_poses[0];
-    // Translation
-    double translation[3];
+    real3_t tor_axis;
     for (long i = 0; i < 3; i++) {
-        translation[i] = individuals[(pose_id * (3 + 4 + ttl_torsions[0])) +
-                                     TRANSLATION_START_IDX + i];
+        tor_axis[i] = anchor_tcoord[i] - link_tcoord[i];
     }
-    // Rotation
-    double rotation[4];
-    for (long i = 0; i < 4; i++) {
-        rotation[i] = individuals[(pose_id * (3 + 4 + ttl_torsions[0])) +
-                                  ROTATION_START_IDX + i];
-    }
-    // Atom coordinate
-    double atom_tcoord[3];
-    for (long i = 0; i < 3; i++) {
-        atom_tcoord[i] = poses[(atom_id * ttl_poses[0] * 3) +
-                               (pose_id * 3) + i];
-    }
-    // Transform
-    double a = rotation[0];
-    double b = rotation[1];
-    double c = rotation[2];
-    double d = rotation[3];
-
-    double db = b + b;
-    double dc = c + c;
-    double dd = d + d;
-
-    double a_db = a * db;
-    double a_dc = a * dc;
-    double a_dd = a * dd;
-
-    double b_db_i = 1.0 - (b * db);
-
-    double c_db = c * db;
-    double c_dc = c * dc;
-    double c_dc_i = 1.0 - c_dc;
-
-    double d_db = d * db;
-    double d_dc = d * dc;
-    double d_dd = d * dd;
-
-    double r_xx = c_dc_i - d_dd;
-    double r_xy = c_db   + a_dd;
-    double r_xz = d_db   - a_dc;
-    double r_yx = c_db   - a_dd;
-    double r_yy = b_db_i - d_dd;
-    double r_yz = d_dc   + a_db;
-    double r_zx = d_db   + a_dc;
-    double r_zy = d_dc   - a_db;
-    double r_zz = b_db_i - c_dc;
-
-    double new_atom_tcoord[3];
-    new_atom_tcoord[0] =  atom_tcoord[0] * r_xx;
-    new_atom_tcoord[0] += atom_tcoord[1] * r_xy;
-    new_atom_tcoord[0] += atom_tcoord[2] * r_xz;
-
-    new_atom_tcoord[1] =  atom_tcoord[0] * r_yx;
-    new_atom_tcoord[1] += atom_tcoord[1] * r_yy;
-    new_atom_tcoord[1] += atom_tcoord[2] * r_yz;
-
-    new_atom_tcoord[2] =  atom_tcoord[0] * r_zx;
-    new_atom_tcoord[2] += atom_tcoord[1] * r_zy;
-    new_atom_tcoord[2] += atom_tcoord[2] * r_zz;
+    real_t half_tor_angle = tor_angle / 2;
+    rotation[0] = cos(half_tor_angle);
+    tor_axis = normalize(tor_axis);
+    real_t s = sin(half_tor_angle);
+    rotation[1] = tor_axis[0] * s;
+    rotation[2] = tor_axis[1] * s;
+    rotation[3] = tor_axis[2] * s;
+}
 
-    for (long i = 0; i < 3; i++) {
-        poses[(atom_id * ttl_poses[0] * 3) + (pose_id * 3) + i] =
-            new_atom_tcoord[i] + translation[i];
+#if MAP_IMAGE
+float get_map_channel(float4 texel, long map_idx)
+{
+    float channels[4];
+    vstore4(texel, 0, channels);
+    return channels[map_idx % 4];
+}
+
+#if MAP_FILTER_LINEAR
+// Value of a map at grid position (u, v, w), interpolated by the sampler
+// between the texel centers. The grid position is given with the fractions
+// of u and w swapped (see calc_atom_inter_energy).
+real_t sample_map(MAPS_T maps, long map_idx, real_t u, real_t v, real_t w)
+{
+    const sampler_t sampler = CLK_NORMALIZED_COORDS_FALSE |
+                              CLK_ADDRESS_CLAMP_TO_EDGE |
+                              CLK_FILTER_LINEAR;
+    real_t slab_w = w + (real_t)((map_idx / 4) * MAP_SLAB_DEPTH);
+    float4 coord = (float4)((float)(u + 0.5), (float)(v + 0.5),
+                            (float)(slab_w + 0.5), 0.0f);
+    return (real_t)get_map_channel(read_imagef(maps, sampler, coord), map_idx);
+}
+#else
+// Value of a map interpolated from the 8 grid points around it, with the
+// same corner weights as the buffer storage, which pair the u fractions with
+// the w corners and the w fractions with the u corners
+real_t sample_map(MAPS_T maps, long map_idx,
+                  long u0, long v0, long w0,
+                  real_t p0u, real_t p0v, real_t p0w,
+                  real_t p1u, real_t p1v, real_t p1w)
+{
+    const sampler_t sampler = CLK_NORMALIZED_COORDS_FALSE |
+                              CLK_ADDRESS_CLAMP_TO_EDGE |
+                              CLK_FILTER_NEAREST;
+    long slab_w0 = w0 + ((map_idx / 4) * MAP_SLAB_DEPTH);
+    real_t value = 0.0;
+    for (int i = 0; i < 8; i++) {
+        int du = i & 1;
+        int dv = (i >> 1) & 1;
+        int dw = (i >> 2) & 1;
+        real_t weight = (dw ? p0u : p1u) * (dv ? p0v : p1v) * (du ? p0w : p1w);
+        int4 coord = (int4)((int)u0 + du, (int)v0 + dv, (int)slab_w0 + dw, 0);
+        value += weight *
+                 (real_t)get_map_channel(read_imagef(maps, sampler, coord),
+                                         map_idx);
     }
+    return value;
 }
+#endif
+#endif
 
-__kernel void calc_inter_energy(__global const long *ttl_poses,
-                                __global const double *lo_grid,
-                                __global const double *hi_grid,
-                                __global const double *field_spacing,
-                                __global const double *poses,
+// Electrostatic (elec) and atom type map plus desolvation (emap) energies of
+// an atom at atom_tcoord. Both are infinity when the atom is out of grid.
+void calc_atom_inter_energy(const real_t *atom_tcoord,
+                            long atom_type_id,
+                            real_t atom_charge,
 
-                                __global const long *num_points1,
-                                __global const long *ttl_maps,
-                                __global const long *electrostatic_lut,
-                                __global const long *desolvation_lut,
-                                __global const long *atom_type_map_lut,
-                                __global const double *maps,
+                            __global const real_t *lo_grid,
+                            __global const real_t *hi_grid,
+                            __global const real_t *field_spacing,
 
-                                __global const long *ttl_atom_properties,
-                                __global const double *atoms_properties,
-                                __global const long *protein_ignore_inter,
-                                __global const long *ttl_protein_ignore_inter,
+                            __global const long *num_points1,
+                            __global const long *electrostatic_lut,
+                            __global const long *desolvation_lut,
+                            __global const long *atom_type_map_lut,
+                            MAPS_T maps,
 
-                                __global double *elecs,
-                                __global double *emaps)
+                            real_t *elec,
+                            real_t *emap)
 {
-    long thread_id = get_global_id(0);
-    // Atom ID starts from index 1
-    long atom_id = (thread_id / ttl_poses[0]) + 1;
-    // Pose ID or individual ID
-    long pose_id = thread_id % ttl_poses[0];
-    // Exclude the atom and the first atom branching out of root from
-    // intermolecular energy calculation
-    for (long i = 0; i < ttl_protein_ignore_inter[0]; i++) {
-        if (atom_id == protein_ignore_inter[i]) {
-            elecs[(atom_id * ttl_poses[0]) + pose_id] = 0.0;
-            emaps[(atom_id * ttl_poses[0]) + pose_id] = 0.0;
-            return;
-        }
-    }
-    // Atom coordinate
-    double atom_tcoord[3];
-    for (long i = 0; i < 3; i++) {
-        atom_tcoord[i] = poses[(atom_id * ttl_poses[0] * 3) +
-                               (pose_id * 3) + i];
-    }
     // Check out of grid
     if (atom_tcoord[0] <= lo_grid[0] ||
         atom_tcoord[1] <= lo_grid[1] ||
@@ -288,15 +247,30 @@ __kernel void calc_inter_energy(__global const long *ttl_poses,
         atom_tcoord[1] >= hi_grid[1] ||
         atom_tcoord[2] >= hi_grid[2]) {
 
-        elecs[(atom_id * ttl_poses[0]) + pose_id] = INFINITY;
-        emaps[(atom_id * ttl_poses[0]) + pose_id] = INFINITY;
+        *elec = INFINITY;
+        *emap = INFINITY;
         return;
     }
     // 3D Linear Interpolation
-    double u = (atom_tcoord[0] - lo_grid[0]) / field_spacing[0];
-    double v = (atom_tcoord[1] - lo_grid[1]) / field_spacing[0];
-    double w = (atom_tcoord[2] - lo_grid[2]) / field_spacing[0];
+    real_t u = (atom_tcoord[0] - lo_grid[0]) / field_spacing[0];
+    real_t v = (atom_tcoord[1] - lo_grid[1]) / field_spacing[0];
+    real_t w = (atom_tcoord[2] - lo_grid[2]) / field_spacing[0];
 
+    // Energy calculation
+    real_t e = 0.0; // Electrostatic
+    real_t d = 0.0; // Desolvation
+    real_t m = 0.0; // Aton type
+
+#if MAP_IMAGE && MAP_FILTER_LINEAR
+    // Corner weights of the buffer storage pair the u fractions with the w
+    // corners and the w fractions with the u corners, which the sampler does
+    // when the fractions are swapped
+    real_t sample_u = floor(u) + (w - floor(w));
+    real_t sample_w = floor(w) + (u - floor(u));
+    e = sample_map(maps, electrostatic_lut[0], sample_u, v, sample_w);
+    d = sample_map(maps, desolvation_lut[0], sample_u, v, sample_w);
+    m = sample_map(maps, atom_type_map_lut[atom_type_id], sample_u, v, sample_w);
+#else
     long u0 = (long)u;
     long v0 = (long)v;
     long w0 = (long)w;
@@ -305,162 +279,103 @@ __kernel void calc_inter_energy(__global const long *ttl_poses,
     long v1 = v0 + 1;
     long w1 = w0 + 1;
 
-    double p0u = u - (double)u0;
-    double p0v = v - (double)v0;
-    double p0w = w - (double)w0;
-
-    double p1u = (double)u1 - u;
-    double p1v = (double)v1 - v;
-    double p1w = (double)w1 - w;
-
-    double p000 = p0u * p0v * p0w;
-    double p001 = p0u * p0v * p1w;
-    double p010 = p0u * p1v * p0w;
-    double p011 = p0u * p1v * p1w;
-    double p100 = p1u * p0v * p0w;
-    double p101 = p1u * p0v * p1w;
-    double p110 = p1u * p1v * p0w;
-    double p111 = p1u * p1v * p1w;
-    
+    real_t p0u = u - (real_t)u0;
+    real_t p0v = v - (real_t)v0;
+    real_t p0w = w - (real_t)w0;
+
+    real_t p1u = (real_t)u1 - u;
+    real_t p1v = (real_t)v1 - v;
+    real_t p1w = (real_t)w1 - w;
+
+#if MAP_IMAGE
+    e = sample_map(maps, electrostatic_lut[0], u0, v0, w0,
+                   p0u, p0v, p0w, p1u, p1v, p1w);
+    d = sample_map(maps, desolvation_lut[0], u0, v0, w0,
+                   p0u, p0v, p0w, p1u, p1v, p1w);
+    m = sample_map(maps, atom_type_map_lut[atom_type_id], u0, v0, w0,
+                   p0u, p0v, p0w, p1u, p1v, p1w);
+#else
+    real_t p000 = p0u * p0v * p0w;
+    real_t p001 = p0u * p0v * p1w;
+    real_t p010 = p0u * p1v * p0w;
+    real_t p011 = p0u * p1v * p1w;
+    real_t p100 = p1u * p0v * p0w;
+    real_t p101 = p1u * p0v * p1w;
+    real_t p110 = p1u * p1v * p0w;
+    real_t p111 = p1u * p1v * p1w;
+
     // AutoDock uses z, y, x axis order for maps
     long num_points1_2 = num_points1[2] * num_points1[1];
     long num_points1_1 = num_points1[2];
-    // Atom type
-    long atom_type_id = (long)atoms_properties[(atom_id * ttl_atom_properties[0]) +
-                                               ATOM_TYPE_IDX];
-
-    // Energy calculation
-    double e = 0.0; // Electrostatic
-    double d = 0.0; // Desolvation
-    double m = 0.0; // Aton type
 
-    long w1v1u1_idx = ttl_maps[0] *
+    long w1v1u1_idx = TTL_MAPS *
                       ((w1 * num_points1_2) + (v1 * num_points1_1) + u1);
     e += p000 * maps[w1v1u1_idx + electrostatic_lut[0]];
     d += p000 * maps[w1v1u1_idx + desolvation_lut[0]];
     m += p000 * maps[w1v1u1_idx + atom_type_map_lut[atom_type_id]];
-    long w1v1u0_idx = ttl_maps[0] *
+    long w1v1u0_idx = TTL_MAPS *
                       ((w1 * num_points1_2) + (v1 * num_points1_1) + u0);
     e += p001 * maps[w1v1u0_idx + electrostatic_lut[0]];
     d += p001 * maps[w1v1u0_idx + desolvation_lut[0]];
     m += p001 * maps[w1v1u0_idx + atom_type_map_lut[atom_type_id]];
-    long w1v0u1_idx = ttl_maps[0] *
+    long w1v0u1_idx = TTL_MAPS *
                       ((w1 * num_points1_2) + (v0 * num_points1_1) + u1);
     e += p010 * maps[w1v0u1_idx + electrostatic_lut[0]];
     d += p010 * maps[w1v0u1_idx + desolvation_lut[0]];
     m += p010 * maps[w1v0u1_idx + atom_type_map_lut[atom_type_id]];
-    long w1v0u0_idx = ttl_maps[0] *
+    long w1v0u0_idx = TTL_MAPS *
                       ((w1 * num_points1_2) + (v0 * num_points1_1) + u0);
     e += p011 * maps[w1v0u0_idx + electrostatic_lut[0]];
     d += p011 * maps[w1v0u0_idx + desolvation_lut[0]];
     m += p011 * maps[w1v0u0_idx + atom_type_map_lut[atom_type_id]];
-    long w0v1u1_idx = ttl_maps[0] *
+    long w0v1u1_idx = TTL_MAPS *
                       ((w0 * num_points1_2) + (v1 * num_points1_1) + u1);
     e += p100 * maps[w0v1u1_idx + electrostatic_lut[0]];
     d += p100 * maps[w0v1u1_idx + desolvation_lut[0]];
     m += p100 * maps[w0v1u1_idx + atom_type_map_lut[atom_type_id]];
-    long w0v1u0_idx = ttl_maps[0] *
+    long w0v1u0_idx = TTL_MAPS *
                       ((w0 * num_points1_2) + (v1 * num_points1_1) + u0);
     e += p101 * maps[w0v1u0_idx + electrostatic_lut[0]];
     d += p101 * maps[w0v1u0_idx + desolvation_lut[0]];
     m += p101 * maps[w0v1u0_idx + atom_type_map_lut[atom_type_id]];
-    long w0v0u1_idx = ttl_maps[0] *
+    long w0v0u1_idx = TTL_MAPS *
                       ((w0 * num_points1_2) + (v0 * num_points1_1) + u1);
     e += p110 * maps[w0v0u1_idx + electrostatic_lut[0]];
     d += p110 * maps[w0v0u1_idx + desolvation_lut[0]];
     m += p110 * maps[w0v0u1_idx + atom_type_map_lut[atom_type_id]];
-    long w0v0u0_idx = ttl_maps[0] *
+    long w0v0u0_idx = TTL_MAPS *
                       ((w0 * num_points1_2) + (v0 * num_points1_1) + u0);
     e += p111 * maps[w0v0u0_idx + electrostatic_lut[0]];
     d += p111 * maps[w0v0u0_idx + desolvation_lut[0]];
     m += p111 * maps[w0v0u0_idx + atom_type_map_lut[atom_type_id]];
+#endif
+#endif
 
-    double atom_charge = atoms_properties[(atom_id * ttl_atom_properties[0]) +
-                                          ATOM_CHARGE_IDX];
-    double abs_atom_charge = fabs(atom_charge);
+    real_t abs_atom_charge = fabs(atom_charge);
 
-    elecs[(atom_id * ttl_poses[0]) + pose_id] = e * atom_charge;
-    emaps[(atom_id * ttl_poses[0]) + pose_id] = m + (d * abs_atom_charge);
+    *elec = e * atom_charge;
+    *emap = m + (d * abs_atom_charge);
 }
 
-__kernel void calc_total_inter_energy(__global const long *ttl_atoms,
-                                      __global const long *ttl_poses,
-                                      __global const double *elecs,
-                                      __global const double *emaps,
+// Internal energy of a non-bond pair with atoms at atom_tcoord1 and
+// atom_tcoord2. Infinity when either atom is out of grid.
+real_t calc_pair_intra_energy(real3_t atom_tcoord1,
+                              real3_t atom_tcoord2,
+                              long atom_type1,
+                              long atom_type2,
+                              long non_bond_type,
+                              real_t desolv,
+                              real_t q1q2,
 
-                                      __global double *elec_totals,
-                                      __global double *emap_totals)
-{
-    long thread_id = get_global_id(0);
-    // Atom ID starts from index 1
-    long e_id = (thread_id / ttl_poses[0]);
-    // Pose ID or individual ID
-    long pose_id = thread_id % ttl_poses[0];
-    // elec totals
-    if (e_id == 0) {
-        double elec_total = 0.0;
-        for (long i = 1; i < ttl_atoms[0] + 1; i++) {
-            elec_total += elecs[(i * ttl_poses[0]) + pose_id];
-        }
-        elec_totals[pose_id] = elec_total;
-    }
-    // emap totals
-    if (e_id == 1) {
-        double emap_total = 0.0;
-        for (long i = 1; i < ttl_atoms[0] + 1; i++) {
-            emap_total += emaps[(i * ttl_poses[0]) + pose_id];
-        }
-        emap_totals[pose_id] = emap_total;
-    }
-}
+                              __global const real_t *lo_grid,
+                              __global const real_t *hi_grid,
 
-__kernel void calc_intra_energy(__global const long *ttl_poses,
-                                __global const double *poses,
-                                __global const double *lo_grid,
-                                __global const double *hi_grid,
+                              __global const real_t *bond_properties,
 
-                                __global const long *ttl_non_bond_list,
-                                __global const long *ttl_non_bond_properties,
-                                __global const double *non_bond_list,
-
-                                __global const long *ttl_atom_types,
-                                __global const double *bond_properties,
-
-                                __global const long *calc_inter_elec_e,
-                                __global const long *include_1_4_interactions,
-
-                                __global const double *et_inv_r_epsilon,
-                                __global const double *et_solvation,
-                                __global const double *et_vdw_hb,
-                                
-                                __global double *e_internals)
+                              __global const real_t *et_inv_r_epsilon,
+                              __global const real_t *et_solvation,
+                              __global const real_t *et_vdw_hb)
 {
-    long thread_id = get_global_id(0);
-    // Pose ID or individual ID
-    long pose_id = (thread_id / ttl_non_bond_list[0]);
-    // Non-bond list ID
-    long nb_id = thread_id % ttl_non_bond_list[0];
-    // Get non-bond properties
-    long non_bond_start_idx = nb_id * ttl_non_bond_properties[0];
-    long atom_id1 = non_bond_list[non_bond_start_idx + ATOM_ID1_IDX];
-    long atom_type1 = non_bond_list[non_bond_start_idx + ATOM_TYPE1_IDX];
-    long atom_id2 = non_bond_list[non_bond_start_idx + ATOM_ID2_IDX];
-    long atom_type2 = non_bond_list[non_bond_start_idx + ATOM_TYPE2_IDX];
-    long non_bond_type = non_bond_list[non_bond_start_idx + NON_BOND_TYPE_IDX];
-    double desolv = non_bond_list[non_bond_start_idx + DESOLV_IDX];
-    double q1q2 = non_bond_list[non_bond_start_idx + Q1Q2_IDX];
-
-    // Atom coordinate
-    double3 atom_tcoord1;
-    for (long i = 0; i < 3; i++) {
-        atom_tcoord1[i] = poses[(atom_id1 * ttl_poses[0] * 3) +
-                                (pose_id * 3) + i];
-    }
-    double3 atom_tcoord2;
-    for (long i = 0; i < 3; i++) {
-        atom_tcoord2[i] = poses[(atom_id2 * ttl_poses[0] * 3) +
-                                (pose_id * 3) + i];
-    }
     // Check out of grid
     if (atom_tcoord1[0] <= lo_grid[0] ||
         atom_tcoord1[1] <= lo_grid[1] ||
@@ -475,12 +390,11 @@ __kernel void calc_intra_energy(__global const long *ttl_poses,
         atom_tcoord2[1] >= hi_grid[1] ||
         atom_tcoord2[2] >= hi_grid[2]) {
 
-        e_internals[(pose_id * ttl_non_bond_list[0]) + nb_id] = INFINITY;
-        return;
+        return INFINITY;
     }
     // Calculate distance square
-    double3 r_tcoord2 = atom_tcoord1 - atom_tcoord2;
-    double r2 = (r_tcoord2[0] * r_tcoord2[0]) +
+    real3_t r_tcoord2 = atom_tcoord1 - atom_tcoord2;
+    real_t r2 = (r_tcoord2[0] * r_tcoord2[0]) +
                 (r_tcoord2[1] * r_tcoord2[1]) +
                 (r_tcoord2[2] * r_tcoord2[2]);
     r2 = max(bond_properties[RMIN_ELEC2_IDX], r2);  // Clamp r2 at RMIN_ELEC2
@@ -490,14 +404,14 @@ __kernel void calc_intra_energy(__global const long *ttl_poses,
     long i_ns_intl = min(index, (long)bond_properties[NS_INTL_1_IDX]);
     long i_ns_el = min(index, (long)bond_properties[NS_EL_1_IDX]);
 
-    double e_internal = 0.0;
-    if (calc_inter_elec_e[0] == 1) {
+    real_t e_internal = 0.0;
+    if (CALC_INTER_ELEC_E == 1) {
         // Calculate Electrostatic Energy
         e_internal += q1q2 * et_inv_r_epsilon[i_ns_el];
     }
     if (r2 < bond_properties[NBC2_IDX]) {
         // Calculate Desolvation Energy
-        double e_desolv = desolv * et_solvation[i_ns_intl];
+        real_t e_desolv = desolv * et_solvation[i_ns_intl];
         // Calculate Van der Waals and Hydrogen Bond Energies
         long a1 = atom_type1;
         long a2 = atom_type2;
@@ -505,46 +419,628 @@ __kernel void calc_intra_energy(__global const long *ttl_poses,
             a1 = atom_type2;
             a2 = atom_type1;
         }
-        long n = ttl_atom_types[0];
+        long n = TTL_ATOM_TYPES;
         long col = (n * a1) + a2 - ((a1 * (a1 + 1)) / 2);
         long ns_intl = (long)bond_properties[NS_INTL_1_IDX] + 1;
-        if (include_1_4_interactions[0] == 1 && non_bond_type == 4) {
+        if (INCLUDE_1_4_INTERACTIONS == 1 && non_bond_type == 4) {
             e_internal += bond_properties[SCALE_1_4_INTERACTIONS_IDX] +
                           (et_vdw_hb[(col * ns_intl) + i_ns_intl] + e_desolv);
         } else {
             e_internal += et_vdw_hb[(col * ns_intl) + i_ns_intl] + e_desolv;
         }
     }
-    e_internals[(pose_id * ttl_non_bond_list[0]) + nb_id] = e_internal;
+    return e_internal;
 }
 
-__kernel void calc_total_intra_energy(__global const long *ttl_poses,
-                                      __global const long *ttl_non_bond_list,
-                                      __global const double *e_internals,
+// Whether the atom is excluded from intermolecular energy calculation, being
+// the flexible residue atom bonded to the rigid receptor or the first atom
+// branching out of it
+bool is_inter_ignored(long atom_id,
+                      __global const long *protein_ignore_inter)
+{
+    for (long i = 0; i < TTL_PROTEIN_IGNORE_INTER; i++) {
+        if (atom_id == protein_ignore_inter[i]) {
+            return true;
+        }
+    }
+    return false;
+}
 
-                                      __global double *e_internal_totals)
+// Tree reduction in local memory of ttl_values sums per work item, stored
+// interleaved by work item. The totals end up in the first ttl_values entries.
+void reduce_in_local(__local accum_t *sums, long ttl_values)
+{
+    long local_id = get_local_id(0);
+    barrier(CLK_LOCAL_MEM_FENCE);
+    for (long size = get_local_size(0); size > 1; size = (size + 1) / 2) {
+        long offset = (size + 1) / 2;
+        if (local_id < size - offset) {
+            for (long i = 0; i < ttl_values; i++) {
+                sums[(local_id * ttl_values) + i] +=
+                    sums[((local_id + offset) * ttl_values) + i];
+            }
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+    }
+}
+
+// Coordinates of an atom in a pose under construction. Poses are built from
+// the single reference copy of atom coordinates, which an atom keeps until
+// the first step that moves it.
+void get_pose_tcoord(long atom_id, long pose_id, bool moved,
+                     __global const real_t *ori_atom_tcoords,
+                     __global const real_t *poses,
+                     real_t *tcoord)
+{
+    for (long i = 0; i < 3; i++) {
+        if (moved) {
+            tcoord[i] = poses[(atom_id * TTL_POSES * 3) + (pose_id * 3) + i];
+        } else {
+            tcoord[i] = ori_atom_tcoords[(atom_id * 3) + i];
+        }
+    }
+}
+
+// Set all atoms of all poses to their reference coordinates. Atoms no step
+// moves, such as flexible residue atoms outside of any branch, keep them.
+__kernel void init_poses(__global const real_t *ori_atom_tcoords,
+                         __global real_t *poses)
+{
+    long thread_id = get_global_id(0);
+    // Atom ID starts from index 0 (not in use)
+    long atom_id = thread_id / TTL_POSES;
+    // Pose ID or individual ID
+    long pose_id = thread_id % TTL_POSES;
+    for (long i = 0; i < 3; i++) {
+        poses[(atom_id * TTL_POSES * 3) + (pose_id * 3) + i] =
+            ori_atom_tcoords[(atom_id * 3) + i];
+    }
+}
+
+// Rotate all atoms of one torsion tree level. Branches of the same level do
+// not move each other's atoms, so each thread rotates one atom of one pose.
+// Atoms whose first rotating level (atom_levels) is below this level have
+// been moved already.
+__kernel void rotate_branches(__global const real_t *individuals,
+                              __global const real_t *ori_atom_tcoords,
+                              __global const long *atom_levels,
+                              long level,
+                              long first_pose,
+
+                              __global const long *torsion_anchors,
+                              __global const long *torsion_links,
+                              __global const long *level_atoms,
+                              __global const long *level_torsions,
+
+                              __global real_t *poses)
+{
+    long thread_id = get_global_id(0);
+    // Pose ID or individual ID
+    long pose_id = thread_id % TTL_POSES;
+    // Entry in this level
+    long level_idx = thread_id / TTL_POSES;
+    if (first_pose + pose_id >= TTL_POPULATION) return;
+    long atom_tcoord_id = level_atoms[level_idx];
+    // Branch rotation, i axis or torsion index
+    long br_i = level_torsions[level_idx];
+    // Torsion angle
+    real_t tor_angle = individuals[((first_pose + pose_id) *
+                                    (3 + 4 + TTL_TORSIONS)) +
+                                   TORSION_START_IDX + br_i];
+    // Torsion axis
+    real_t anchor_tcoord[3];
+    real_t link_tcoord[3];
+    long anchor_tcoord_id = torsion_anchors[br_i];
+    long link_tcoord_id = torsion_links[br_i];
+    get_pose_tcoord(anchor_tcoord_id, pose_id,
+                    atom_levels[anchor_tcoord_id] < level,
+                    ori_atom_tcoords, poses, anchor_tcoord);
+    get_pose_tcoord(link_tcoord_id, pose_id,
+                    atom_levels[link_tcoord_id] < level,
+                    ori_atom_tcoords, poses, link_tcoord);
+    // Rotation in quaternion
+    real_t rotation[4];
+    get_torsion_rotation(tor_angle, anchor_tcoord, link_tcoord, rotation);
+    // Transform
+    real_t atom_tcoord[3];
+    get_pose_tcoord(atom_tcoord_id, pose_id,
+                    atom_levels[atom_tcoord_id] < level,
+                    ori_atom_tcoords, poses, atom_tcoord);
+    for (long i = 0; i < 3; i++) {
+        atom_tcoord[i] -= link_tcoord[i];
+    }
+    real_t new_atom_tcoord[3];
+    rotate_tcoord(rotation, atom_tcoord, new_atom_tcoord);
+
+    for (long i = 0; i < 3; i++) {
+        poses[(atom_tcoord_id * TTL_POSES * 3) + (pose_id * 3) + i] =
+        new_atom_tcoord[i] + link_tcoord[i];
+    }
+}
+
+// Atoms of ligand branches have been moved by rotate_branches, the others
+// are transformed from their reference coordinates
+__kernel void transform_ligand_root(__global const real_t *individuals,
+                                    __global const real_t *ori_atom_tcoords,
+                                    __global const long *atom_levels,
+                                    long first_pose,
+                                    __global real_t *poses)
+{
+    long thread_id = get_global_id(0);
+    // Atom ID starts from index 1
+    long atom_id = (thread_id / TTL_POSES) + 1;
+    // Pose ID or individual ID
+    long pose_id = thread_id % TTL_POSES;
+    if (first_pose + pose_id >= TTL_POPULATION) return;
+    // Translation
+    real_t translation[3];
+    for (long i = 0; i < 3; i++) {
+        translation[i] = individuals[((first_pose + pose_id) *
+                                      (3 + 4 + TTL_TORSIONS)) +
+                                     TRANSLATION_START_IDX + i];
+    }
+    // Rotation
+    real_t rotation[4];
+    for (long i = 0; i < 4; i++) {
+        rotation[i] = individuals[((first_pose + pose_id) *
+                                   (3 + 4 + TTL_TORSIONS)) +
+                                  ROTATION_START_IDX + i];
+    }
+    // Atom coordinate
+    real_t atom_tcoord[3];
+    get_pose_tcoord(atom_id, pose_id, atom_levels[atom_id] < TTL_LEVELS,
+                    ori_atom_tcoords, poses, atom_tcoord);
+    // Transform
+    real_t new_atom_tcoord[3];
+    rotate_tcoord(rotation, atom_tcoord, new_atom_tcoord);
+
+    for (long i = 0; i < 3; i++) {
+        poses[(atom_id * TTL_POSES * 3) + (pose_id * 3) + i] =
+            new_atom_tcoord[i] + translation[i];
+    }
+}
+
+__kernel void calc_inter_energy(__global const real_t *lo_grid,
+                                __global const real_t *hi_grid,
+                                __global const real_t *field_spacing,
+                                __global const real_t *poses,
+
+                                __global const long *num_points1,
+                                __global const long *electrostatic_lut,
+                                __global const long *desolvation_lut,
+                                __global const long *atom_type_map_lut,
+                                MAPS_T maps,
+
+                                __global const real_t *atoms_properties,
+                                __global const long *protein_ignore_inter,
+
+                                __global real_t *elecs,
+                                __global real_t *emaps)
+{
+    long thread_id = get_global_id(0);
+    // Atom ID starts from index 1
+    long atom_id = (thread_id / TTL_POSES) + 1;
+    // Pose ID or individual ID
+    long pose_id = thread_id % TTL_POSES;
+    // Exclude the atom and the first atom branching out of root from
+    // intermolecular energy calculation
+    if (is_inter_ignored(atom_id, protein_ignore_inter)) {
+        elecs[(atom_id * TTL_POSES) + pose_id] = 0.0;
+        emaps[(atom_id * TTL_POSES) + pose_id] = 0.0;
+        return;
+    }
+    // Atom coordinate
+    real_t atom_tcoord[3];
+    for (long i = 0; i < 3; i++) {
+        atom_tcoord[i] = poses[(atom_id * TTL_POSES * 3) +
+                               (pose_id * 3) + i];
+    }
+    // Atom type and charge
+    long atom_type_id = (long)atoms_properties[(atom_id * TTL_ATOM_PROPERTIES) +
+                                               ATOM_TYPE_IDX];
+    real_t atom_charge = atoms_properties[(atom_id * TTL_ATOM_PROPERTIES) +
+                                          ATOM_CHARGE_IDX];
+    real_t elec, emap;
+    calc_atom_inter_energy(atom_tcoord, atom_type_id, atom_charge,
+                           lo_grid, hi_grid, field_spacing,
+                           num_points1, electrostatic_lut,
+                           desolvation_lut, atom_type_map_lut, maps,
+                           &elec, &emap);
+    elecs[(atom_id * TTL_POSES) + pose_id] = elec;
+    emaps[(atom_id * TTL_POSES) + pose_id] = emap;
+}
+
+__kernel void calc_total_inter_energy(__global const real_t *elecs,
+                                      __global const real_t *emaps,
+
+                                      __global accum_t *elec_totals,
+                                      __global accum_t *emap_totals)
+{
+    long thread_id = get_global_id(0);
+    // Atom ID starts from index 1
+    long e_id = (thread_id / TTL_POSES);
+    // Pose ID or individual ID
+    long pose_id = thread_id % TTL_POSES;
+    // elec totals
+    if (e_id == 0) {
+        accum_t elec_total = 0.0;
+        for (long i = 1; i < TTL_ATOMS + 1; i++) {
+            elec_total += elecs[(i * TTL_POSES) + pose_id];
+        }
+        elec_totals[pose_id] = elec_total;
+    }
+    // emap totals
+    if (e_id == 1) {
+        accum_t emap_total = 0.0;
+        for (long i = 1; i < TTL_ATOMS + 1; i++) {
+            emap_total += emaps[(i * TTL_POSES) + pose_id];
+        }
+        emap_totals[pose_id] = emap_total;
+    }
+}
+
+// Intermolecular energy totals without per-atom energies. One work-group per
+// pose, each work item sums some of its atoms and the sums are reduced in
+// local memory holding 2 values per work item.
+__kernel void calc_inter_energy_totals(__global const real_t *lo_grid,
+                                       __global const real_t *hi_grid,
+                                       __global const real_t *field_spacing,
+                                       __global const real_t *poses,
+
+                                       __global const long *num_points1,
+                                       __global const long *electrostatic_lut,
+                                       __global const long *desolvation_lut,
+                                       __global const long *atom_type_map_lut,
+                                       MAPS_T maps,
+
+                                       __global const real_t *atoms_properties,
+                                       __global const long *protein_ignore_inter,
+
+                                       __local accum_t *sums,
+
+                                       __global accum_t *elec_totals,
+                                       __global accum_t *emap_totals)
+{
+    // Pose ID or individual ID
+    long pose_id = get_group_id(0);
+    long local_id = get_local_id(0);
+    long local_size = get_local_size(0);
+
+    accum_t elec_total = 0.0;
+    accum_t emap_total = 0.0;
+    // Atom ID starts from index 1
+    for (long atom_id = local_id + 1; atom_id < TTL_ATOMS + 1;
+         atom_id += local_size) {
+        if (is_inter_ignored(atom_id, protein_ignore_inter)) continue;
+
+        real_t atom_tcoord[3];
+        for (long i = 0; i < 3; i++) {
+            atom_tcoord[i] = poses[(atom_id * TTL_POSES * 3) +
+                                   (pose_id * 3) + i];
+        }
+        long atom_type_id = (long)atoms_properties[(atom_id * TTL_ATOM_PROPERTIES) +
+                                                   ATOM_TYPE_IDX];
+        real_t atom_charge = atoms_properties[(atom_id * TTL_ATOM_PROPERTIES) +
+                                              ATOM_CHARGE_IDX];
+        real_t elec, emap;
+        calc_atom_inter_energy(atom_tcoord, atom_type_id, atom_charge,
+                               lo_grid, hi_grid, field_spacing,
+                               num_points1, electrostatic_lut,
+                               desolvation_lut, atom_type_map_lut, maps,
+                               &elec, &emap);
+        elec_total += elec;
+        emap_total += emap;
+    }
+
+    sums[(local_id * 2) + 0] = elec_total;
+    sums[(local_id * 2) + 1] = emap_total;
+    reduce_in_local(sums, 2);
+    if (local_id == 0) {
+        elec_totals[pose_id] = sums[0];
+        emap_totals[pose_id] = sums[1];
+    }
+}
+
+__kernel void calc_intra_energy(__global const real_t *poses,
+                                __global const real_t *lo_grid,
+                                __global const real_t *hi_grid,
+
+                                __global const real_t *non_bond_list,
+
+                                __global const real_t *bond_properties,
+
+                                __global const real_t *et_inv_r_epsilon,
+                                __global const real_t *et_solvation,
+                                __global const real_t *et_vdw_hb,
+                                
+                                __global real_t *e_internals)
+{
+    long thread_id = get_global_id(0);
+    // Pose ID or individual ID
+    long pose_id = (thread_id / TTL_NON_BOND_LIST);
+    // Non-bond list ID
+    long nb_id = thread_id % TTL_NON_BOND_LIST;
+    // Get non-bond properties
+    long non_bond_start_idx = nb_id * TTL_NON_BOND_PROPERTIES;
+    long atom_id1 = non_bond_list[non_bond_start_idx + ATOM_ID1_IDX];
+    long atom_type1 = non_bond_list[non_bond_start_idx + ATOM_TYPE1_IDX];
+    long atom_id2 = non_bond_list[non_bond_start_idx + ATOM_ID2_IDX];
+    long atom_type2 = non_bond_list[non_bond_start_idx + ATOM_TYPE2_IDX];
+    long non_bond_type = non_bond_list[non_bond_start_idx + NON_BOND_TYPE_IDX];
+    real_t desolv = non_bond_list[non_bond_start_idx + DESOLV_IDX];
+    real_t q1q2 = non_bond_list[non_bond_start_idx + Q1Q2_IDX];
+
+    // Atom coordinate
+    real3_t atom_tcoord1;
+    for (long i = 0; i < 3; i++) {
+        atom_tcoord1[i] = poses[(atom_id1 * TTL_POSES * 3) +
+                                (pose_id * 3) + i];
+    }
+    real3_t atom_tcoord2;
+    for (long i = 0; i < 3; i++) {
+        atom_tcoord2[i] = poses[(atom_id2 * TTL_POSES * 3) +
+                                (pose_id * 3) + i];
+    }
+    e_internals[(pose_id * TTL_NON_BOND_LIST) + nb_id] =
+        calc_pair_intra_energy(atom_tcoord1, atom_tcoord2,
+                               atom_type1, atom_type2, non_bond_type,
+                               desolv, q1q2,
+                               lo_grid, hi_grid,
+                               bond_properties,
+                               et_inv_r_epsilon, et_solvation, et_vdw_hb);
+}
+
+__kernel void calc_total_intra_energy(__global const real_t *e_internals,
+
+                                      __global accum_t *e_internal_totals)
 {
     // Pose ID or individual ID
     long pose_id = get_global_id(0);
 
     // Internal energy totals
-    double total_e_internal = 0.0;
-    for (long i = 0; i < ttl_non_bond_list[0]; i++) {
-        total_e_internal += e_internals[(pose_id * ttl_non_bond_list[0]) + i];
+    accum_t total_e_internal = 0.0;
+    for (long i = 0; i < TTL_NON_BOND_LIST; i++) {
+        total_e_internal += e_internals[(pose_id * TTL_NON_BOND_LIST) + i];
     }
     e_internal_totals[pose_id] = total_e_internal;
 }
 
-__kernel void calc_total_energy(__global const double *elec_totals,
-                                __global const double *emap_totals,
-                                __global const double *e_internal_totals,
+// Intramolecular energy totals without per-pair energies. One work-group per
+// pose, each work item sums some of the non-bond pairs and the sums are
+// reduced in local memory holding 1 value per work item.
+__kernel void calc_intra_energy_totals(__global const real_t *poses,
+                                       __global const real_t *lo_grid,
+                                       __global const real_t *hi_grid,
+
+                                       __global const real_t *non_bond_list,
+
+                                       __global const real_t *bond_properties,
 
-                                __global double *e_totals)
+                                       __global const real_t *et_inv_r_epsilon,
+                                       __global const real_t *et_solvation,
+                                       __global const real_t *et_vdw_hb,
+
+                                       __local accum_t *sums,
+
+                                       __global accum_t *e_internal_totals)
 {
     // Pose ID or individual ID
+    long pose_id = get_group_id(0);
+    long local_id = get_local_id(0);
+    long local_size = get_local_size(0);
+
+    accum_t e_internal_total = 0.0;
+    for (long nb_id = local_id; nb_id < TTL_NON_BOND_LIST;
+         nb_id += local_size) {
+        long non_bond_start_idx = nb_id * TTL_NON_BOND_PROPERTIES;
+        long atom_id1 = non_bond_list[non_bond_start_idx + ATOM_ID1_IDX];
+        long atom_id2 = non_bond_list[non_bond_start_idx + ATOM_ID2_IDX];
+        real3_t atom_tcoord1;
+        real3_t atom_tcoord2;
+        for (long i = 0; i < 3; i++) {
+            atom_tcoord1[i] = poses[(atom_id1 * TTL_POSES * 3) +
+                                    (pose_id * 3) + i];
+            atom_tcoord2[i] = poses[(atom_id2 * TTL_POSES * 3) +
+                                    (pose_id * 3) + i];
+        }
+        e_internal_total += calc_pair_intra_energy(
+            atom_tcoord1, atom_tcoord2,
+            non_bond_list[non_bond_start_idx + ATOM_TYPE1_IDX],
+            non_bond_list[non_bond_start_idx + ATOM_TYPE2_IDX],
+            non_bond_list[non_bond_start_idx + NON_BOND_TYPE_IDX],
+            non_bond_list[non_bond_start_idx + DESOLV_IDX],
+            non_bond_list[non_bond_start_idx + Q1Q2_IDX],
+            lo_grid, hi_grid,
+            bond_properties,
+            et_inv_r_epsilon, et_solvation, et_vdw_hb);
+    }
+
+    sums[local_id] = e_internal_total;
+    reduce_in_local(sums, 1);
+    if (local_id == 0) {
+        e_internal_totals[pose_id] = sums[0];
+    }
+}
+
+__kernel void calc_total_energy(__global const accum_t *elec_totals,
+                                __global const accum_t *emap_totals,
+                                __global const accum_t *e_internal_totals,
+                                long first_pose,
+
+                                __global accum_t *e_totals)
+{
+    // Pose ID within the chunk, launched for poses within the population
     long pose_id = get_global_id(0);
-    e_totals[pose_id] = elec_totals[pose_id] +
+    e_totals[first_pose + pose_id] = elec_totals[pose_id] +
                         emap_totals[pose_id] +
                         e_internal_totals[pose_id];
 }
 
+// Fused scoring. One work-group per pose builds the pose coordinates in local
+// memory, evaluates intermolecular and intramolecular energies on them and
+// reduces both into e_totals in a single launch. Local memory holds
+// (ttl_atoms + 1) x 3 coordinates and 3 partial sums per work item.
+__kernel void score_poses(__global const real_t *individuals,
+                          __global const real_t *ori_atom_tcoords,
+
+                          __global const long *level_starts,
+                          __global const long *level_atoms,
+                          __global const long *level_torsions,
+                          __global const long *torsion_anchors,
+                          __global const long *torsion_links,
+
+                          __global const real_t *lo_grid,
+                          __global const real_t *hi_grid,
+                          __global const real_t *field_spacing,
+
+                          __global const long *num_points1,
+                          __global const long *electrostatic_lut,
+                          __global const long *desolvation_lut,
+                          __global const long *atom_type_map_lut,
+                          MAPS_T maps,
+
+                          __global const real_t *atoms_properties,
+                          __global const long *protein_ignore_inter,
+
+                          __global const real_t *non_bond_list,
+
+                          __global const real_t *bond_properties,
+
+                          __global const real_t *et_inv_r_epsilon,
+                          __global const real_t *et_solvation,
+                          __global const real_t *et_vdw_hb,
+
+                          __local real_t *tcoords,
+                          __local accum_t *partials,
+
+                          __global accum_t *e_totals)
+{
+    // Pose ID or individual ID
+    long pose_id = get_group_id(0);
+    long local_id = get_local_id(0);
+    long local_size = get_local_size(0);
+    long dna_start_idx = pose_id * (3 + 4 + TTL_TORSIONS);
+
+    // Original coordinates. Atom ID starts from index 1.
+    for (long i = local_id; i < (TTL_ATOMS + 1) * 3; i += local_size) {
+        tcoords[i] = ori_atom_tcoords[i];
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    // Rotate branches level by level
+    for (long level = 0; level < TTL_LEVELS; level++) {
+        for (long level_idx = level_starts[level] + local_id;
+             level_idx < level_starts[level + 1];
+             level_idx += local_size) {
+            long atom_tcoord_id = level_atoms[level_idx];
+            long br_i = level_torsions[level_idx];
+            real_t tor_angle = individuals[dna_start_idx + TORSION_START_IDX +
+                                           br_i];
+            real_t anchor_tcoord[3];
+            real_t link_tcoord[3];
+            real_t atom_tcoord[3];
+            for (long i = 0; i < 3; i++) {
+                anchor_tcoord[i] = tcoords[(torsion_anchors[br_i] * 3) + i];
+                link_tcoord[i] = tcoords[(torsion_links[br_i] * 3) + i];
+            }
+            real_t rotation[4];
+            get_torsion_rotation(tor_angle, anchor_tcoord, link_tcoord,
+                                 rotation);
+            for (long i = 0; i < 3; i++) {
+                atom_tcoord[i] = tcoords[(atom_tcoord_id * 3) + i] -
+                                 link_tcoord[i];
+            }
+            real_t new_atom_tcoord[3];
+            rotate_tcoord(rotation, atom_tcoord, new_atom_tcoord);
+            for (long i = 0; i < 3; i++) {
+                tcoords[(atom_tcoord_id * 3) + i] = new_atom_tcoord[i] +
+                                                    link_tcoord[i];
+            }
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+    }
+
+    // Transform (translate and rotate) ligand root (whole body)
+    real_t translation[3];
+    real_t rotation[4];
+    for (long i = 0; i < 3; i++) {
+        translation[i] = individuals[dna_start_idx + TRANSLATION_START_IDX + i];
+    }
+    for (long i = 0; i < 4; i++) {
+        rotation[i] = individuals[dna_start_idx + ROTATION_START_IDX + i];
+    }
+    for (long atom_id = local_id + 1; atom_id < TTL_LIGAND_ATOMS + 1;
+         atom_id += local_size) {
+        real_t atom_tcoord[3];
+        real_t new_atom_tcoord[3];
+        for (long i = 0; i < 3; i++) {
+            atom_tcoord[i] = tcoords[(atom_id * 3) + i];
+        }
+        rotate_tcoord(rotation, atom_tcoord, new_atom_tcoord);
+        for (long i = 0; i < 3; i++) {
+            tcoords[(atom_id * 3) + i] = new_atom_tcoord[i] + translation[i];
+        }
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    // Intermolecular energy
+    accum_t elec_total = 0.0;
+    accum_t emap_total = 0.0;
+    for (long atom_id = local_id + 1; atom_id < TTL_ATOMS + 1;
+         atom_id += local_size) {
+        // Exclude the atom and the first atom branching out of root from
+        // intermolecular energy calculation
+        if (is_inter_ignored(atom_id, protein_ignore_inter)) continue;
+
+        real_t atom_tcoord[3];
+        for (long i = 0; i < 3; i++) {
+            atom_tcoord[i] = tcoords[(atom_id * 3) + i];
+        }
+        long atom_type_id = (long)atoms_properties[(atom_id * TTL_ATOM_PROPERTIES) +
+                                                   ATOM_TYPE_IDX];
+        real_t atom_charge = atoms_properties[(atom_id * TTL_ATOM_PROPERTIES) +
+                                              ATOM_CHARGE_IDX];
+        real_t elec, emap;
+        calc_atom_inter_energy(atom_tcoord, atom_type_id, atom_charge,
+                               lo_grid, hi_grid, field_spacing,
+                               num_points1, electrostatic_lut,
+                               desolvation_lut, atom_type_map_lut, maps,
+                               &elec, &emap);
+        elec_total += elec;
+        emap_total += emap;
+    }
+
+    // Intramolecular energy
+    accum_t e_internal_total = 0.0;
+    for (long nb_id = local_id; nb_id < TTL_NON_BOND_LIST;
+         nb_id += local_size) {
+        long non_bond_start_idx = nb_id * TTL_NON_BOND_PROPERTIES;
+        long atom_id1 = non_bond_list[non_bond_start_idx + ATOM_ID1_IDX];
+        long atom_id2 = non_bond_list[non_bond_start_idx + ATOM_ID2_IDX];
+        real3_t atom_tcoord1;
+        real3_t atom_tcoord2;
+        for (long i = 0; i < 3; i++) {
+            atom_tcoord1[i] = tcoords[(atom_id1 * 3) + i];
+            atom_tcoord2[i] = tcoords[(atom_id2 * 3) + i];
+        }
+        e_internal_total += calc_pair_intra_energy(
+            atom_tcoord1, atom_tcoord2,
+            non_bond_list[non_bond_start_idx + ATOM_TYPE1_IDX],
+            non_bond_list[non_bond_start_idx + ATOM_TYPE2_IDX],
+            non_bond_list[non_bond_start_idx + NON_BOND_TYPE_IDX],
+            non_bond_list[non_bond_start_idx + DESOLV_IDX],
+            non_bond_list[non_bond_start_idx + Q1Q2_IDX],
+            lo_grid, hi_grid,
+            bond_properties,
+            et_inv_r_epsilon, et_solvation, et_vdw_hb);
+    }
+
+    // Reduce partial sums of all work items
+    partials[(local_id * 3) + 0] = elec_total;
+    partials[(local_id * 3) + 1] = emap_total;
+    partials[(local_id * 3) + 2] = e_internal_total;
+    reduce_in_local(partials, 3);
+    if (local_id == 0) {
+        e_totals[pose_id] = partials[0] + partials[1] + partials[2];
+    }
+}
@@ -15,10 +15,38 @@
 // Free Software Foundation, Inc.,
 // 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
+// Floating-point precision is chosen at build time (-D PRECISION), as in
+// Dock.cl: genomes are real_t and scores are accum_t
+#define PRECISION_FP64  0
+#define PRECISION_FP32  1
+#define PRECISION_MIXED 2
+
+#if PRECISION != PRECISION_FP32
 #pragma OPENCL EXTENSION cl_khr_fp64 : enable
+#endif
+
+#if PRECISION == PRECISION_FP64
+typedef double real_t;
+#else
+typedef float real_t;
+#endif
+
+#if PRECISION == PRECISION_FP32
+typedef float accum_t;
+#else
+typedef double accum_t;
+#endif
 
 #define DEBUG 0
 
+// Population sizes are defined at build time (-D options): POPULATION_SIZE,
+// DNA_SIZE, TTL_TORSIONS, ELITE_SIZE and PRECISION
+//
+// A batch of communities can run together. Their populations are stacked
+// into a single buffer, community after community, while selection and
+// reproduction only take place within a community. Kernels find the
+// community of a work item from its global (or group) ID.
+
 // Individual
 #define I_TRANS_X_IDX   0
 #define I_TRANS_Y_IDX   1
@@ -29,21 +57,22 @@
 #define I_ROT_D_IDX     6
 #define I_TOR_START_IDX 7
 
-// Population random number
+// Population random number draws
 #define PRN_P1_IDX                  0   // Parent1
 #define PRN_P2_IDX                  1   // Parent2
 #define PRN_MUTATION_CHANCE_IDX     2   // Overall mutation probability
 #define PRN_TRANS_IDX               3   // Translation mutation probability
 #define PRN_ROT_IDX                 4   // Rotation mutation probability
 #define PRN_TOR_START_IDX           5   // Torsion mutation probabilities
-#define PRN_POSE_TRANS_X_IDX        (PRN_TOR_START_IDX + ttl_torsions[0] + 0)
-#define PRN_POSE_TRANS_Y_IDX        (PRN_TOR_START_IDX + ttl_torsions[0] + 1)
-#define PRN_POSE_TRANS_Z_IDX        (PRN_TOR_START_IDX + ttl_torsions[0] + 2)
-#define PRN_POSE_ROT_A_IDX          (PRN_TOR_START_IDX + ttl_torsions[0] + 3)
-#define PRN_POSE_ROT_B_IDX          (PRN_TOR_START_IDX + ttl_torsions[0] + 4)
-#define PRN_POSE_ROT_C_IDX          (PRN_TOR_START_IDX + ttl_torsions[0] + 5)
-#define PRN_POSE_ROT_D_IDX          (PRN_TOR_START_IDX + ttl_torsions[0] + 6)
-#define PRN_POSE_TOR_START_IDX      (PRN_TOR_START_IDX + ttl_torsions[0] + 7)
+#define PRN_POSE_TRANS_X_IDX        (PRN_TOR_START_IDX + TTL_TORSIONS + 0)
+#define PRN_POSE_TRANS_Y_IDX        (PRN_TOR_START_IDX + TTL_TORSIONS + 1)
+#define PRN_POSE_TRANS_Z_IDX        (PRN_TOR_START_IDX + TTL_TORSIONS + 2)
+#define PRN_POSE_ROT_A_IDX          (PRN_TOR_START_IDX + TTL_TORSIONS + 3)
+#define PRN_POSE_ROT_B_IDX          (PRN_TOR_START_IDX + TTL_TORSIONS + 4)
+#define PRN_POSE_ROT_C_IDX          (PRN_TOR_START_IDX + TTL_TORSIONS + 5)
+#define PRN_POSE_ROT_D_IDX          (PRN_TOR_START_IDX + TTL_TORSIONS + 6)
+#define PRN_POSE_TOR_START_IDX      (PRN_TOR_START_IDX + TTL_TORSIONS + 7)
+#define PRN_CROSSOVER_START_IDX     (PRN_POSE_TOR_START_IDX + TTL_TORSIONS)
 
 // Crossover modes
 // Separate probabilities for translation/rotation genes
@@ -51,44 +80,87 @@
 // Combined probability for translation/rotation genes
 #define CM_COMBINE  (long)1
 
-// Construct individuals from previously generated random numbers
-__kernel void construct_individuals(__global const double *lo_grid,
-                                    __global const double *dist_grid,
-                                    __global const long *dna_size,
+// Philox4x32-10 counter-based random number generator (Salmon et al.,
+// "Parallel random numbers: as easy as 1, 2, 3", SC 2011)
+#define PHILOX_M0 0xD2511F53
+#define PHILOX_M1 0xCD9E8D57
+#define PHILOX_W0 0x9E3779B9
+#define PHILOX_W1 0xBB67AE85
 
-                                    __global double *individuals)
+uint4 philox4x32(uint4 counter, uint2 key)
 {
-    // Individual ID
-    long i_id = get_global_id(0);
+    for (int round = 0; round < 10; round++) {
+        uint hi0 = mul_hi((uint)PHILOX_M0, counter.x);
+        uint lo0 = (uint)PHILOX_M0 * counter.x;
+        uint hi1 = mul_hi((uint)PHILOX_M1, counter.z);
+        uint lo1 = (uint)PHILOX_M1 * counter.z;
+        counter = (uint4)(hi1 ^ counter.y ^ key.x, lo1,
+                          hi0 ^ counter.w ^ key.y, lo0);
+        key += (uint2)(PHILOX_W0, PHILOX_W1);
+    }
+    return counter;
+}
+
+// Uniform random number in [0, 1) of the given draw of an individual at a
+// generation step. Random numbers of a community are keyed by its rng_key
+// entry (seed and community), so they do not depend on launch configuration
+// or on the other communities of the batch.
+real_t rng_uniform(__global const uint *rng_key, uint generation,
+                   long c_id, long i_id, long draw)
+{
+    uint4 counter = (uint4)((uint)draw, (uint)i_id, generation, 0);
+    uint4 bits = philox4x32(counter, (uint2)(rng_key[c_id * 2],
+                                             rng_key[(c_id * 2) + 1]));
+#if PRECISION == PRECISION_FP64
+    // 53 random bits
+    ulong mantissa = ((ulong)bits.x << 21) | (bits.y >> 11);
+    return (real_t)mantissa * 0x1.0p-53;
+#else
+    // 24 random bits
+    return (real_t)(bits.x >> 8) * 0x1.0p-24f;
+#endif
+}
+
+// Construct random individuals
+__kernel void construct_individuals(__global const real_t *lo_grid,
+                                    __global const real_t *dist_grid,
+                                    __global const uint *rng_key,
+                                    uint generation,
+
+                                    __global real_t *individuals)
+{
+    // Community and individual IDs
+    long c_id = get_global_id(0) / POPULATION_SIZE;
+    long i_id = get_global_id(0) % POPULATION_SIZE;
     // DNA (gene) ID
-    long st_idx = i_id * dna_size[0];
-    double two_pi = 2 * M_PI;
+    long st_idx = get_global_id(0) * DNA_SIZE;
+    real_t two_pi = 2 * M_PI;
 
     // Translation genes
     individuals[st_idx + I_TRANS_X_IDX] = lo_grid[0] +
-                                          (individuals[st_idx + I_TRANS_X_IDX] * dist_grid[0]);
+                                          (rng_uniform(rng_key, generation, c_id, i_id, I_TRANS_X_IDX) * dist_grid[0]);
     individuals[st_idx + I_TRANS_Y_IDX] = lo_grid[1] +
-                                          (individuals[st_idx + I_TRANS_Y_IDX] * dist_grid[1]);
+                                          (rng_uniform(rng_key, generation, c_id, i_id, I_TRANS_Y_IDX) * dist_grid[1]);
     individuals[st_idx + I_TRANS_Z_IDX] = lo_grid[2] +
-                                          (individuals[st_idx + I_TRANS_Z_IDX] * dist_grid[2]);
+                                          (rng_uniform(rng_key, generation, c_id, i_id, I_TRANS_Z_IDX) * dist_grid[2]);
     // Rotation genes
     // x0 = rng.zero_to_one()
-    double x0 = individuals[st_idx + I_ROT_A_IDX];
+    real_t x0 = rng_uniform(rng_key, generation, c_id, i_id, I_ROT_A_IDX);
     // t1 = rng.zero_to_2pi()
-    double t1 = individuals[st_idx + I_ROT_B_IDX] * two_pi;
+    real_t t1 = rng_uniform(rng_key, generation, c_id, i_id, I_ROT_B_IDX) * two_pi;
     // t2 = rng.zero_to_2pi()
-    double t2 = individuals[st_idx + I_ROT_C_IDX] * two_pi;
-    double r1 = sqrt(1.0 - x0);
-    double r2 = sqrt(x0);
+    real_t t2 = rng_uniform(rng_key, generation, c_id, i_id, I_ROT_C_IDX) * two_pi;
+    real_t r1 = sqrt(1.0 - x0);
+    real_t r2 = sqrt(x0);
     individuals[st_idx + I_ROT_B_IDX] = sin(t1) * r1;
     individuals[st_idx + I_ROT_C_IDX] = cos(t1) * r1;
     individuals[st_idx + I_ROT_D_IDX] = sin(t2) * r2;
     individuals[st_idx + I_ROT_A_IDX] = cos(t2) * r2;
 
     // Torsion genes
-    for (long tor_idx = I_TOR_START_IDX; tor_idx < dna_size[0]; tor_idx++) {
+    for (long tor_idx = I_TOR_START_IDX; tor_idx < DNA_SIZE; tor_idx++) {
         // rng.neg_pi_to_pi()
-        individuals[st_idx + tor_idx] = (individuals[st_idx + tor_idx] - 0.5) *
+        individuals[st_idx + tor_idx] = (rng_uniform(rng_key, generation, c_id, i_id, tor_idx) - 0.5) *
                                         two_pi;
     }
 
@@ -117,7 +189,7 @@ __kernel void construct_individuals(__global const double *lo_grid,
     }
 }
 
-__kernel void calc_chances(__global const double *e_totals,
+__kernel void calc_chances(__global const accum_t *e_totals,
                            __global const long *normalizer,
                            __global const long *max_inherited_prob,
 
@@ -125,7 +197,7 @@ __kernel void calc_chances(__global const double *e_totals,
 {
     // Individual ID
     long i_id = get_global_id(0);
-    double score = e_totals[i_id] / (double)normalizer[0];
+    accum_t score = e_totals[i_id] / (accum_t)normalizer[0];
 
     // To handle different interpretation of Python infinity by different
     // processors.
@@ -139,178 +211,290 @@ __kernel void calc_chances(__global const double *e_totals,
         chances[i_id] = max_inherited_prob[0];
         return;
     }
-    double power = log(score);
+    accum_t power = log(score);
     if ((long)power < max_inherited_prob[0]) {
-        chances[i_id] = (long)((double)max_inherited_prob[0] - power);
+        chances[i_id] = (long)((accum_t)max_inherited_prob[0] - power);
     } else {
         chances[i_id] = 1;
     }
 }
 
-//TODO: Update the new individuals into individials array instead of
-//      new_individuals array
-__kernel void reproduce(__global const long *population_size,
-                        __global const long *chances,
-                        __global const long *ttl_reproduction_rns,
-                        __global const double *reproduction_rns,
+// Inclusive prefix sum of chances into chances_sum, run as one work-group of
+// power of two size per community. Each work item sums a contiguous chunk of
+// chances, the chunk totals are scanned in local memory (up-sweep and
+// down-sweep) and each work item then writes the prefix sums of its chunk.
+__kernel void scan_chances(__global const long *chances,
+
+                           __local long *chunk_sums,
+
+                           __global long *chances_sum)
+{
+    // Community of the work-group
+    long c_id = get_group_id(0);
+    chances += c_id * POPULATION_SIZE;
+    chances_sum += c_id * POPULATION_SIZE;
+    long local_id = get_local_id(0);
+    long local_size = get_local_size(0);
+    long chunk_size = (POPULATION_SIZE + local_size - 1) / local_size;
+    long start_idx = min(local_id * chunk_size, (long)POPULATION_SIZE);
+    long end_idx = min(start_idx + chunk_size, (long)POPULATION_SIZE);
+
+    long chunk_sum = 0;
+    for (long i = start_idx; i < end_idx; i++) {
+        chunk_sum += chances[i];
+    }
+    chunk_sums[local_id] = chunk_sum;
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    // Up-sweep
+    for (long offset = 1; offset < local_size; offset *= 2) {
+        long i = ((local_id + 1) * offset * 2) - 1;
+        if (i < local_size) {
+            chunk_sums[i] += chunk_sums[i - offset];
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+    }
+    // Down-sweep into exclusive prefix sums of the chunk totals
+    if (local_id == 0) {
+        chunk_sums[local_size - 1] = 0;
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+    for (long offset = local_size / 2; offset > 0; offset /= 2) {
+        long i = ((local_id + 1) * offset * 2) - 1;
+        if (i < local_size) {
+            long left_sum = chunk_sums[i - offset];
+            chunk_sums[i - offset] = chunk_sums[i];
+            chunk_sums[i] += left_sum;
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+    }
+
+    chunk_sum = chunk_sums[local_id];
+    for (long i = start_idx; i < end_idx; i++) {
+        chunk_sum += chances[i];
+        chances_sum[i] = chunk_sum;
+    }
+}
+
+// Index of the first individual of a community whose prefix sum of chances
+// reaches loc
+long search_parent(long loc, __global const long *chances_sum)
+{
+    long lo = 0;
+    long hi = POPULATION_SIZE - 1;
+    while (lo < hi) {
+        long mid = (lo + hi) / 2;
+        if (loc <= chances_sum[mid]) {
+            hi = mid;
+        } else {
+            lo = mid + 1;
+        }
+    }
+    return lo;
+}
+
+// Children of the generation step are written into new individuals
+__kernel void reproduce(__global const long *chances_sum,
+                        __global const uint *rng_key,
+                        uint generation,
 
-                        __global const long *dna_size,
-                        __global const double *individuals,
+                        __global const real_t *individuals,
 
                         __global const long *crossover_translation_mode,
                         __global const long *crossover_rotation_mode,
-                        __global const double *crossover_probability,
+                        __global const real_t *crossover_probability,
 
-                        __global const double *mutation_chance,
-                        __global const double *mutation_probability,
-                        __global const long *ttl_torsions,
-                        __global const double *lo_grid,
-                        __global const double *dist_grid,
+                        __global const real_t *mutation_chance,
+                        __global const real_t *mutation_probability,
+                        __global const real_t *lo_grid,
+                        __global const real_t *dist_grid,
 
-                        __global long *chances_sum,
-                        __global double *dna1,
-                        __global double *dna2,
-
-                        __global double *new_individuals)
+                        __global real_t *new_individuals)
 {
-    // Individual ID
-    long i_id = get_global_id(0);
+    // Community and individual IDs
+    long c_id = get_global_id(0) / POPULATION_SIZE;
+    long i_id = get_global_id(0) % POPULATION_SIZE;
+    chances_sum += c_id * POPULATION_SIZE;
+    individuals += c_id * POPULATION_SIZE * DNA_SIZE;
+    new_individuals += c_id * POPULATION_SIZE * DNA_SIZE;
 
     // Pick parents
-    long ttl_chances = 0;
-    for (long i = 0; i < population_size[0]; i++) {
-        ttl_chances += chances[i];
-        // Prefix-sum
-        chances_sum[i] = ttl_chances;
-    }
-    ttl_chances += 1;
-    // Start index of reproduction random number
-    long start_r_rns_idx = i_id * ttl_reproduction_rns[0];
-    long p1_loc = (long)(reproduction_rns[start_r_rns_idx + PRN_P1_IDX] *
+    long ttl_chances = chances_sum[POPULATION_SIZE - 1] + 1;
+    long p1_loc = (long)(rng_uniform(rng_key, generation, c_id, i_id, PRN_P1_IDX) *
                          ttl_chances);
-    long p2_loc = (long)(reproduction_rns[start_r_rns_idx + PRN_P2_IDX] *
+    long p2_loc = (long)(rng_uniform(rng_key, generation, c_id, i_id, PRN_P2_IDX) *
                          ttl_chances);
-    // p1 location has to be smaller than or equal to p2
-    if (p2_loc < p1_loc) {
-        long ptmp_loc = p1_loc;
-        p1_loc = p2_loc;
-        p2_loc = ptmp_loc;
-    }
     // Get parent 1 and 2 IDs
-    long p1_id, p2_id;
-    for (long i = 0; i < population_size[0]; i++) {
-        if (p1_loc <= chances_sum[i]) {
-            p1_id = i;
-            break;
-        }
+    long p1_id = search_parent(p1_loc, chances_sum);
+    long p2_id = search_parent(p2_loc, chances_sum);
+    // Parent 1 comes first in the population
+    if (p2_id < p1_id) {
+        long ptmp_id = p1_id;
+        p1_id = p2_id;
+        p2_id = ptmp_id;
     }
-    for (long i = p1_id; i < population_size[0]; i++) {
-        if (p2_loc <= chances_sum[i]) {
-            p2_id = i;
-            break;
+    // Crossover. Genes are taken from parent 1 unless their random number is
+    // above the crossover probability. Translation and rotation genes share
+    // the random number of their first gene in CM_COMBINE mode. If parent 1
+    // and 2 IDs point to a same DNA, there is nothing to cross over.
+    long start_p1_idx = p1_id * DNA_SIZE;
+    long start_p2_idx = p2_id * DNA_SIZE;
+    long start_dst_idx = i_id * DNA_SIZE;
+    real_t trans_rn = rng_uniform(rng_key, generation, c_id, i_id,
+                                  PRN_CROSSOVER_START_IDX + I_TRANS_X_IDX);
+    real_t rot_rn = rng_uniform(rng_key, generation, c_id, i_id,
+                                PRN_CROSSOVER_START_IDX + I_ROT_A_IDX);
+    for (long i = 0; i < DNA_SIZE; i++) {
+        real_t rn = rng_uniform(rng_key, generation, c_id, i_id,
+                                PRN_CROSSOVER_START_IDX + i);
+        if (i < I_ROT_A_IDX) {
+            if (crossover_translation_mode[0] == CM_COMBINE) rn = trans_rn;
+        } else if (i < I_TOR_START_IDX) {
+            if (crossover_rotation_mode[0] == CM_COMBINE) rn = rot_rn;
         }
-    }
-    // Get parent 1 and 2 DNAs
-    long start_src_idx;
-    start_src_idx = p1_id * dna_size[0];
-    long start_dna_idx = i_id * dna_size[0];
-    for (long i = 0; i < dna_size[0]; i++) {
-        dna1[start_dna_idx + i] = individuals[start_src_idx + i];
-    }
-    start_src_idx = p2_id * dna_size[0];
-    for (long i = 0; i < dna_size[0]; i++) {
-        dna2[start_dna_idx + i] = individuals[start_src_idx + i];
-    }
-    long start_dst_idx = i_id * dna_size[0];
-    // Crossover
-    // If parent 1 and 2 IDs point to a same DNA, skip crossover
-    if (p1_id != p2_id) {
-        // Translation genes
-        if (crossover_translation_mode[0] == CM_SEPARATE) {
-            if (new_individuals[start_dst_idx + I_TRANS_X_IDX] > crossover_probability[0]) {
-                dna1[start_dna_idx + I_TRANS_X_IDX] = dna2[start_dna_idx + I_TRANS_X_IDX];
-            }
-            if (new_individuals[start_dst_idx + I_TRANS_Y_IDX] > crossover_probability[0]) {
-                dna1[start_dna_idx + I_TRANS_Y_IDX] = dna2[start_dna_idx + I_TRANS_Y_IDX];
-            }
-            if (new_individuals[start_dst_idx + I_TRANS_Z_IDX] > crossover_probability[0]) {
-                dna1[start_dna_idx + I_TRANS_Z_IDX] = dna2[start_dna_idx + I_TRANS_Z_IDX];
-            }
-        } else { // CM_COMBINE
-            if (new_individuals[start_dst_idx + I_TRANS_X_IDX] > crossover_probability[0]) {
-                for (long i = 0; i < 3; i++) {
-                    dna1[start_dna_idx + I_TRANS_X_IDX + i] = dna2[start_dna_idx + I_TRANS_X_IDX + i];
-                }
-            }
-        }
-        // Rotation genes
-        if (crossover_rotation_mode[0] == CM_SEPARATE) {
-            if (new_individuals[start_dst_idx + I_ROT_A_IDX] > crossover_probability[0]) {
-                dna1[start_dna_idx + I_ROT_A_IDX] = dna2[start_dna_idx + I_ROT_A_IDX];
-            }
-            if (new_individuals[start_dst_idx + I_ROT_B_IDX] > crossover_probability[0]) {
-                dna1[start_dna_idx + I_ROT_B_IDX] = dna2[start_dna_idx + I_ROT_B_IDX];
-            }
-            if (new_individuals[start_dst_idx + I_ROT_C_IDX] > crossover_probability[0]) {
-                dna1[start_dna_idx + I_ROT_C_IDX] = dna2[start_dna_idx + I_ROT_C_IDX];
-            }
-            if (new_individuals[start_dst_idx + I_ROT_D_IDX] > crossover_probability[0]) {
-                dna1[start_dna_idx + I_ROT_D_IDX] = dna2[start_dna_idx + I_ROT_D_IDX];
-            }
-        } else { // CM_COMBINE
-            if (new_individuals[start_dst_idx + I_ROT_A_IDX] > crossover_probability[0]) {
-                for (long i = 0; i < 4; i++) {
-                    dna1[start_dna_idx + I_ROT_A_IDX + i] = dna2[start_dna_idx + I_ROT_A_IDX + i];
-                }
-            }
-        }
-        // Torsion genes
-        for (long i = 0; i < ttl_torsions[0]; i++) {
-            if (new_individuals[start_dst_idx + I_TOR_START_IDX + i] > crossover_probability[0]) {
-                dna1[start_dna_idx + I_TOR_START_IDX + i] = dna2[start_dna_idx + I_TOR_START_IDX + i];
-            }
+        if (p1_id != p2_id && rn > crossover_probability[0]) {
+            new_individuals[start_dst_idx + i] = individuals[start_p2_idx + i];
+        } else {
+            new_individuals[start_dst_idx + i] = individuals[start_p1_idx + i];
         }
     }
     // Mutation
-    if (reproduction_rns[start_r_rns_idx + PRN_MUTATION_CHANCE_IDX] < mutation_chance[0]) {
-        double two_pi = 2 * M_PI;
+    if (rng_uniform(rng_key, generation, c_id, i_id, PRN_MUTATION_CHANCE_IDX) < mutation_chance[0]) {
+        real_t two_pi = 2 * M_PI;
         // Translation genes
-        if (reproduction_rns[start_r_rns_idx + PRN_TRANS_IDX] < mutation_probability[0]) {
+        if (rng_uniform(rng_key, generation, c_id, i_id, PRN_TRANS_IDX) < mutation_probability[0]) {
             // Translation genes. Starts from index 0 to 2
-            dna1[start_dna_idx + I_TRANS_X_IDX] = lo_grid[0] +
-                                                  (reproduction_rns[start_r_rns_idx + PRN_POSE_TRANS_X_IDX] * dist_grid[0]);
-            dna1[start_dna_idx + I_TRANS_Y_IDX] = lo_grid[1] +
-                                                  (reproduction_rns[start_r_rns_idx + PRN_POSE_TRANS_Y_IDX] * dist_grid[1]);
-            dna1[start_dna_idx + I_TRANS_Z_IDX] = lo_grid[2] +
-                                                  (reproduction_rns[start_r_rns_idx + PRN_POSE_TRANS_Z_IDX] * dist_grid[2]);
+            new_individuals[start_dst_idx + I_TRANS_X_IDX] = lo_grid[0] +
+                                                             (rng_uniform(rng_key, generation, c_id, i_id, PRN_POSE_TRANS_X_IDX) * dist_grid[0]);
+            new_individuals[start_dst_idx + I_TRANS_Y_IDX] = lo_grid[1] +
+                                                             (rng_uniform(rng_key, generation, c_id, i_id, PRN_POSE_TRANS_Y_IDX) * dist_grid[1]);
+            new_individuals[start_dst_idx + I_TRANS_Z_IDX] = lo_grid[2] +
+                                                             (rng_uniform(rng_key, generation, c_id, i_id, PRN_POSE_TRANS_Z_IDX) * dist_grid[2]);
         }
         // Rotation genes
-        if (reproduction_rns[start_r_rns_idx + PRN_ROT_IDX] < mutation_probability[0]) {
+        if (rng_uniform(rng_key, generation, c_id, i_id, PRN_ROT_IDX) < mutation_probability[0]) {
             // x0 = rng.zero_to_one()
-            double x0 = reproduction_rns[start_r_rns_idx + PRN_POSE_ROT_A_IDX];
+            real_t x0 = rng_uniform(rng_key, generation, c_id, i_id, PRN_POSE_ROT_A_IDX);
             // t1 = rng.zero_to_2pi()
-            double t1 = reproduction_rns[start_r_rns_idx + PRN_POSE_ROT_B_IDX] * two_pi;
+            real_t t1 = rng_uniform(rng_key, generation, c_id, i_id, PRN_POSE_ROT_B_IDX) * two_pi;
             // t2 = rng.zero_to_2pi()
-            double t2 = reproduction_rns[start_r_rns_idx + PRN_POSE_ROT_C_IDX] * two_pi;
-            double r1 = sqrt(1.0 - x0);
-            double r2 = sqrt(x0);
-            dna1[start_dna_idx + I_ROT_B_IDX] = sin(t1) * r1;
-            dna1[start_dna_idx + I_ROT_C_IDX] = cos(t1) * r1;
-            dna1[start_dna_idx + I_ROT_D_IDX] = sin(t2) * r2;
-            dna1[start_dna_idx + I_ROT_A_IDX] = cos(t2) * r2;
+            real_t t2 = rng_uniform(rng_key, generation, c_id, i_id, PRN_POSE_ROT_C_IDX) * two_pi;
+            real_t r1 = sqrt(1.0 - x0);
+            real_t r2 = sqrt(x0);
+            new_individuals[start_dst_idx + I_ROT_B_IDX] = sin(t1) * r1;
+            new_individuals[start_dst_idx + I_ROT_C_IDX] = cos(t1) * r1;
+            new_individuals[start_dst_idx + I_ROT_D_IDX] = sin(t2) * r2;
+            new_individuals[start_dst_idx + I_ROT_A_IDX] = cos(t2) * r2;
         }
         // Tortion genes
-        for (long i = 0; i < ttl_torsions[0]; i++) {
-            if (reproduction_rns[start_r_rns_idx + PRN_TOR_START_IDX + i] < mutation_probability[0]) {
+        for (long i = 0; i < TTL_TORSIONS; i++) {
+            if (rng_uniform(rng_key, generation, c_id, i_id, PRN_TOR_START_IDX + i) < mutation_probability[0]) {
                 // rng.neg_pi_to_pi()
-                dna1[start_dna_idx + I_TOR_START_IDX + i] = (reproduction_rns[start_r_rns_idx + PRN_POSE_TOR_START_IDX + i] - 0.5) *
-                                                            two_pi;
+                new_individuals[start_dst_idx + I_TOR_START_IDX + i] = (rng_uniform(rng_key, generation, c_id, i_id, PRN_POSE_TOR_START_IDX + i) - 0.5) *
+                                                                       two_pi;
             }
         }
     }
-    // Commit the new individual
-    for (long i = 0; i < dna_size[0]; i++) {
-        new_individuals[start_dst_idx + i] = dna1[start_dna_idx + i];
+}
+
+
+// Candidate a comes before candidate b when it has lower score, or the same
+// score and lower ID. Not a number scores come last.
+bool is_better(accum_t score_a, long id_a, accum_t score_b, long id_b)
+{
+    if (isnan(score_a)) return false;
+    if (isnan(score_b)) return true;
+    return (score_a < score_b) || (score_a == score_b && id_a < id_b);
+}
+
+// Lowest score of the population of each community and its individual ID,
+// run as one work-group of any size per community. Each work item finds the
+// best of a strided part of the population and the work item bests are
+// reduced in local memory.
+__kernel void find_best(__global const accum_t *e_totals,
+
+                        __local accum_t *scores,
+                        __local long *ids,
+
+                        __global accum_t *best_score,
+                        __global long *best_id)
+{
+    // Community of the work-group
+    long c_id = get_group_id(0);
+    e_totals += c_id * POPULATION_SIZE;
+    long local_id = get_local_id(0);
+    long local_size = get_local_size(0);
+
+    accum_t score = NAN;
+    long id = POPULATION_SIZE;
+    for (long i = local_id; i < POPULATION_SIZE; i += local_size) {
+        if (is_better(e_totals[i], i, score, id)) {
+            score = e_totals[i];
+            id = i;
+        }
+    }
+    scores[local_id] = score;
+    ids[local_id] = id;
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    for (long size = local_size; size > 1; size = (size + 1) / 2) {
+        long offset = (size + 1) / 2;
+        if (local_id < size - offset &&
+            is_better(scores[local_id + offset], ids[local_id + offset],
+                      scores[local_id], ids[local_id])) {
+            scores[local_id] = scores[local_id + offset];
+            ids[local_id] = ids[local_id + offset];
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+    }
+
+    if (local_id == 0) {
+        best_score[c_id] = scores[0];
+        best_id[c_id] = ids[0];
     }
 }
 
+// Merge the scored population of each community into its elite archive of
+// the ELITE_SIZE best individuals seen so far. Candidates of a community are
+// its archive entries (IDs 0 to ELITE_SIZE - 1) followed by its population.
+// Each work item ranks one candidate by counting the better candidates,
+// stopping once there are ELITE_SIZE of them, and writes the candidates that
+// make it into the new archive at their rank.
+__kernel void update_elite(__global const accum_t *elite_scores,
+                           __global const real_t *elite_individuals,
+                           __global const accum_t *e_totals,
+                           __global const real_t *individuals,
+
+                           __global accum_t *new_elite_scores,
+                           __global real_t *new_elite_individuals)
+{
+    // Community and candidate IDs
+    long c_id = get_global_id(0) / (ELITE_SIZE + POPULATION_SIZE);
+    long cand_id = get_global_id(0) % (ELITE_SIZE + POPULATION_SIZE);
+    elite_scores += c_id * ELITE_SIZE;
+    elite_individuals += c_id * ELITE_SIZE * DNA_SIZE;
+    e_totals += c_id * POPULATION_SIZE;
+    individuals += c_id * POPULATION_SIZE * DNA_SIZE;
+    new_elite_scores += c_id * ELITE_SIZE;
+    new_elite_individuals += c_id * ELITE_SIZE * DNA_SIZE;
+
+    accum_t score = (cand_id < ELITE_SIZE) ? elite_scores[cand_id] :
+                                             e_totals[cand_id - ELITE_SIZE];
+
+    long rank = 0;
+    for (long i = 0; i < ELITE_SIZE + POPULATION_SIZE && rank < ELITE_SIZE; i++) {
+        accum_t other_score = (i < ELITE_SIZE) ? elite_scores[i] :
+                                                 e_totals[i - ELITE_SIZE];
+        if (is_better(other_score, i, score, cand_id)) rank++;
+    }
+    if (rank >= ELITE_SIZE) return;
+
+    new_elite_scores[rank] = score;
+    for (long i = 0; i < DNA_SIZE; i++) {
+        if (cand_id < ELITE_SIZE) {
+            new_elite_individuals[(rank * DNA_SIZE) + i] = elite_individuals[(cand_id * DNA_SIZE) + i];
+        } else {
+            new_elite_individuals[(rank * DNA_SIZE) + i] = individuals[((cand_id - ELITE_SIZE) * DNA_SIZE) + i];
+        }
+    }
+}
@@ -23,184 +23,156 @@
 
 from Axis3 import Axis3
 from Quaternion import Quaternion
-from Constants import DEG2RAD
+from Constants import DEG2RAD, TWOPI
 from LFSR import LFSR
-from math import log
-from copy import deepcopy
+from WorkGroupTuner import WorkGroupTuner
 from time import time
+from multiprocessing import Pool, cpu_count
+import threading
+import os
+import copy
 import numpy as np
 import pyopencl as cl
-from pyopencl.clrandom import RanluxGenerator
+import pyopencl.array
 
 DEBUG = False
 VERBOSE = False
 
-class GeneticAlgorithm:
-    class Individual:
-        def __init__(self, ttl_torsions = 0, \
-                     lo_grid = Axis3(), hi_grid = Axis3(), \
-                     rng = None):
-            self.translation_gene = Axis3()
-            self.rotation_gene = Quaternion()
-            self.torsions_gene = []
-            
-            self.random_translation(lo_grid, hi_grid, rng)
-            self.random_rotation(rng)
-            self.random_torsions(ttl_torsions, rng)
-
-        def random_translation(self, lo_grid, hi_grid, rng):
-            lo_x, lo_y, lo_z = lo_grid.xyz
-            hi_x, hi_y, hi_z = hi_grid.xyz
-            self.translation_gene.x = lo_x + (rng.zero_to_one() * (hi_x - lo_x))
-            self.translation_gene.y = lo_y + (rng.zero_to_one() * (hi_y - lo_y))
-            self.translation_gene.z = lo_z + (rng.zero_to_one() * (hi_z - lo_z))
-
-        def random_rotation(self, rng):
-            self.rotation_gene.uniform(rng)
-
-        def random_torsions(self, ttl_torsions, rng):
-            self.torsions_gene = []
-            for i in xrange(ttl_torsions):
-                self.torsions_gene.append(rng.neg_pi_to_pi())
+# Genetic algorithm whose communities are run by worker processes. Workers are
+# forked after it is set, so they share its docking data read-only.
+community_ga = None
+
+def run_community_in_worker(community_idx):
+    return community_ga.run_community(community_idx)
 
+class GeneticAlgorithm:
     class Population:
+        # Crossover modes
+        CM_SEPARATE = 0 # Separate probabilities for translation/rotation genes
+        CM_COMBINE = 1  # Combined probability for translation/rotation genes
+
         def __init__(self):
-            self.individuals = []
+            # Matrix of i by j for individuals and genes (DNA) respectively
+            self.individuals = np.empty((0, 7))
             self.scores = GeneticAlgorithm.Scores()
+            self.crossover_translation_mode = self.CM_SEPARATE
+            self.crossover_rotation_mode = self.CM_SEPARATE
+            self.crossover_probability = 0.5
+            self.mutation_probability = 0.0
 
         def __repr__(self):
             ret = "Individuals:\n"
-            for individual in self.individuals:
-                ret += "%s  %s |" % (individual.translation_gene, \
-                                     individual.rotation_gene)
-                for torsion in individual.torsions_gene:
+            for idx, individual in enumerate(self.individuals):
+                ret += "[%3d] " % (idx + 1)
+                ret += "%6.2f %6.2f %6.2f | " % (individual[0], \
+                                                 individual[1], \
+                                                 individual[2])
+                ret += "%6.2f %6.2fi %6.2fj %6.2fk | " % (individual[3], \
+                                                          individual[4], \
+                                                          individual[5], \
+                                                          individual[6])
+                for torsion in individual[7:]:
                     ret += " %5.2f" % torsion
                 ret += "\n"
             return ret
 
+        # Random individuals as a (size, 7 + T) array. Random numbers are
+        # drawn per individual for translation, rotation and then torsion
+        # genes.
+        @staticmethod
+        def random_individuals(size = 0, ttl_torsions = 0, \
+                               lo_grid = Axis3(), hi_grid = Axis3(), \
+                               rng = None):
+            rands = rng.zero_to_one_in_numpy((size, 6 + ttl_torsions))
+            lo = np.array(lo_grid.xyz)
+            hi = np.array(hi_grid.xyz)
+            individuals = np.empty((size, 7 + ttl_torsions))
+            individuals[:, :3] = lo + (rands[:, :3] * (hi - lo))
+            individuals[:, 3:7] = Quaternion.uniform_in_numpy(rands[:, 3:6])
+            individuals[:, 7:] = (rands[:, 6:] - 0.5) * TWOPI
+            return individuals
+
         def create(self, size = 0, ttl_torsions = 0, \
                    lo_grid = Axis3(), hi_grid = Axis3(), \
                    rng = None):
-            self.individuals = []
-            for i in xrange(size):
-                individual = GeneticAlgorithm.Individual(ttl_torsions, \
-                                                         lo_grid, hi_grid, \
-                                                         rng)
-                self.individuals.append(individual)
+            self.individuals = self.random_individuals(size, ttl_torsions, \
+                                                       lo_grid, hi_grid, rng)
 
         def scoring(self, dock = None):
-            self.scores = GeneticAlgorithm.Scores()
-            for individual in self.individuals:
-                if DEBUG:
-                    individual.translation_gene = Axis3(2.056477, 5.846611, -7.245407)
-                    individual.rotation_gene = Quaternion(0.532211, 0.379383, 0.612442, 0.444674)
-                    torsions_gene_degrees = [-122.13, -179.41, \
-                         -141.59,  177.29, \
-                         -179.46,   -9.31, \
-                         132.37,  -89.19, \
-                         78.43,   22.22, \
-                         71.37,   59.52]
-                    individual.torsions_gene = []
-                    for torsions_gene_degree in torsions_gene_degrees:
-                        individual.torsions_gene.append((3.1415926535897931 / 180.0) * torsions_gene_degree)
-                    print individual.translation_gene
-                    print individual.rotation_gene
-                    print individual.torsions_gene
-
-                if dock.reset_pose(individual.translation_gene, \
-                                   individual.rotation_gene, \
-                                   individual.torsions_gene):
-                    self.scores.append(dock.calc_energy())
-                else:
-                    self.scores.append(float("inf"))
+            if DEBUG:
+                torsions_gene_degrees = [-122.13, -179.41, \
+                     -141.59,  177.29, \
+                     -179.46,   -9.31, \
+                     132.37,  -89.19, \
+                     78.43,   22.22, \
+                     71.37,   59.52]
+                self.individuals[:, :3] = [2.056477, 5.846611, -7.245407]
+                self.individuals[:, 3:7] = [0.532211, 0.379383, 0.612442, 0.444674]
+                self.individuals[:, 7:] = [(3.1415926535897931 / 180.0) * degree \
+                                           for degree in torsions_gene_degrees]
+                print self
+
+            # Score the whole population at once
+            scores = dock.score_batch(self.individuals)
+            self.scores = GeneticAlgorithm.Scores(scores.tolist())
             return self.scores
 
+        # Crossover random number column of each gene. Genes sharing a column
+        # are crossed over together.
+        def get_crossover_columns(self, ttl_torsions):
+            if self.crossover_translation_mode == self.CM_SEPARATE:
+                columns = [0, 1, 2]
+            else: # CM_COMBINE
+                columns = [0, 0, 0]
+            if self.crossover_rotation_mode == self.CM_SEPARATE:
+                columns += range(columns[-1] + 1, columns[-1] + 5)
+            else: # CM_COMBINE
+                columns += [columns[-1] + 1] * 4
+            columns += range(columns[-1] + 1, columns[-1] + 1 + ttl_torsions)
+            return np.array(columns)
+
+        # Children of the given parents (size, 2). Each gene of a child comes
+        # from the second parent when its random number is above the crossover
+        # probability, otherwise from the first parent.
         def crossover(self, parents_idx, ttl_torsions, rng):
-            return None
-
-        def mutate(self, individual, mutation_chance, \
+            columns = self.get_crossover_columns(ttl_torsions)
+            rands = rng.zero_to_one_in_numpy((len(parents_idx), columns[-1] + 1))
+            mask = rands[:, columns] > self.crossover_probability
+            return np.where(mask, \
+                            self.individuals[parents_idx[:, 1]], \
+                            self.individuals[parents_idx[:, 0]])
+
+        # Mutates individuals in place. An individual mutates by mutation
+        # chance, then its translation genes, rotation genes and each of its
+        # torsion genes are replaced by mutation probability.
+        def mutate(self, individuals, mutation_chance, \
                    lo_grid, hi_grid, ttl_torsions, rng):
-            return None
+            rands = rng.zero_to_one_in_numpy(len(individuals))
+            mutants_idx = np.flatnonzero(rands < mutation_chance)
+            columns = np.array([0, 0, 0, 1, 1, 1, 1] + range(2, 2 + ttl_torsions))
+            rands = rng.zero_to_one_in_numpy((len(mutants_idx), 2 + ttl_torsions))
+            mask = rands[:, columns] < self.mutation_probability
+            mutants = self.random_individuals(len(mutants_idx), ttl_torsions, \
+                                              lo_grid, hi_grid, rng)
+            individuals[mutants_idx] = np.where(mask, mutants, \
+                                                individuals[mutants_idx])
+            return individuals
 
     class Settler(Population):
         def __init__(self):
             GeneticAlgorithm.Population.__init__(self)
-
-        def crossover(self, parents_idx, ttl_torsions, rng):
-            p1_idx = parents_idx[0]
-            p2_idx = parents_idx[1]
-            individual = deepcopy(self.individuals[p1_idx])
-            # Crossing over translation genes
-            if rng.zero_to_one() > 0.5:
-                individual.translation_gene = deepcopy(self.individuals[p2_idx].translation_gene)
-            # Crossing over rotation genes
-            if rng.zero_to_one() > 0.5:
-                individual.rotation_gene = deepcopy(self.individuals[p2_idx].rotation_gene)
-            # Crossing over torsion genes
-            for i in xrange(ttl_torsions):
-                if rng.zero_to_one() > 0.5:
-                    individual.torsions_gene[i] = self.individuals[p2_idx].torsions_gene[i]
-            return individual
-
-        def mutate(self, individual, mutation_chance, \
-                   lo_grid, hi_grid, ttl_torsions, rng):
-            if rng.zero_to_one() < mutation_chance:
-                # Mutating translation genes
-                if rng.zero_to_one() < 0.25:
-                    individual.random_translation(lo_grid, hi_grid, rng)
-                # Mutating rotation genes
-                if rng.zero_to_one() < 0.25:
-                    individual.random_rotation(rng)
-                # Mutating torsion genes
-                for i in xrange(ttl_torsions):
-                    if rng.zero_to_one() < 0.25:
-                        individual.torsions_gene[i] = rng.neg_pi_to_pi()
-            return individual
+            self.crossover_translation_mode = self.CM_COMBINE
+            self.crossover_rotation_mode = self.CM_COMBINE
+            self.crossover_probability = 0.5
+            self.mutation_probability = 0.25
 
     class Nomad(Population):
         def __init__(self):
             GeneticAlgorithm.Population.__init__(self)
-
-        def crossover(self, parents_idx, ttl_torsions, rng):
-            p1_idx = parents_idx[0]
-            p2_idx = parents_idx[1]
-            individual = deepcopy(self.individuals[p1_idx])
-            # Crossing over translation genes
-            if rng.zero_to_one() > 0.5:
-                individual.translation_gene.x = self.individuals[p2_idx].translation_gene.x
-            if rng.zero_to_one() > 0.5:
-                individual.translation_gene.y = self.individuals[p2_idx].translation_gene.y
-            if rng.zero_to_one() > 0.5:
-                individual.translation_gene.z = self.individuals[p2_idx].translation_gene.z
-            # Crossing over rotation genes
-            if rng.zero_to_one() > 0.5:
-                individual.rotation_gene.a = self.individuals[p2_idx].rotation_gene.a
-            if rng.zero_to_one() > 0.5:
-                individual.rotation_gene.b = self.individuals[p2_idx].rotation_gene.b
-            if rng.zero_to_one() > 0.5:
-                individual.rotation_gene.c = self.individuals[p2_idx].rotation_gene.c
-            if rng.zero_to_one() > 0.5:
-                individual.rotation_gene.d = self.individuals[p2_idx].rotation_gene.d
-            # Crossing over torsion genes
-            for i in xrange(ttl_torsions):
-                if rng.zero_to_one() > 0.5:
-                    individual.torsions_gene[i] = self.individuals[p2_idx].torsions_gene[i]
-            return individual
-
-        def mutate(self, individual, mutation_chance, \
-                   lo_grid, hi_grid, ttl_torsions, rng):
-            if rng.zero_to_one() < mutation_chance:
-                # Mutating translation genes
-                if rng.zero_to_one() < 0.75:
-                    individual.random_translation(lo_grid, hi_grid, rng)
-                # Mutating rotation genes
-                if rng.zero_to_one() < 0.75:
-                    individual.random_rotation(rng)
-                # Mutating torsion genes
-                for i in xrange(ttl_torsions):
-                    if rng.zero_to_one() < 0.75:
-                        individual.torsions_gene[i] = rng.neg_pi_to_pi()
-            return individual
+            self.crossover_translation_mode = self.CM_SEPARATE
+            self.crossover_rotation_mode = self.CM_SEPARATE
+            self.crossover_probability = 0.5
+            self.mutation_probability = 0.75
 
     class Scores(list):
         def __init__(self, *args):
@@ -228,6 +200,7 @@ class GeneticAlgorithm:
         self.dna_size = 0               # Total genes in a DNA
         self.num_gen = 0                # Number of generations
         self.max_inherited_prob = 12    # Maximum inhereted probability
+        self.num_workers = 1            # Number of worker processes
 
         self.rng = None
         self.mutation_chance = 0.0
@@ -236,9 +209,15 @@ class GeneticAlgorithm:
         self.nomad = None
         self.settler = None
 
-    def setup_rng(self):
+    # Random numbers reserved for each community. Every community draws from
+    # its own part of the LFSR sequence, so its result does not depend on which
+    # worker runs it or in which order.
+    COMMUNITY_RNG_STRIDE = 2 ** 36
+
+    def setup_rng(self, community_idx = 0):
         # Define random number generator
         self.rng = LFSR(lfsr = 1070, bit_len = 48)
+        self.rng.jump(community_idx * self.COMMUNITY_RNG_STRIDE)
 
     def setup(self):
         self.lo_grid = self.dock.grid.field.lo
@@ -248,79 +227,110 @@ class GeneticAlgorithm:
         self.ttl_ligand_atoms = len(self.dock.ligand.ori_atoms)
         self.setup_rng()
 
+    # Number of entries each individual gets in the mating pool
+    def calc_chances(self, scores):
+        scores = np.array(scores, dtype = float) / self.ttl_ligand_atoms
+        chances = np.ones(len(scores), dtype = int)
+        # Use probabilistic method to select individual into mating pool
+        positive = scores > 0.0
+        powers = np.log(scores[positive])
+        chances[positive] = np.where(powers < self.max_inherited_prob, \
+                                     self.max_inherited_prob - powers, \
+                                     1).astype(int)
+        chances[scores <= 0.0] = self.max_inherited_prob
+        return chances
+
+    # Returns the mating pool as cumulative chances. Individual i owns mating
+    # pool entries from chances_sum[i - 1] up to, but excluding, chances_sum[i].
     def select(self, population):
         # Get individual scores
         scores = population.scoring(self.dock)
-        # Create mating pool from the scores
-        mating_pool = []
-        for idx, score in enumerate(scores.normalize(self.ttl_ligand_atoms)):
-            # Use probabilistic method to select individual into mating pool
-            if score < 0:
-                chances = self.max_inherited_prob
-            else:
-                power = log(score)
-                if power < self.max_inherited_prob:
-                    chances = int(self.max_inherited_prob - power)
-                else:
-                    chances = 1
-            # Fill in the mating pool
-            for i in xrange(chances):
-                mating_pool.append(idx)
-        return mating_pool
-
-    def pick_parents(self, mating_pool):
-        parents = []
-        for i in xrange(2):
-            parents.append(mating_pool[int(self.rng.zero_to_one() * \
-                                           len(mating_pool))])
-        return parents
-
-    def reproduce(self, mating_pool, population):
-        new_population = deepcopy(population)
-        new_population.individuals = []
-        for i in xrange(self.population_size):
-            parents_idx = self.pick_parents(mating_pool)
-            individual = population.crossover(parents_idx, self.ttl_torsions, self.rng)
-            individual = population.mutate(individual, self.mutation_chance, \
-                                           self.lo_grid, self.hi_grid, \
-                                           self.ttl_torsions, self.rng)
-            new_population.individuals.append(individual)
-        return new_population
-
-    def run(self):
-        self.setup()
+        return np.cumsum(self.calc_chances(scores))
+
+    # Parents (size, 2) picked from the mating pool
+    def pick_parents(self, chances_sum, size):
+        locs = (self.rng.zero_to_one_in_numpy((size, 2)) * \
+                chances_sum[-1]).astype(int)
+        return np.searchsorted(chances_sum, locs, side = 'right')
+
+    def reproduce(self, chances_sum, population):
+        parents_idx = self.pick_parents(chances_sum, self.population_size)
+        individuals = population.crossover(parents_idx, self.ttl_torsions, \
+                                           self.rng)
+        population.individuals = population.mutate(individuals, \
+                                                    self.mutation_chance, \
+                                                    self.lo_grid, self.hi_grid, \
+                                                    self.ttl_torsions, self.rng)
+        return population
+
+    # Runs a Nomad and then a Settler population. Returns their minimum scores
+    # and the elapsed time.
+    def run_community(self, community_idx):
+        tic = time()
+        self.setup_rng(community_idx)
         # Define multiple population
         self.nomad = self.Nomad()
         self.settler = self.Settler()
+
+        # Nomad portion
+        nomad_min_score = float("inf")
+        self.nomad.create(self.population_size, self.ttl_torsions, \
+                          self.lo_grid, self.hi_grid, \
+                          self.rng)
+        if VERBOSE: print self.nomad
+        for gen_idx in xrange(self.num_gen):
+            chances_sum = self.select(self.nomad)
+            self.nomad = self.reproduce(chances_sum, self.nomad)
+        nomad_min_score = self.nomad.scores.minimum()
+
+        # Settler portion
+        settler_min_score = float("inf")
+        self.settler.individuals = self.nomad.individuals.copy()
+        if VERBOSE: print self.settler
+        for gen_idx in xrange(self.num_gen):
+            chances_sum = self.select(self.settler)
+            self.settler = self.reproduce(chances_sum, self.settler)
+        if VERBOSE: print self.settler
+        settler_min_score = self.settler.scores.minimum()
+
+        toc = time()
+        return [nomad_min_score, settler_min_score], toc - tic
+
+    # Yields the results of all communities in community order. Communities
+    # are independent, so they are spread over num_workers processes when
+    # more than one is configured (0 for all cores).
+    def run_communities(self):
+        num_workers = self.num_workers
+        if num_workers <= 0:
+            num_workers = cpu_count()
+        num_workers = min(num_workers, self.community_size)
+        if num_workers <= 1:
+            for community_idx in xrange(self.community_size):
+                yield self.run_community(community_idx)
+            return
+
+        global community_ga
+        self.dock.setup_scoring()
+        community_ga = self
+        pool = Pool(num_workers)
+        try:
+            for result in pool.imap(run_community_in_worker, \
+                                    xrange(self.community_size)):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+            community_ga = None
+
+    def run(self):
+        self.setup()
         population_min_scores = []
-        for community_idx in xrange(self.community_size):
-            tic = time()
-            # Nomad portion
-            nomad_min_score = float("inf")
-            self.nomad.create(self.population_size, self.ttl_torsions, \
-                              self.lo_grid, self.hi_grid, \
-                              self.rng)
-            if VERBOSE: print self.nomad
-            for gen_idx in xrange(self.num_gen):
-                mating_pool = self.select(self.nomad)
-                self.nomad = self.reproduce(mating_pool, self.nomad)
-            nomad_min_score = self.nomad.scores.minimum()
-
-            # Settler portion
-            settler_min_score = float("inf")
-            self.settler.individuals = deepcopy(self.nomad.individuals)
-            if VERBOSE: print self.settler
-            for gen_idx in xrange(self.num_gen):
-                mating_pool = self.select(self.settler)
-                self.settler = self.reproduce(mating_pool, self.settler)
-            if VERBOSE: print self.settler
-            settler_min_score = self.settler.scores.minimum()
-
-            population_min_scores.append([nomad_min_score, settler_min_score])
-            toc = time()
+        for community_idx, (min_scores, elapsed_time) in \
+            enumerate(self.run_communities()):
+            population_min_scores.append(min_scores)
             print "Elapsed time community %4d: %10.2f - Minimum Scores: %12.3f, %12.3f" \
-                  % (community_idx + 1, toc - tic, \
-                     nomad_min_score, settler_min_score)
+                  % (community_idx + 1, elapsed_time, \
+                     min_scores[0], min_scores[1])
 
         print "Community Minimum Scores: %s" % population_min_scores
 
@@ -331,16 +341,25 @@ class GeneticAlgorithmOpenCL(GeneticAlgorithm):
         CM_COMBINE = 1  # Combined probability for translation/rotation genes
 
         def __init__(self, size = 0, dna_size = 0, \
-                     cl_ctx = None, cl_queue = None, rng = None, cl_prg = None):
+                     cl_ctx = None, cl_queue = None, rng_key_buf = None, \
+                     cl_prg = None, batch_size = 1, \
+                     real_dtype = float, accum_dtype = float):
+            # Size of the population of each community
             self.size = size
             self.dna_size = dna_size
+            # Number of communities whose populations are stacked together
+            self.batch_size = batch_size
+            # numpy types of genes and scores following the kernel precision
+            self.real_dtype = real_dtype
+            self.accum_dtype = accum_dtype
 
             # OpenCL
             self.cl_ctx = cl_ctx
             self.cl_queue = cl_queue
-            self.rng = rng
+            self.rng_key_buf = rng_key_buf
             self.cl_prg = cl_prg
-            # Matrix of i by j for individuals and genes (DNA) respectively
+            # Matrix of i by j for individuals and genes (DNA) respectively,
+            # community after community
             self.individuals_np = None
             self.individuals_buf = None
             self.new_individuals_np = None
@@ -353,16 +372,22 @@ class GeneticAlgorithmOpenCL(GeneticAlgorithm):
             self.crossover_probability_buf = None
             self.mutation_probability_np = np.array([], dtype = float)
             self.mutation_probability_buf = None
+            # Lowest score and its individual ID of every community, found on
+            # the device
+            self.best_score_buf = None
+            self.best_id_buf = None
 
         def setup_opencl(self):
             mf = cl.mem_flags
             # Setup device buffers
             self.individuals_buf = cl.array.zeros(self.cl_queue, \
-                                                  (self.size, self.dna_size), \
-                                                  dtype = float)
+                                                  (self.get_batch_population_size(), \
+                                                   self.dna_size), \
+                                                  dtype = self.real_dtype)
             self.new_individuals_buf = cl.array.zeros(self.cl_queue, \
-                                                      (self.size, self.dna_size), \
-                                                      dtype = float)
+                                                      (self.get_batch_population_size(), \
+                                                       self.dna_size), \
+                                                      dtype = self.real_dtype)
             self.crossover_translation_mode_np = np.array([self.crossover_translation_mode], \
                                                           dtype = int)
             self.crossover_translation_mode_buf =  cl.Buffer(self.cl_ctx, \
@@ -374,15 +399,23 @@ class GeneticAlgorithmOpenCL(GeneticAlgorithm):
                                                           mf.READ_ONLY | mf.COPY_HOST_PTR, \
                                                           hostbuf = self.crossover_rotation_mode_np)
             self.crossover_probability_np = np.array([self.crossover_probability], \
-                                                     dtype = float)
+                                                     dtype = self.real_dtype)
             self.crossover_probability_buf =  cl.Buffer(self.cl_ctx, \
                                                         mf.READ_ONLY | mf.COPY_HOST_PTR, \
                                                         hostbuf = self.crossover_probability_np)
             self.mutation_probability_np = np.array([self.mutation_probability], \
-                                                    dtype = float)
+                                                    dtype = self.real_dtype)
             self.mutation_probability_buf =  cl.Buffer(self.cl_ctx, \
                                                        mf.READ_ONLY | mf.COPY_HOST_PTR, \
                                                        hostbuf = self.mutation_probability_np)
+            self.best_score_buf = cl.array.zeros(self.cl_queue, self.batch_size, \
+                                                 dtype = self.accum_dtype)
+            self.best_id_buf = cl.array.zeros(self.cl_queue, self.batch_size, \
+                                              dtype = int)
+
+        # Total number of individuals of all communities in the batch
+        def get_batch_population_size(self):
+            return self.batch_size * self.size
 
         def __repr__(self):
             self.individuals_np = self.individuals_buf.get()
@@ -406,25 +439,59 @@ class GeneticAlgorithmOpenCL(GeneticAlgorithm):
             self.individuals_np = self.individuals_buf.get()
             return self.individuals_np[idx]
 
-        def create(self, dna_size_buf = None, dock = None):
-            self.rng.fill_uniform(self.individuals_buf)
+        def create(self, dock = None, generation = 0):
             # Construct individuals
-            self.cl_prg.construct_individuals(self.cl_queue, \
-                                              (self.size,), None, \
-                                              dock.lo_grid_buf, \
-                                              dock.dist_grid_buf, \
-                                              dna_size_buf, \
-                                              self.individuals_buf.data)
+            kernel = self.cl_prg.construct_individuals
+            global_size = self.get_batch_population_size()
+            def launch(local_size):
+                return kernel(self.cl_queue, (global_size,), \
+                              local_size and (local_size,), \
+                              dock.lo_grid_buf, \
+                              dock.dist_grid_buf, \
+                              self.rng_key_buf, \
+                              np.uint32(generation), \
+                              self.individuals_buf.data)
+            launch(dock.get_flat_local_size(kernel, global_size, launch))
 
         def scoring(self, dock = None, \
                     cl_ctx = None, cl_queue = None):
-            dock.reset_poses(self.size, self.individuals_buf, \
-                             cl_ctx, cl_queue)
+            dock.reset_poses(self.get_batch_population_size(), \
+                             self.individuals_buf, cl_ctx, cl_queue)
             dock.calc_energy()
 
-        def min_score(self, dock = None):
-            scores = dock.e_totals_buf.get()
-            return scores.min()
+        # Lowest scores of the last scoring and their individual IDs, one per
+        # community, into best score and ID buffers. Only the results are
+        # transferred from the device later, not the population scores.
+        def find_best(self, dock = None):
+            kernel = self.cl_prg.find_best
+            score_size = self.best_score_buf.dtype.itemsize
+            id_size = self.best_id_buf.dtype.itemsize
+            def launch(local_size):
+                return kernel(self.cl_queue, \
+                              (self.batch_size * local_size,), (local_size,), \
+                              dock.e_totals_buf.data, \
+                              cl.LocalMemory(local_size * score_size), \
+                              cl.LocalMemory(local_size * id_size), \
+                              self.best_score_buf.data, \
+                              self.best_id_buf.data)
+            if dock.workgroup_tuner:
+                local_bytes = lambda local_size: local_size * \
+                                                 (score_size + id_size)
+                candidates = WorkGroupTuner.get_group_candidates(kernel, \
+                                                                 self.cl_queue.device, \
+                                                                 self.size, \
+                                                                 local_bytes)
+                local_size = dock.workgroup_tuner.get_local_size(self.cl_queue, \
+                                                                 kernel, \
+                                                                 self.batch_size, \
+                                                                 candidates, \
+                                                                 launch)
+            else:
+                local_size = kernel.get_work_group_info( \
+                                 cl.kernel_work_group_info.WORK_GROUP_SIZE, \
+                                 self.cl_queue.device)
+                local_size = min(local_size, self.size)
+            launch(local_size)
 
         def crossover(self, parents_idx, ttl_torsions, rng):
             return None
@@ -435,10 +502,14 @@ class GeneticAlgorithmOpenCL(GeneticAlgorithm):
 
     class Settler(Population):
         def __init__(self, size = 0, dna_size = 0, \
-                     cl_ctx = None, cl_queue = None, rng = None, cl_prg = None):
+                     cl_ctx = None, cl_queue = None, rng_key_buf = None, \
+                     cl_prg = None, batch_size = 1, \
+                     real_dtype = float, accum_dtype = float):
             GeneticAlgorithmOpenCL.Population.__init__(self, size, dna_size, \
                                                        cl_ctx, cl_queue, \
-                                                       rng, cl_prg)
+                                                       rng_key_buf, cl_prg, \
+                                                       batch_size, real_dtype, \
+                                                       accum_dtype)
             self.crossover_translation_mode = self.CM_COMBINE
             self.crossover_rotation_mode = self.CM_COMBINE
             self.crossover_probability = 0.5
@@ -448,10 +519,14 @@ class GeneticAlgorithmOpenCL(GeneticAlgorithm):
 
     class Nomad(Population):
         def __init__(self, size = 0, dna_size = 0, \
-                     cl_ctx = None, cl_queue = None, rng = None, cl_prg = None):
+                     cl_ctx = None, cl_queue = None, rng_key_buf = None, \
+                     cl_prg = None, batch_size = 1, \
+                     real_dtype = float, accum_dtype = float):
             GeneticAlgorithmOpenCL.Population.__init__(self, size, dna_size, \
                                                        cl_ctx, cl_queue, \
-                                                       rng, cl_prg)
+                                                       rng_key_buf, cl_prg, \
+                                                       batch_size, real_dtype, \
+                                                       accum_dtype)
             self.crossover_translation_mode = self.CM_SEPARATE
             self.crossover_rotation_mode = self.CM_SEPARATE
             self.crossover_probability = 0.5
@@ -459,27 +534,59 @@ class GeneticAlgorithmOpenCL(GeneticAlgorithm):
             # OpenCL
             self.setup_opencl()
 
-    def __init__(self, dock = None, cl_device_type = None):
+    # Batch of communities enqueued on the device. Its results are read into
+    # host arrays on the transfer queue once its last kernel completes.
+    class Batch:
+        def __init__(self, first_community_idx = 0, ttl_communities = 0):
+            self.first_community_idx = first_community_idx
+            self.ttl_communities = ttl_communities
+            self.tic = time()
+            # Results per community
+            self.nomad_min_scores_np = None
+            self.settler_min_scores_np = None
+            self.elite_scores_np = None
+            self.elite_individuals_np = None
+            # Events of result reads
+            self.read_events = []
+
+    def __init__(self, dock = None, cl_device_type = None, \
+                 program_cache = None, cl_device = None):
         GeneticAlgorithm.__init__(self, dock)
         # OpenCL
         self.cl_device_type = cl_device_type
-        if self.cl_device_type == "gpu":
+        if cl_device is not None:
+            self.cl_ctx = cl.Context([cl_device])
+        elif self.cl_device_type == "gpu":
             self.cl_ctx = cl.Context(dev_type = cl.device_type.GPU)
         elif self.cl_device_type == "cpu":
             self.cl_ctx = cl.Context(dev_type = cl.device_type.CPU)
         else: # manual selection
             self.cl_ctx = cl.create_some_context()
         self.cl_queue = cl.CommandQueue(self.cl_ctx)
+        # Results are read on their own queue, so that reading them does not
+        # hold back the kernels of the next batch
+        self.cl_transfer_queue = cl.CommandQueue(self.cl_ctx, \
+                                                 self.cl_queue.device)
+        # Read events of the last enqueued batch, which the next batch waits
+        # for before overwriting the result buffers
+        self.pending_reads = []
+        # Time the results of the last batch were collected
+        self.collect_time = 0.0
         self.cl_filename = "./OpenCL/GeneticAlgorithm.cl"
         fh = open(self.cl_filename, 'r')
-        cl_code = "".join(fh.readlines())
-        self.cl_prg = cl.Program(self.cl_ctx, cl_code).build()
-        self.rng = None
+        self.cl_code = "".join(fh.readlines())
+        # Built by setup_opencl for the population and DNA sizes
+        self.cl_prg = None
+        self.program_cache = program_cache
+        # Random numbers are drawn on the device, keyed by seed and community
+        self.rng_key_np = np.array([], dtype = np.uint32)
+        self.rng_key_buf = None
+        self.generation = 0
+        # Number of communities run together as one stacked population
+        self.batch_size = 1
         # OpenCL buffer
         self.population_size_np = np.array([], dtype = int)
-        self.population_size_buf =  None
         self.dna_size_np = np.array([], dtype = int)
-        self.dna_size_buf = None
         self.max_inherited_prob_np = np.array([], dtype = int)
         self.max_inherited_prob_buf = None
         self.normalizer_np = np.array([], dtype = int)
@@ -487,13 +594,17 @@ class GeneticAlgorithmOpenCL(GeneticAlgorithm):
         self.chances_np = None
         self.chances_buf = None
         self.chances_sum_buf = None
-        self.dna1_buf = None
-        self.dna2_buf = None
-        self.ttl_reproduction_rns_np = np.array([], dtype = int)
-        self.ttl_reproduction_rns_buf = None
-        self.reproduction_rns_buf = None
         self.mutation_chance_np = np.array([], dtype = float)
         self.mutation_chance_buf = None
+        # Archive of the best individuals seen in a community, kept on the
+        # device and transferred once the community finishes
+        self.elite_size = 10
+        self.elite_scores_buf = None
+        self.elite_individuals_buf = None
+        self.new_elite_scores_buf = None
+        self.new_elite_individuals_buf = None
+        # Elite scores and individuals of every community run
+        self.community_elites = []
 
     def setup_opencl(self):
         # OpenCL setup
@@ -502,14 +613,9 @@ class GeneticAlgorithmOpenCL(GeneticAlgorithm):
         # Setup OpenCL device buffer
         mf = cl.mem_flags
         self.population_size_np = np.array([self.population_size], dtype = int)
-        self.population_size_buf =  cl.Buffer(self.cl_ctx, \
-                                              mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                              hostbuf = self.population_size_np)
         self.dna_size = 3 + 4 + self.dock.get_total_torsions()
         self.dna_size_np = np.array([self.dna_size], dtype = int)
-        self.dna_size_buf = cl.Buffer(self.cl_ctx, \
-                                      mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                      hostbuf = self.dna_size_np)
+        self.build_program()
         self.max_inherited_prob_np = np.array([self.max_inherited_prob], \
                                               dtype = int)
         self.max_inherited_prob_buf = cl.Buffer(self.cl_ctx, \
@@ -519,126 +625,421 @@ class GeneticAlgorithmOpenCL(GeneticAlgorithm):
         self.normalizer_buf = cl.Buffer(self.cl_ctx, \
                                         mf.READ_ONLY | mf.COPY_HOST_PTR, \
                                         hostbuf = self.normalizer_np)
-        self.chances_buf = cl.array.zeros(self.cl_queue, (self.population_size), \
+        self.chances_buf = cl.array.zeros(self.cl_queue, \
+                                          (self.get_batch_population_size()), \
                                           dtype = int)
-        self.chances_sum_buf = cl.array.zeros(self.cl_queue, (self.population_size), \
+        self.chances_sum_buf = cl.array.zeros(self.cl_queue, \
+                                              (self.get_batch_population_size()), \
                                               dtype = int)
-        self.dna1_buf = cl.array.zeros(self.cl_queue, \
-                                       (self.population_size, self.dna_size), \
-                                       dtype = float)
-        self.dna2_buf = cl.array.zeros(self.cl_queue, \
-                                       (self.population_size, self.dna_size), \
-                                       dtype = float)
-        # Reproduction random numbers needed per individual:
-        # - Selecting parents:  2
-        # - Crossing over:      Use new_individuals_buf
-        # - Mutation:           1 + 2 + total torsions
-        # - Mutation pose:      3 + 4 + total torsions
-        ttl_reproduction_rns = 2 + 1 + 2 + self.ttl_torsions + \
-                               3 + 4 + self.ttl_torsions
-        self.ttl_reproduction_rns_np = np.array([ttl_reproduction_rns], \
-                                                dtype = int)
-        self.ttl_reproduction_rns_buf = cl.Buffer(self.cl_ctx, \
-                                                  mf.READ_ONLY | mf.COPY_HOST_PTR, \
-                                                  hostbuf = self.ttl_reproduction_rns_np)
-        self.reproduction_rns_buf = cl.array.zeros(self.cl_queue, \
-                                                   (self.population_size, ttl_reproduction_rns), \
-                                                   dtype = float)
-        self.mutation_chance_np = np.array([self.mutation_chance], dtype = float)
+        self.mutation_chance_np = np.array([self.mutation_chance], \
+                                           dtype = self.dock.get_real_dtype())
         self.mutation_chance_buf = cl.Buffer(self.cl_ctx, \
                                              mf.READ_ONLY | mf.COPY_HOST_PTR, \
                                              hostbuf = self.mutation_chance_np)
-        # Setup OpenCL buffer for docking object
-        self.dock.setup_opencl_buffer(self.population_size, \
+        ttl_elites = self.batch_size * self.elite_size
+        self.elite_scores_buf = cl.array.zeros(self.cl_queue, ttl_elites, \
+                                               dtype = self.dock.get_accum_dtype())
+        self.elite_individuals_buf = cl.array.zeros(self.cl_queue, \
+                                                    (ttl_elites, self.dna_size), \
+                                                    dtype = self.dock.get_real_dtype())
+        self.new_elite_scores_buf = cl.array.zeros(self.cl_queue, ttl_elites, \
+                                                   dtype = self.dock.get_accum_dtype())
+        self.new_elite_individuals_buf = cl.array.zeros(self.cl_queue, \
+                                                        (ttl_elites, self.dna_size), \
+                                                        dtype = self.dock.get_real_dtype())
+        # Setup OpenCL buffer for docking object. Poses of all communities in
+        # the batch are scored together.
+        self.dock.setup_opencl_buffer(self.get_batch_population_size(), \
                                       self.cl_ctx, self.cl_queue)
 
-    def setup_rng(self):
-        self.rng = RanluxGenerator(self.cl_queue)
+    # Total number of individuals of all communities in the batch
+    def get_batch_population_size(self):
+        return self.batch_size * self.population_size
+
+    # Population, DNA and elite archive sizes are baked into the program as
+    # preprocessor definitions
+    def get_build_options(self):
+        defines = [("POPULATION_SIZE", self.population_size), \
+                   ("DNA_SIZE", self.dna_size), \
+                   ("TTL_TORSIONS", self.ttl_torsions), \
+                   ("ELITE_SIZE", self.elite_size)]
+        return ["-D%s=%d" % (name, value) for name, value in defines] + \
+               self.dock.get_precision_options()
+
+    def build_program(self):
+        options = self.get_build_options()
+        if self.program_cache:
+            self.cl_prg = self.program_cache.build(self.cl_ctx, self.cl_code, \
+                                                   os.path.basename(self.cl_filename), \
+                                                   options)
+        else:
+            self.cl_prg = cl.Program(self.cl_ctx, self.cl_code).build(options)
+
+    # Seed of the device random number generator
+    RNG_SEED = 1070
+
+    # Random numbers of a community are drawn from its own Philox key, so they
+    # do not depend on which communities ran before it or share its batch
+    def setup_rng(self, first_community_idx = 0):
+        self.rng_key_np = np.array([[self.RNG_SEED, community_idx] \
+                                    for community_idx in \
+                                    xrange(first_community_idx, \
+                                           first_community_idx + self.batch_size)], \
+                                   dtype = np.uint32)
+        if self.rng_key_buf is None:
+            mf = cl.mem_flags
+            self.rng_key_buf = cl.Buffer(self.cl_ctx, \
+                                         mf.READ_ONLY | mf.COPY_HOST_PTR, \
+                                         hostbuf = self.rng_key_np)
+        else:
+            cl.enqueue_copy(self.cl_queue, self.rng_key_buf, self.rng_key_np, \
+                            is_blocking = False)
 
     def setup(self):
         # Call parent setup
         GeneticAlgorithm.setup(self)
         # OpenCL
         self.setup_opencl()
+        # Define multiple population
+        self.nomad = self.Nomad(self.population_size, self.dna_size, \
+                                self.cl_ctx, self.cl_queue, \
+                                self.rng_key_buf, self.cl_prg, \
+                                self.batch_size, self.dock.get_real_dtype(), \
+                                self.dock.get_accum_dtype())
+        self.settler = self.Settler(self.population_size, self.dna_size, \
+                                    self.cl_ctx, self.cl_queue, \
+                                    self.rng_key_buf, self.cl_prg, \
+                                    self.batch_size, self.dock.get_real_dtype(), \
+                                    self.dock.get_accum_dtype())
 
     def select(self, population):
         # Get individual scores
         population.scoring(self.dock, self.cl_ctx, self.cl_queue)
-        self.cl_prg.calc_chances(self.cl_queue, (self.population_size,), None, \
-                                 self.dock.e_totals_buf.data, \
-                                 self.normalizer_buf, \
-                                 self.max_inherited_prob_buf, \
-                                 self.chances_buf.data)
+        kernel = self.cl_prg.calc_chances
+        global_size = self.get_batch_population_size()
+        def launch(local_size):
+            return kernel(self.cl_queue, (global_size,), \
+                          local_size and (local_size,), \
+                          self.dock.e_totals_buf.data, \
+                          self.normalizer_buf, \
+                          self.max_inherited_prob_buf, \
+                          self.chances_buf.data)
+        launch(self.dock.get_flat_local_size(kernel, global_size, launch))
+        # Prefix sum of chances for parents selection, one work-group per
+        # community
+        scan_size = self.get_scan_size()
+        self.cl_prg.scan_chances(self.cl_queue, \
+                                 (self.batch_size * scan_size,), (scan_size,), \
+                                 self.chances_buf.data, \
+                                 cl.LocalMemory(scan_size * \
+                                                self.chances_buf.dtype.itemsize), \
+                                 self.chances_sum_buf.data)
+        self.update_elite(population)
+
+    # Elite archive
+    # -------------
+    def reset_elite(self):
+        self.elite_scores_buf.fill(float("inf"))
+        self.elite_individuals_buf.fill(0.0)
+
+    # Merge the population just scored into the archive. The merged archive
+    # is written into the spare buffers, which then become the archive.
+    def update_elite(self, population):
+        kernel = self.cl_prg.update_elite
+        global_size = self.batch_size * (self.elite_size + self.population_size)
+        def launch(local_size):
+            return kernel(self.cl_queue, (global_size,), \
+                          local_size and (local_size,), \
+                          self.elite_scores_buf.data, \
+                          self.elite_individuals_buf.data, \
+                          self.dock.e_totals_buf.data, \
+                          population.individuals_buf.data, \
+                          self.new_elite_scores_buf.data, \
+                          self.new_elite_individuals_buf.data)
+        launch(self.dock.get_flat_local_size(kernel, global_size, launch))
+        self.elite_scores_buf, self.new_elite_scores_buf = \
+            self.new_elite_scores_buf, self.elite_scores_buf
+        self.elite_individuals_buf, self.new_elite_individuals_buf = \
+            self.new_elite_individuals_buf, self.elite_individuals_buf
+
+    # Work-group size of the prefix sum, the largest power of two the device
+    # allows that does not exceed the population size
+    def get_scan_size(self):
+        max_size = self.cl_prg.scan_chances.get_work_group_info( \
+                       cl.kernel_work_group_info.WORK_GROUP_SIZE, \
+                       self.cl_queue.device)
+        max_size = min(max_size, self.population_size)
+        scan_size = 1
+        while scan_size * 2 <= max_size:
+            scan_size *= 2
+        return scan_size
 
     def reproduce(self, population):
-        self.rng.fill_uniform(population.new_individuals_buf)
-        self.rng.fill_uniform(self.reproduction_rns_buf)
-
-        self.cl_prg.reproduce(self.cl_queue, (self.population_size,), None, \
-                              self.population_size_buf, \
-                              self.chances_buf.data, \
-                              self.ttl_reproduction_rns_buf, \
-                              self.reproduction_rns_buf.data, \
-
-                              self.dna_size_buf, \
-                              population.individuals_buf.data, \
-
-                              population.crossover_translation_mode_buf, \
-                              population.crossover_rotation_mode_buf, \
-                              population.crossover_probability_buf, \
-
-                              self.mutation_chance_buf, \
-                              population.mutation_probability_buf, \
-                              self.dock.ttl_torsions_buf, \
-                              self.dock.lo_grid_buf, \
-                              self.dock.dist_grid_buf, \
-
-                              self.chances_sum_buf.data, \
-                              self.dna1_buf.data, \
-                              self.dna2_buf.data, \
-
-                              population.new_individuals_buf.data)
+        self.generation += 1
+        kernel = self.cl_prg.reproduce
+        global_size = self.get_batch_population_size()
+        def launch(local_size):
+            return kernel(self.cl_queue, (global_size,), \
+                          local_size and (local_size,), \
+                          self.chances_sum_buf.data, \
+                          self.rng_key_buf, \
+                          np.uint32(self.generation), \
+
+                          population.individuals_buf.data, \
+
+                          population.crossover_translation_mode_buf, \
+                          population.crossover_rotation_mode_buf, \
+                          population.crossover_probability_buf, \
+
+                          self.mutation_chance_buf, \
+                          population.mutation_probability_buf, \
+                          self.dock.lo_grid_buf, \
+                          self.dock.dist_grid_buf, \
+
+                          population.new_individuals_buf.data)
+        launch(self.dock.get_flat_local_size(kernel, global_size, launch))
 
         cl.enqueue_copy(self.cl_queue, population.individuals_buf.data, \
                         population.new_individuals_buf.data)
 
-    def run(self):
-        self.setup()
-        # Define multiple population
-        self.nomad = self.Nomad(self.population_size, self.dna_size, \
-                                self.cl_ctx, self.cl_queue, \
-                                self.rng, self.cl_prg)
-        self.settler = self.Settler(self.population_size, self.dna_size, \
-                                    self.cl_ctx, self.cl_queue, \
-                                    self.rng, self.cl_prg)
-        population_min_scores = []
-        for community_idx in xrange(self.community_size):
-            tic = time()
-            # Nomad portion
-            nomad_min_score = float("inf")
-            self.nomad.create(self.dna_size_buf, self.dock)
-            if VERBOSE: print self.nomad
-            for gen_idx in xrange(self.num_gen):
-                self.select(self.nomad)
-                self.reproduce(self.nomad)
-            nomad_min_score = self.nomad.min_score(self.dock)
-
-            # Settler portion
-            settler_min_score = float("inf")
-            cl.enqueue_copy(self.cl_queue, self.settler.individuals_buf.data, \
-                            self.nomad.individuals_buf.data)
-            if VERBOSE: print self.settler
-            for gen_idx in xrange(self.num_gen):
-                self.select(self.settler)
-                self.reproduce(self.settler)
-            if VERBOSE: print self.settler
-            settler_min_score = self.settler.min_score(self.dock)
-
-            population_min_scores.append([nomad_min_score, settler_min_score])
-            toc = time()
-            print "Elapsed time community %4d: %10.2f - Minimum Scores: %12.3f, %12.3f" \
-                  % (community_idx + 1, toc - tic, \
-                     nomad_min_score, settler_min_score)
-
-        print "Community Minimum Scores: %s" % population_min_scores
+    # Enqueue the communities of a batch starting from first_community_idx
+    # without waiting for the device. The last batch may run beyond the
+    # community size, whose extra communities are discarded.
+    def enqueue_batch(self, first_community_idx):
+        batch = self.Batch(first_community_idx, \
+                           min(self.batch_size, \
+                               self.community_size - first_community_idx))
+        # Results of the previous batch have to be read before its buffers are
+        # overwritten
+        if self.pending_reads:
+            cl.enqueue_barrier(self.cl_queue, wait_for = self.pending_reads)
+        self.setup_rng(first_community_idx)
+        self.generation = 0
+        self.reset_elite()
+        # Nomad portion
+        self.nomad.create(self.dock, self.generation)
+        if VERBOSE: print self.nomad
+        for gen_idx in xrange(self.num_gen):
+            self.select(self.nomad)
+            self.reproduce(self.nomad)
+        self.nomad.find_best(self.dock)
+
+        # Settler portion
+        cl.enqueue_copy(self.cl_queue, self.settler.individuals_buf.data, \
+                        self.nomad.individuals_buf.data)
+        if VERBOSE: print self.settler
+        for gen_idx in xrange(self.num_gen):
+            self.select(self.settler)
+            self.reproduce(self.settler)
+        if VERBOSE: print self.settler
+        self.settler.find_best(self.dock)
+
+        self.enqueue_read_results(batch)
+        return batch
+
+    # Read minimum scores and elites (ascending scores and individuals of the
+    # archive) of the batch once all of its kernels complete. Only these are
+    # transferred from the device.
+    def enqueue_read_results(self, batch):
+        batch_done = cl.enqueue_marker(self.cl_queue)
+        batch.nomad_min_scores_np = np.empty(self.batch_size, \
+                                             dtype = self.dock.get_accum_dtype())
+        batch.settler_min_scores_np = np.empty(self.batch_size, \
+                                               dtype = self.dock.get_accum_dtype())
+        batch.elite_scores_np = np.empty((self.batch_size, self.elite_size), \
+                                         dtype = self.dock.get_accum_dtype())
+        batch.elite_individuals_np = np.empty((self.batch_size, self.elite_size, \
+                                               self.dna_size), \
+                                              dtype = self.dock.get_real_dtype())
+        reads = [(batch.nomad_min_scores_np, self.nomad.best_score_buf), \
+                 (batch.settler_min_scores_np, self.settler.best_score_buf), \
+                 (batch.elite_scores_np, self.elite_scores_buf), \
+                 (batch.elite_individuals_np, self.elite_individuals_buf)]
+        batch.read_events = [cl.enqueue_copy(self.cl_transfer_queue, \
+                                             host_np, device_buf.data, \
+                                             is_blocking = False, \
+                                             wait_for = [batch_done]) \
+                             for host_np, device_buf in reads]
+        self.pending_reads = batch.read_events
+        self.cl_queue.flush()
+        self.cl_transfer_queue.flush()
+
+    # Wait for the results of a batch and return them in community order.
+    # Elapsed time of the batch runs from its start on the device, at the
+    # earliest when the previous batch finished, and is shared evenly by its
+    # communities.
+    def collect_batch(self, batch):
+        cl.wait_for_events(batch.read_events)
+        toc = time()
+        elapsed_time = toc - max(batch.tic, self.collect_time)
+        self.collect_time = toc
+
+        results = []
+        for idx in xrange(batch.ttl_communities):
+            self.community_elites.append((batch.elite_scores_np[idx], \
+                                          batch.elite_individuals_np[idx]))
+            if VERBOSE: print "Elite scores:", batch.elite_scores_np[idx]
+            results.append(([batch.nomad_min_scores_np[idx], \
+                             batch.settler_min_scores_np[idx]], \
+                            elapsed_time / batch.ttl_communities))
+        return results
+
+    # OpenCL contexts cannot be shared with forked processes, so batches of
+    # communities run one after another on the device. Batches are
+    # pipelined: the next batch is enqueued before the results of the
+    # previous one are collected, so the host collects and logs results
+    # while the device runs the next batch.
+    def run_communities(self):
+        batch = None
+        for first_community_idx in xrange(0, self.community_size, \
+                                          self.batch_size):
+            next_batch = self.enqueue_batch(first_community_idx)
+            if batch is not None:
+                for result in self.collect_batch(batch):
+                    yield result
+            batch = next_batch
+        if batch is not None:
+            for result in self.collect_batch(batch):
+                yield result
+
+# Genetic algorithm running its communities on several OpenCL devices at once
+# (all devices of all platforms by default). Every device gets its own
+# GeneticAlgorithmOpenCL worker with its own context, device buffers and
+# copy of the molecules and maps. Batches of communities are assigned one by
+# one to the device expected to complete them first, based on its last
+# measured batch time, so a slow device is left idle rather than holding up
+# the last batches of a faster one.
+class GeneticAlgorithmMultiDevice(GeneticAlgorithm):
+    # Batches enqueued on a device at a time, the one running and the next one
+    MAX_QUEUED_BATCHES = 2
+    # Parameters passed on to the device workers
+    WORKER_PARAMETERS = ["community_size", "population_size", "num_gen", \
+                         "max_inherited_prob", "elite_size", "batch_size"]
+
+    def __init__(self, dock = None, program_cache = None, cl_devices = None):
+        GeneticAlgorithm.__init__(self, dock)
+        self.program_cache = program_cache
+        if cl_devices is None:
+            cl_devices = [cl_device for platform in cl.get_platforms() \
+                          for cl_device in platform.get_devices()]
+        self.cl_devices = cl_devices
+        self.elite_size = 10
+        self.batch_size = 1
+        self.workers = []
+        # Load balancing state per worker: batches enqueued (oldest first),
+        # last measured batch time (None until measured) and estimated time
+        # the enqueued batches complete
+        self.queued_batches = []
+        self.batch_times = []
+        self.free_times = []
+        self.next_community_idx = 0
+        # Set by the device whenever a result read of any batch completes
+        self.read_completed = threading.Event()
+        # Elite scores and individuals of every community run
+        self.community_elites = []
 
+    def setup(self):
+        GeneticAlgorithm.setup(self)
+        self.workers = []
+        for cl_device in self.cl_devices:
+            print "OpenCL device: %s (%s)" % (cl_device.name, \
+                                              cl_device.platform.name)
+            worker = GeneticAlgorithmOpenCL(self.copy_dock(), None, \
+                                            self.program_cache, cl_device)
+            for name in self.WORKER_PARAMETERS:
+                setattr(worker, name, getattr(self, name))
+            worker.setup()
+            self.workers.append(worker)
+
+    # Docking object of a worker. Setting up the device buffers resets the
+    # atoms of the ligand and protein, so every worker gets its own ligand,
+    # protein and grid (with the maps). Bond tables and non-bond lists are
+    # only read and stay shared. The torsion tree is built again from the
+    # copied molecules.
+    def copy_dock(self):
+        dock = copy.copy(self.dock)
+        dock.ligand, dock.protein, dock.grid = \
+            copy.deepcopy((self.dock.ligand, self.dock.protein, self.dock.grid))
+        dock.torsion_tree = None
+        dock.sorted_branches = []
+        return dock
+
+    # Time a new batch on the worker would complete
+    def get_completion_time(self, worker_idx, now):
+        batch_time = self.batch_times[worker_idx]
+        if batch_time is None:
+            # Unmeasured workers take a single batch first
+            if self.queued_batches[worker_idx]:
+                return float("inf")
+            return now
+        return max(self.free_times[worker_idx], now) + batch_time
+
+    # Assign the remaining batches one by one to the worker that would
+    # complete them first. Assigning stops when that worker has no room in
+    # its queue, so other workers stay idle rather than delaying the run.
+    def assign_batches(self):
+        now = time()
+        while self.next_community_idx < self.community_size:
+            completion_times = [self.get_completion_time(worker_idx, now) \
+                                for worker_idx in xrange(len(self.workers))]
+            worker_idx = int(np.argmin(completion_times))
+            if completion_times[worker_idx] == float("inf") or \
+               len(self.queued_batches[worker_idx]) >= self.MAX_QUEUED_BATCHES:
+                break
+            batch = self.workers[worker_idx].enqueue_batch(self.next_community_idx)
+            for event in batch.read_events:
+                event.set_callback(cl.command_execution_status.COMPLETE, \
+                                   self.notify_read_completed)
+            self.queued_batches[worker_idx].append(batch)
+            self.free_times[worker_idx] = completion_times[worker_idx]
+            self.next_community_idx += self.batch_size
+
+    # Called from an OpenCL runtime thread
+    def notify_read_completed(self, status):
+        self.read_completed.set()
+
+    # Worker index and the oldest batch of a worker that has completed. The
+    # host sleeps until a result read completes. The flag is cleared before
+    # checking the batches, so a read completing during the check wakes the
+    # host up again right away.
+    def wait_any_batch(self):
+        while True:
+            self.read_completed.clear()
+            for worker_idx, batches in enumerate(self.queued_batches):
+                if batches and \
+                   all(event.command_execution_status <= \
+                       cl.command_execution_status.COMPLETE \
+                       for event in batches[0].read_events):
+                    return worker_idx, batches[0]
+            self.read_completed.wait()
+
+    # Results are yielded in community order, whichever device ran them
+    def run_communities(self):
+        self.queued_batches = [[] for worker in self.workers]
+        self.batch_times = [None] * len(self.workers)
+        self.free_times = [0.0] * len(self.workers)
+        self.next_community_idx = 0
+        completed = {}
+        next_yield_idx = 0
+        self.assign_batches()
+        while next_yield_idx < self.community_size:
+            worker_idx, batch = self.wait_any_batch()
+            results = self.workers[worker_idx].collect_batch(batch)
+            self.queued_batches[worker_idx].pop(0)
+            # Rebalance with the measured batch time of the worker
+            batch_time = sum(elapsed_time for min_scores, elapsed_time in results)
+            self.batch_times[worker_idx] = batch_time
+            self.free_times[worker_idx] = time() + \
+                                          (batch_time * \
+                                           len(self.queued_batches[worker_idx]))
+            for idx, result in enumerate(results):
+                completed[batch.first_community_idx + idx] = \
+                    (result, (batch.elite_scores_np[idx], \
+                              batch.elite_individuals_np[idx]))
+            self.assign_batches()
+
+            while next_yield_idx in completed:
+                result, elite = completed.pop(next_yield_idx)
+                self.community_elites.append(elite)
+                next_yield_idx += 1
+                yield result
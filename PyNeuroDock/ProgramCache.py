@@ -0,0 +1,125 @@
+# Copyright (C) 2013 by Eka A. Kurniawan
+# eka.a.kurniawan(ta)gmail(tod)com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+# References:
+#  - PyOpenCL Program (binaries and program_info.BINARIES)
+#    http://documen.tician.de/pyopencl/runtime.html#program
+
+import os
+import hashlib
+from time import time
+import pyopencl as cl
+from CacheFile import make_dirs, write_atomic
+
+# OpenCL Program Cache
+# --------------------
+# Building OpenCL programs from source takes seconds with CPU runtimes, which
+# dominates startup of short docking jobs. The cache stores the program
+# binaries once built and reloads them on later runs.
+#
+# Programs are keyed by the hash of kernel source, build options and, for
+# every device of the context, platform, device name and driver version. Each
+# cached program consists of files inside the cache directory:
+#  - <program name>.<key digest>.<device index>.bin: program binary
+#  - <program name>.<key digest>.key: key digest and build time in seconds
+class ProgramCache:
+    DEFAULT_DIR = "./OpenCL/Cache"
+
+    def __init__(self, cache_dir = DEFAULT_DIR):
+        self.cache_dir = cache_dir
+        # Cache statistics
+        self.hits = 0
+        self.misses = 0
+        self.time_saved = 0.0
+
+    @staticmethod
+    def calc_key_digest(cl_ctx, cl_code, options):
+        key_hash = hashlib.sha1()
+        key_hash.update(cl_code)
+        key_hash.update(" ".join(options))
+        for device in cl_ctx.devices:
+            key_hash.update("\n%s\n%s\n%s\n%s" % (device.platform.name, \
+                                                  device.platform.version, \
+                                                  device.name, \
+                                                  device.driver_version))
+        return key_hash.hexdigest()
+
+    def get_cache_filenames(self, name, key_digest, ttl_devices):
+        basename = "%s.%s" % (name, key_digest[:16])
+        basename = os.path.join(self.cache_dir, basename)
+        bin_filenames = ["%s.%d.bin" % (basename, i) \
+                         for i in xrange(ttl_devices)]
+        return bin_filenames, basename + ".key"
+
+    # Key format (one item per line): key digest, build time
+    @staticmethod
+    def read_key(key_filename):
+        try:
+            with open(key_filename, 'r') as p_file:
+                lines = p_file.read().split('\n')
+            return {'digest': lines[0], \
+                    'build_time': float(lines[1])}
+        except (IOError, IndexError, ValueError):
+            return None
+
+    @staticmethod
+    def read_binaries(bin_filenames):
+        binaries = []
+        for bin_filename in bin_filenames:
+            with open(bin_filename, 'rb') as p_file:
+                binaries.append(p_file.read())
+        return binaries
+
+    # Return program built from cl_code for all devices of cl_ctx, reusing
+    # the cached binaries when the key matches. Name identifies the program
+    # in cache filenames and log messages.
+    def build(self, cl_ctx, cl_code, name, options = []):
+        make_dirs(self.cache_dir)
+        devices = cl_ctx.devices
+        key_digest = self.calc_key_digest(cl_ctx, cl_code, options)
+        bin_filenames, key_filename = self.get_cache_filenames(name, \
+                                                               key_digest, \
+                                                               len(devices))
+        key = self.read_key(key_filename)
+        if key is not None and key['digest'] == key_digest:
+            tic = time()
+            try:
+                binaries = self.read_binaries(bin_filenames)
+                cl_prg = cl.Program(cl_ctx, devices, binaries).build(options)
+            except (IOError, cl.Error):
+                # Missing or rejected binaries are rebuilt from source
+                cl_prg = None
+            if cl_prg is not None:
+                time_saved = max(key['build_time'] - (time() - tic), 0.0)
+                self.hits += 1
+                self.time_saved += time_saved
+                print "OpenCL program cache hit: %s (%.2f s saved)" % \
+                      (name, time_saved)
+                return cl_prg
+
+        tic = time()
+        cl_prg = cl.Program(cl_ctx, cl_code).build(options)
+        build_time = time() - tic
+        self.misses += 1
+        print "OpenCL program cache miss: %s (built in %.2f s)" % \
+              (name, build_time)
+        binaries = cl_prg.get_info(cl.program_info.BINARIES)
+        for bin_filename, binary in zip(bin_filenames, binaries):
+            write_atomic(bin_filename, lambda p_file: p_file.write(binary))
+        key = "%s\n%r\n" % (key_digest, build_time)
+        write_atomic(key_filename, lambda p_file: p_file.write(key), 'w')
+        return cl_prg
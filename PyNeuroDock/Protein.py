@@ -21,7 +21,6 @@
 
 from Atom import Atom, Branch
 from Axis3 import Axis3
-from copy import deepcopy
 import numpy as np
 
 class Protein:
@@ -30,6 +29,9 @@ class Protein:
         self.ori_flex_atoms = []
         # Modified flexible (rotatable) atom locations for energy calculation
         self.flex_atoms = []
+        # Coordinates of ori_flex_atoms and flex_atoms as (N, 3) arrays
+        self.ori_flex_tcoords = np.zeros((0, 3), dtype = float)
+        self.flex_tcoords = np.zeros((0, 3), dtype = float)
         # flexible (rotatable) branches
         self.flex_branches = []
 
@@ -37,6 +39,9 @@ class Protein:
         self.ori_rigid_atoms = []
         # Modified rigid atom locations for energy calculation
         self.rigid_atoms = []
+        # Coordinates of ori_rigid_atoms and rigid_atoms as (N, 3) arrays
+        self.ori_rigid_tcoords = np.zeros((0, 3), dtype = float)
+        self.rigid_tcoords = np.zeros((0, 3), dtype = float)
 
         self.root = None
         # Exclude the atom and the first atom branching out of root from
@@ -130,13 +135,33 @@ class Protein:
 
         self.reset_flex_atoms()
 
-    # Reset atoms information (including location) from original atoms
-    # information
+    # Create atoms from original atoms, with coordinates of both stored in
+    # arrays
+    def setup_flex_atoms(self):
+        self.ori_flex_tcoords = Atom.bind_tcoords(self.ori_flex_atoms)
+        self.flex_atoms = [atom.copy() for atom in self.ori_flex_atoms]
+        self.flex_tcoords = Atom.bind_tcoords(self.flex_atoms)
+
+    def setup_rigid_atoms(self):
+        self.ori_rigid_tcoords = Atom.bind_tcoords(self.ori_rigid_atoms)
+        self.rigid_atoms = [atom.copy() for atom in self.ori_rigid_atoms]
+        self.rigid_tcoords = Atom.bind_tcoords(self.rigid_atoms)
+
+    # Reset atom locations from original atoms. Atoms are created once, after
+    # that only their coordinates are copied.
     def reset_flex_atoms(self):
-        self.flex_atoms = deepcopy(self.ori_flex_atoms)
+        if len(self.flex_atoms) != len(self.ori_flex_atoms) or \
+           len(self.ori_flex_tcoords) != len(self.ori_flex_atoms):
+            self.setup_flex_atoms()
+        else:
+            self.flex_tcoords[:] = self.ori_flex_tcoords
 
     def reset_rigid_atoms(self):
-        self.rigid_atoms = deepcopy(self.ori_rigid_atoms)
+        if len(self.rigid_atoms) != len(self.ori_rigid_atoms) or \
+           len(self.ori_rigid_tcoords) != len(self.ori_rigid_atoms):
+            self.setup_rigid_atoms()
+        else:
+            self.rigid_tcoords[:] = self.ori_rigid_tcoords
 
     def get_flex_atom_tcoords(self):
         tcoords = []
@@ -145,18 +170,10 @@ class Protein:
         return tcoords
 
     def get_flex_atom_tcoords_in_numpy(self):
-        tcoords = np.array([[0., 0., 0.] for i in xrange(len(self.flex_atoms))], \
-                           dtype = float)
-        for idx, atom in enumerate(self.flex_atoms):
-            tcoords[idx] = atom.tcoord.xyz
-        return tcoords
+        return self.flex_tcoords.copy()
 
     def get_rigid_atom_tcoords_in_numpy(self):
-        tcoords = np.array([[0., 0., 0.] for i in xrange(len(self.rigid_atoms))], \
-                           dtype = float)
-        for idx, atom in enumerate(self.rigid_atoms):
-            tcoords[idx] = atom.tcoord.xyz
-        return tcoords
+        return self.rigid_tcoords.copy()
 
     def set_flex_atom_tcoords(self, tcoords):
         for i, tcoord in enumerate(tcoords):
@@ -26,6 +26,7 @@
 
 
 import math
+import numpy as np
 import Constants as const
 from Axis3 import Axis3
 
@@ -69,6 +70,25 @@ class Quaternion:
         self.d = math.sin(t2) * r2
         self.a = math.cos(t2) * r2
 
+    # Array counterpart of uniform. Returns quaternions (..., 4) in (a, b, c, d)
+    # order from rands (..., 3) holding, per quaternion, the three zero_to_one
+    # numbers in the order uniform draws them.
+    @staticmethod
+    def uniform_in_numpy(rands):
+        x0 = rands[..., 0]
+        r1 = np.sqrt(1.0 - x0)
+        r2 = np.sqrt(x0)
+
+        t1 = rands[..., 1] * const.TWOPI
+        t2 = rands[..., 2] * const.TWOPI
+
+        rotations = np.empty(np.shape(rands)[:-1] + (4,))
+        rotations[..., 0] = np.cos(t2) * r2
+        rotations[..., 1] = np.sin(t1) * r1
+        rotations[..., 2] = np.cos(t1) * r1
+        rotations[..., 3] = np.sin(t2) * r2
+        return rotations
+
     def __mul__(self, other):
         Aa = self.a
         Ab = self.b
@@ -100,6 +120,25 @@ class Quaternion:
         self.d =  Ab * Bc - Ac * Bb + Ad * Ba + Aa * Bd
         return self
 
+    # Array counterpart of __mul__ for quaternions (..., 4) in (a, b, c, d)
+    # order
+    @staticmethod
+    def mul_in_numpy(q1, q2):
+        Aa = q1[..., 0]
+        Ab = q1[..., 1]
+        Ac = q1[..., 2]
+        Ad = q1[..., 3]
+        Ba = q2[..., 0]
+        Bb = q2[..., 1]
+        Bc = q2[..., 2]
+        Bd = q2[..., 3]
+        q = np.empty(np.broadcast(q1, q2).shape)
+        q[..., 0] = -Ab * Bb - Ac * Bc - Ad * Bd + Aa * Ba
+        q[..., 1] =  Ab * Ba + Ac * Bd - Ad * Bc + Aa * Bb
+        q[..., 2] = -Ab * Bd + Ac * Ba + Ad * Bb + Aa * Bc
+        q[..., 3] =  Ab * Bc - Ac * Bb + Ad * Ba + Aa * Bd
+        return q
+
     def __abs__(self):
         return math.sqrt(self.a * self.a + \
                          self.b * self.b + \
@@ -187,6 +226,75 @@ class Quaternion:
 
         return new_tcoords
 
+    # Array counterpart of transform. Applies rotations (..., 4) in (a, b, c, d)
+    # order and translations (..., 3) to coordinates tcoords (..., N, 3), one
+    # rotation and translation per block of N coordinates.
+    @staticmethod
+    def transform_in_numpy(translations, rotations, tcoords):
+        a = rotations[..., 0, np.newaxis]
+        b = rotations[..., 1, np.newaxis]
+        c = rotations[..., 2, np.newaxis]
+        d = rotations[..., 3, np.newaxis]
+
+        db = b + b
+        dc = c + c
+        dd = d + d
+
+        a_db = a * db
+        a_dc = a * dc
+        a_dd = a * dd
+
+        b_db_i = 1.0 - (b * db)
+
+        c_db = c * db
+        c_dc = c * dc
+        c_dc_i = 1.0 - c_dc
+
+        d_db = d * db
+        d_dc = d * dc
+        d_dd = d * dd
+
+        r_xx = c_dc_i - d_dd
+        r_xy = c_db   + a_dd
+        r_xz = d_db   - a_dc
+        r_yx = c_db   - a_dd
+        r_yy = b_db_i - d_dd
+        r_yz = d_dc   + a_db
+        r_zx = d_db   + a_dc
+        r_zy = d_dc   - a_db
+        r_zz = b_db_i - c_dc
+
+        tx = tcoords[..., 0]
+        ty = tcoords[..., 1]
+        tz = tcoords[..., 2]
+
+        new_tcoords = np.empty(np.broadcast(tcoords, \
+                                            translations[..., np.newaxis, :]).shape)
+        new_tcoords[..., 0] = tx * r_xx + ty * r_xy + tz * r_xz + \
+                              translations[..., 0, np.newaxis]
+        new_tcoords[..., 1] = tx * r_yx + ty * r_yy + tz * r_yz + \
+                              translations[..., 1, np.newaxis]
+        new_tcoords[..., 2] = tx * r_zx + ty * r_zy + tz * r_zz + \
+                              translations[..., 2, np.newaxis]
+        return new_tcoords
+
+    # Array counterpart of set_angle_axis. Returns quaternions (..., 4) in
+    # (a, b, c, d) order for angles (...) and axes (..., 3).
+    @staticmethod
+    def from_angle_axis_in_numpy(angles, axes):
+        half_angles = angles / 2
+        mag_xyz = np.sqrt(axes[..., 0] * axes[..., 0] + \
+                          axes[..., 1] * axes[..., 1] + \
+                          axes[..., 2] * axes[..., 2])
+        mag_xyz = np.where(mag_xyz > const.APPROX_ZERO, mag_xyz, 1.0)
+        s = np.sin(half_angles)
+        rotations = np.empty(np.shape(angles) + (4,))
+        rotations[..., 0] = np.cos(half_angles)
+        rotations[..., 1] = (axes[..., 0] / mag_xyz) * s
+        rotations[..., 2] = (axes[..., 1] / mag_xyz) * s
+        rotations[..., 3] = (axes[..., 2] / mag_xyz) * s
+        return rotations
+
     # Returns angle and axis
     # By convention, angle is in radians ranging from -pi to pi
     # Example:
@@ -20,7 +20,11 @@ from Ligand import Ligand
 from Protein import Protein
 from Grid import Grid, Field
 from Map import ElectrostaticMap, DesolvationMap, AtomTypeMap
-from Dock import Dock
+from Dock import Dock, DockOpenCL
+from Atom import TorsionTree
+from Axis3 import Axis3
+from Quaternion import Quaternion
+import numpy as np
 
 class DockCalcLinInterp3(unittest.TestCase):
     def testCalcLinInterp3(self):
@@ -376,10 +380,122 @@ class DockCalcEnergy(unittest.TestCase):
         self.assertLessEqual(dock.emap_total - exp_emap_total, 0.0000000001)
         self.assertGreaterEqual(dock.emap_total - exp_emap_total, -0.0000000001)
 
+class DockScoreBatch(unittest.TestCase):
+    def testScoreBatch(self):
+        ligand = Ligand()
+        ligand.read_pdbqt("./Inputs/ind.pdbqt")
+        # Zero-out central point
+        about = Axis3(0.3689, -0.2148, -4.9865)
+        for atom in ligand.ori_atoms:
+            atom.tcoord -= about
+        ligand.reset_atoms()
+
+        grid = Grid()
+        grid.field = Field("./Parameters/hsg1_rigid.maps.fld")
+        grid.maps['e'] = ElectrostaticMap("./Maps/hsg1_rigid.e.map", grid.field).map
+        grid.maps['d'] = DesolvationMap("./Maps/hsg1_rigid.d.map", grid.field).map
+        grid.maps['A'] = AtomTypeMap("./Maps/hsg1_rigid.A.map", grid.field).map
+        grid.maps['C'] = AtomTypeMap("./Maps/hsg1_rigid.C.map", grid.field).map
+        grid.maps['HD'] = AtomTypeMap("./Maps/hsg1_rigid.HD.map", grid.field).map
+        grid.maps['N'] = AtomTypeMap("./Maps/hsg1_rigid.N.map", grid.field).map
+        grid.maps['NA'] = AtomTypeMap("./Maps/hsg1_rigid.NA.map", grid.field).map
+        grid.maps['OA'] = AtomTypeMap("./Maps/hsg1_rigid.OA.map", grid.field).map
+
+        dock = Dock()
+        dock.ligand = ligand
+        dock.grid = grid
+
+        ttl_torsions = dock.get_total_torsions()
+        # Around grid center and far out of grid
+        translations = [[2.5, 6.5, -7.5], [2.6, 6.3, -7.2], [52.5, 6.5, -7.5]]
+        rotation = Quaternion()
+        rotation.set_angle_axis(0.3, Axis3(0.2, 0.5, 0.8))
+        rotations = [[1.0, 0.0, 0.0, 0.0], \
+                     [rotation.a, rotation.b, rotation.c, rotation.d], \
+                     [1.0, 0.0, 0.0, 0.0]]
+        torsions = [[0.0] * ttl_torsions, \
+                    [0.1 * i for i in xrange(ttl_torsions)], \
+                    [0.0] * ttl_torsions]
+        genomes = np.array([translations[i] + rotations[i] + torsions[i] \
+                            for i in xrange(3)])
+
+        exp_energies = []
+        for i in xrange(3):
+            if dock.reset_pose(Axis3(*translations[i]), \
+                               Quaternion(*rotations[i]), torsions[i]):
+                exp_energies.append(dock.calc_energy())
+            else:
+                exp_energies.append(float("inf"))
+        self.assertEquals(exp_energies[2], float("inf"))
+        self.assertEquals(dock.score_batch(genomes).tolist(), exp_energies)
+
+class DockTorsionTree(unittest.TestCase):
+    def testBuild(self):
+        ligand = Ligand()
+        ligand.read_pdbqt("./Inputs/ind.pdbqt")
+        tree = TorsionTree(ligand, Protein())
+
+        self.assertEquals(tree.ttl_torsions, 6)
+        self.assertEquals(tree.anchors.tolist(), [10, 18, 5, 13, 36, 0])
+        self.assertEquals(tree.links.tolist(), [28, 47, 43, 30, 37, 36])
+        self.assertEquals(tree.levels.tolist(), [0, 0, 0, 0, 0, 1])
+        self.assertEquals(tree.get_branch_atoms(4).tolist(), \
+                          [38, 39, 40, 41, 42])
+        self.assertEquals(tree.get_branch_atoms(5).tolist(), \
+                          [37, 38, 39, 40, 41, 42])
+
+        self.assertEquals(tree.ttl_levels, 2)
+        level_atoms, level_torsions = tree.get_level_atoms(1)
+        self.assertEquals(level_atoms.tolist(), [37, 38, 39, 40, 41, 42])
+        self.assertEquals(level_torsions.tolist(), [5, 5, 5, 5, 5, 5])
+        level_atoms, level_torsions = tree.get_level_atoms(0)
+        self.assertEquals(level_torsions.tolist(), \
+                          [0, 1, 2, 2, 2, 3, 3, 3, 3, 3, 4, 4, 4, 4, 4])
+
+class DockOpenCLChunkSize(unittest.TestCase):
+    # Device memory sizes read by the chunk sizing
+    class Device:
+        def __init__(self, global_mem_size, max_mem_alloc_size):
+            self.global_mem_size = global_mem_size
+            self.max_mem_alloc_size = max_mem_alloc_size
+
+    def testChunkSize(self):
+        ligand = Ligand()
+        ligand.read_pdbqt("./Inputs/ind.pdbqt")
+        dock = DockOpenCL()
+        dock.ligand = ligand
+        # Poses and 3 energy totals per pose in double precision
+        poses_bytes = (dock.get_total_atoms() + 1) * 3 * 8
+        pose_bytes = poses_bytes + (3 * 8)
+
+        # Whole population fits into the device memory
+        device = self.Device(1 << 40, 1 << 40)
+        self.assertEquals(dock.get_chunk_size(300, device), 300)
+        # Chunks of even size within the pool share of the global memory, the
+        # last one running beyond the population
+        pool_bytes = 100 * pose_bytes * dock.CHUNK_POOL_SIZE
+        device = self.Device(int(pool_bytes / dock.CHUNK_MEMORY_FRACTION), \
+                             1 << 40)
+        self.assertEquals(dock.get_chunk_size(300, device), 100)
+        self.assertEquals(dock.get_chunk_size(250, device), 84)
+        # Within the largest buffer the device allocates
+        device = self.Device(1 << 40, 50 * poses_bytes)
+        self.assertEquals(dock.get_chunk_size(300, device), 50)
+        # Within the given limit
+        dock.max_chunk_poses = 7
+        self.assertEquals(dock.get_chunk_size(150, device), 7)
+        self.assertEquals(dock.get_chunk_size(3, device), 3)
+        # Fused scoring keeps poses in local memory
+        dock.scoring = "fused"
+        self.assertEquals(dock.get_chunk_size(300, device), 300)
+
 def suite():
     suite1 = unittest.makeSuite(DockCalcLinInterp3)
     suite2 = unittest.makeSuite(DockCalcEnergy)
-    return unittest.TestSuite((suite1, suite2))
+    suite3 = unittest.makeSuite(DockScoreBatch)
+    suite4 = unittest.makeSuite(DockTorsionTree)
+    suite5 = unittest.makeSuite(DockOpenCLChunkSize)
+    return unittest.TestSuite((suite1, suite2, suite3, suite4, suite5))
 
 if __name__ == '__main__':
     unittest.main()
@@ -18,6 +18,7 @@
 import unittest
 from Grid import Grid, Field
 from Axis3 import Axis3
+import numpy as np
 
 class ParametersField(unittest.TestCase):
     def testRead(self):
@@ -31,9 +32,25 @@ class ParametersField(unittest.TestCase):
         self.assertEquals(str(field.lo), str(Axis3(-8.750, -4.750, -18.750)))
         self.assertEquals(str(field.hi), str(Axis3(13.750, 17.750, 3.750)))
 
+class GridFlatMaps(unittest.TestCase):
+    def testFlatMaps(self):
+        grid = Grid()
+        grid.maps['e'] = np.arange(8, dtype = float).reshape(2, 2, 2)
+        flat_maps = grid.get_flat_maps()
+        self.assertEquals(flat_maps['e'].tolist(), range(8))
+        # Views of the maps, not copies
+        self.assertTrue(np.may_share_memory(flat_maps['e'], grid.maps['e']))
+        # Replaced and added maps are flattened again
+        grid.maps['e'] = np.zeros((2, 2, 2))
+        grid.maps['d'] = np.ones((2, 2, 2))
+        flat_maps = grid.get_flat_maps()
+        self.assertEquals(flat_maps['e'].tolist(), [0.0] * 8)
+        self.assertEquals(flat_maps['d'].tolist(), [1.0] * 8)
+
 def suite():
     suite1 = unittest.makeSuite(ParametersField)
-    return unittest.TestSuite((suite1, ))
+    suite2 = unittest.makeSuite(GridFlatMaps)
+    return unittest.TestSuite((suite1, suite2))
 
 if __name__ == '__main__':
     unittest.main()
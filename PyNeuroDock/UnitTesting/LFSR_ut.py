@@ -73,9 +73,22 @@ class LfsrTestGenerate(unittest.TestCase):
         for i in xrange(9):
             self.assertEquals(lfsr.sign(), exp[i])
 
+class LfsrTestJump(unittest.TestCase):
+    def testJump(self):
+        for bit_len in [16, 48]:
+            for steps in [0, 1, 2, 1000, 12345]:
+                lfsr = LFSR(lfsr = 1070, bit_len = bit_len)
+                for i in xrange(steps):
+                    lfsr.generate()
+                jumped_lfsr = LFSR(lfsr = 1070, bit_len = bit_len)
+                jumped_lfsr.jump(steps)
+                self.assertEquals(jumped_lfsr.lfsr, lfsr.lfsr)
+                self.assertEquals(jumped_lfsr.generate(), lfsr.generate())
+
 def suite():
     suite1 = unittest.makeSuite(LfsrTestGenerate)
-    return unittest.TestSuite((suite1, ))
+    suite2 = unittest.makeSuite(LfsrTestJump)
+    return unittest.TestSuite((suite1, suite2, ))
 
 if __name__ == '__main__':
     unittest.main()
@@ -17,6 +17,7 @@
 
 import unittest
 from Ligand import Ligand
+from Axis3 import Axis3
 
 class LigandAtoms(unittest.TestCase):
     def testRead(self):
@@ -288,9 +289,31 @@ class LigandAtoms(unittest.TestCase):
         for i, atom in enumerate(ligand.atoms):
             self.assertEquals(str(atom.tcoord), exp[i])
 
+class LigandTcoords(unittest.TestCase):
+    def testResetAtoms(self):
+        ligand = Ligand()
+        ligand.read_pdbqt("./Inputs/ind.pdbqt")
+        atoms = ligand.atoms
+        tcoords = ligand.tcoords
+
+        ligand.atoms[0].tcoord = Axis3(1.0, 2.0, 3.0)
+        ligand.atoms[1].tcoord.xyz = [4.0, 5.0, 6.0]
+        self.assertEquals(ligand.tcoords[0].tolist(), [1.0, 2.0, 3.0])
+        self.assertEquals(ligand.tcoords[1].tolist(), [4.0, 5.0, 6.0])
+        self.assertNotEquals(ligand.ori_atoms[0].tcoord.xyz, [1.0, 2.0, 3.0])
+
+        # Atoms and coordinate array are reused, only coordinates are reset
+        ligand.reset_atoms()
+        self.assertIs(ligand.atoms, atoms)
+        self.assertIs(ligand.tcoords, tcoords)
+        self.assertEquals(ligand.tcoords.tolist(), ligand.ori_tcoords.tolist())
+        for i, atom in enumerate(ligand.atoms):
+            self.assertEquals(atom.tcoord.xyz, ligand.ori_atoms[i].tcoord.xyz)
+
 def suite():
     suite1 = unittest.makeSuite(LigandAtoms)
-    return unittest.TestSuite((suite1, ))
+    suite2 = unittest.makeSuite(LigandTcoords)
+    return unittest.TestSuite((suite1, suite2))
 
 if __name__ == '__main__':
     unittest.main()
@@ -16,7 +16,12 @@
 # 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
 import unittest
-from Map import ElectrostaticMap, DesolvationMap, AtomTypeMap
+import os
+import shutil
+import tempfile
+import numpy as np
+from Map import ElectrostaticMap, DesolvationMap, AtomTypeMap, MapCache, \
+                GridMapReader, GridMapError
 from Grid import Grid, Field
 
 class MapElectrostatic(unittest.TestCase):
@@ -208,11 +213,108 @@ class MapAtomType(unittest.TestCase):
         for i in xrange(10):
             self.assertEquals(em.map[60][60][51 + i], exp[i])
 
+class MapGridMapReader(unittest.TestCase):
+    def testReadHeader(self):
+        field = Field()
+        field.read("./Parameters/hsg1_rigid.maps.fld")
+        gm = GridMapReader("./Maps/hsg1_rigid.OA.map", field)
+        self.assertEquals(gm.spacing, 0.375)
+        self.assertEquals(gm.num_points.xyz, [60, 60, 60])
+        self.assertEquals(gm.center.xyz, [2.5, 6.5, -7.5])
+        self.assertEquals(gm.map.shape, (61, 61, 61))
+
+    def testCheckField(self):
+        field = Field()
+        field.read("./Parameters/hsg1_rigid.maps.fld")
+        field.spacing = 0.5
+        self.assertRaises(GridMapError, GridMapReader, \
+                          "./Maps/hsg1_rigid.OA.map", field)
+        field.read("./Parameters/hsg1_rigid.maps.fld")
+        field.center.x = 0.0
+        self.assertRaises(GridMapError, GridMapReader, \
+                          "./Maps/hsg1_rigid.OA.map", field)
+
+class MapCacheRead(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def testRead(self):
+        field = Field()
+        field.read("./Parameters/hsg1_rigid.maps.fld")
+        exp = AtomTypeMap("./Maps/hsg1_rigid.C.map", field).map
+
+        # First read parses the map and stores it into the cache
+        map_cache = MapCache(self.cache_dir)
+        map = map_cache.read("./Maps/hsg1_rigid.C.map", field, AtomTypeMap)
+        self.assertEquals(map_cache.misses, 1)
+        self.assertEquals(map_cache.hits, 0)
+        self.assertTrue(np.array_equal(map, exp))
+
+        # Second read memory-maps the binary map
+        map_cache = MapCache(self.cache_dir)
+        map = map_cache.read("./Maps/hsg1_rigid.C.map", field, AtomTypeMap)
+        self.assertEquals(map_cache.misses, 0)
+        self.assertEquals(map_cache.hits, 1)
+        self.assertTrue(np.array_equal(map, exp))
+        self.assertFalse(map.flags.writeable)
+        self.assertEquals(map[0][5][10], 2165.672)
+
+    def testSourceChanged(self):
+        field = Field()
+        field.read("./Parameters/hsg1_rigid.maps.fld")
+        map_file = os.path.join(self.cache_dir, "hsg1_rigid.e.map")
+        shutil.copy("./Maps/hsg1_rigid.e.map", map_file)
+        map_cache = MapCache(self.cache_dir)
+        map_cache.read(map_file, field, ElectrostaticMap)
+
+        # Touching the source keeps the cached binary as the content is the
+        # same
+        stat = os.stat(map_file)
+        os.utime(map_file, (stat.st_atime, stat.st_mtime + 10))
+        map = map_cache.read(map_file, field, ElectrostaticMap)
+        self.assertEquals(map_cache.misses, 1)
+        self.assertEquals(map_cache.hits, 1)
+
+        # Replacing the source content invalidates the cached binary
+        shutil.copy("./Maps/hsg1_rigid.d.map", map_file)
+        os.utime(map_file, (stat.st_atime, stat.st_mtime + 20))
+        map = map_cache.read(map_file, field, ElectrostaticMap)
+        self.assertEquals(map_cache.misses, 2)
+        self.assertEquals(map[0][0][0], 0.704)
+
+    def testFieldMismatch(self):
+        field = Field()
+        field.read("./Parameters/hsg1_rigid.maps.fld")
+        map_cache = MapCache(self.cache_dir)
+        map_cache.read("./Maps/hsg1_rigid.C.map", field, AtomTypeMap)
+
+        # Cached maps are checked against the grid field as parsed maps are
+        bad_field = Field()
+        bad_field.read("./Parameters/hsg1_rigid.maps.fld")
+        bad_field.center.x = 9.5
+        self.assertRaises(GridMapError, map_cache.read, \
+                          "./Maps/hsg1_rigid.C.map", bad_field, AtomTypeMap)
+        self.assertEquals(map_cache.hits, 0)
+        # Also when the source has been touched
+        map_file = os.path.join(self.cache_dir, "hsg1_rigid.C.map")
+        shutil.copy("./Maps/hsg1_rigid.C.map", map_file)
+        map_cache.read(map_file, field, AtomTypeMap)
+        stat = os.stat(map_file)
+        os.utime(map_file, (stat.st_atime, stat.st_mtime + 10))
+        self.assertRaises(GridMapError, map_cache.read, \
+                          map_file, bad_field, AtomTypeMap)
+        self.assertEquals(map_cache.hits, 0)
+
 def suite():
     suite1 = unittest.makeSuite(MapElectrostatic)
     suite2 = unittest.makeSuite(MapDesolvation)
     suite3 = unittest.makeSuite(MapAtomType)
-    return unittest.TestSuite((suite1, suite2, suite3))
+    suite4 = unittest.makeSuite(MapGridMapReader)
+    suite5 = unittest.makeSuite(MapCacheRead)
+    return unittest.TestSuite((suite1, suite2, suite3, suite4, suite5))
 
 if __name__ == '__main__':
     unittest.main()
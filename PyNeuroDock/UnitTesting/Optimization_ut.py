@@ -0,0 +1,408 @@
+# Copyright (C) 2013 by Eka A. Kurniawan
+# eka.a.kurniawan(ta)gmail(tod)com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+import unittest
+from Optimization import GeneticAlgorithm, GeneticAlgorithmOpenCL, \
+                         GeneticAlgorithmMultiDevice
+from Axis3 import Axis3
+from LFSR import LFSR
+from Dock import DockOpenCL
+from Grid import Field
+from Map import ElectrostaticMap, DesolvationMap, AtomTypeMap
+import numpy as np
+import pyopencl as cl
+import pyopencl.array
+
+class GeneticAlgorithmSelect(unittest.TestCase):
+    def testPickParents(self):
+        ga = GeneticAlgorithm()
+        ga.ttl_ligand_atoms = 10
+        ga.rng = LFSR(lfsr = 1070, bit_len = 48)
+        scores = [-25.0, 0.5, 10.0, 2.0e6, float("inf"), 300.0]
+        chances = ga.calc_chances(scores)
+        self.assertEquals(chances.tolist(), [12, 14, 12, 1, 1, 8])
+
+        # Same parents as picking from the expanded mating pool
+        mating_pool = []
+        for idx, chance in enumerate(chances):
+            mating_pool += [idx] * chance
+        chances_sum = np.cumsum(chances)
+        rng = LFSR(lfsr = 1070, bit_len = 48)
+        parents_idx = ga.pick_parents(chances_sum, 50)
+        for parents in parents_idx.tolist():
+            for parent in parents:
+                self.assertEquals(parent, \
+                                  mating_pool[int(rng.zero_to_one() * \
+                                                  len(mating_pool))])
+
+class GeneticAlgorithmReproduce(unittest.TestCase):
+    def testCrossover(self):
+        rng = LFSR(lfsr = 1070, bit_len = 48)
+        for population in [GeneticAlgorithm.Nomad(), GeneticAlgorithm.Settler()]:
+            population.create(2, 5, Axis3(-5.0, -5.0, -5.0), \
+                              Axis3(5.0, 5.0, 5.0), rng)
+            parents_idx = np.array([[0, 1]] * 20)
+            children = population.crossover(parents_idx, 5, rng)
+            from_p2 = children == population.individuals[1]
+            self.assertTrue(np.all(from_p2 | \
+                                   (children == population.individuals[0])))
+            if population.crossover_translation_mode == population.CM_COMBINE:
+                self.assertTrue(np.all(from_p2[:, :3] == from_p2[:, :1]))
+                self.assertTrue(np.all(from_p2[:, 3:7] == from_p2[:, 3:4]))
+
+    def testMutate(self):
+        rng = LFSR(lfsr = 1070, bit_len = 48)
+        population = GeneticAlgorithm.Nomad()
+        population.create(40, 5, Axis3(-5.0, -5.0, -5.0), \
+                          Axis3(5.0, 5.0, 5.0), rng)
+        individuals = population.individuals.copy()
+        population.mutate(individuals, 0.0, Axis3(-5.0, -5.0, -5.0), \
+                          Axis3(5.0, 5.0, 5.0), 5, rng)
+        self.assertEquals(individuals.tolist(), population.individuals.tolist())
+
+        population.mutate(individuals, 1.0, Axis3(-5.0, -5.0, -5.0), \
+                          Axis3(5.0, 5.0, 5.0), 5, rng)
+        self.assertTrue(np.any(individuals != population.individuals))
+        self.assertTrue(np.all(individuals[:, :3] >= -5.0))
+        self.assertTrue(np.all(individuals[:, :3] <= 5.0))
+
+class GeneticAlgorithmOpenCLElite(unittest.TestCase):
+    POPULATION_SIZE = 37
+    DNA_SIZE = 3
+    ELITE_SIZE = 5
+
+    def setUp(self):
+        self.cl_ctx = cl.create_some_context(interactive = False)
+        self.cl_queue = cl.CommandQueue(self.cl_ctx)
+        self.cl_prg = self.build_program(["-DPRECISION=0"])
+        rng = np.random.RandomState(1070)
+        # Repeated scores to check ties
+        self.scores = np.round(rng.uniform(-10.0, 10.0, \
+                                           self.POPULATION_SIZE), 0)
+        self.scores[3] = float("inf")
+        self.individuals = rng.uniform(-1.0, 1.0, (self.POPULATION_SIZE, \
+                                                   self.DNA_SIZE))
+
+    def build_program(self, precision_options):
+        fh = open("../OpenCL/GeneticAlgorithm.cl", 'r')
+        cl_code = "".join(fh.readlines())
+        options = ["-DPOPULATION_SIZE=%d" % self.POPULATION_SIZE, \
+                   "-DDNA_SIZE=%d" % self.DNA_SIZE, \
+                   "-DTTL_TORSIONS=0", \
+                   "-DELITE_SIZE=%d" % self.ELITE_SIZE] + precision_options
+        return cl.Program(self.cl_ctx, cl_code).build(options)
+
+    def to_device(self, values):
+        return cl.array.to_device(self.cl_queue, np.ascontiguousarray(values))
+
+    def testFindBest(self):
+        scores_buf = self.to_device(self.scores)
+        best_score_buf = cl.array.zeros(self.cl_queue, 1, dtype = float)
+        best_id_buf = cl.array.zeros(self.cl_queue, 1, dtype = int)
+        # Work-group sizes below, at and above the population size
+        for local_size in [1, 8, self.POPULATION_SIZE, 64]:
+            self.cl_prg.find_best(self.cl_queue, (local_size,), (local_size,), \
+                                  scores_buf.data, \
+                                  cl.LocalMemory(local_size * 8), \
+                                  cl.LocalMemory(local_size * 8), \
+                                  best_score_buf.data, best_id_buf.data)
+            self.assertEquals(best_score_buf.get()[0], self.scores.min())
+            self.assertEquals(best_id_buf.get()[0], np.argmin(self.scores))
+
+    def testFindBestBatch(self):
+        # Two communities stacked, the second one in reverse order
+        scores_buf = self.to_device(np.concatenate((self.scores, \
+                                                    self.scores[::-1])))
+        best_score_buf = cl.array.zeros(self.cl_queue, 2, dtype = float)
+        best_id_buf = cl.array.zeros(self.cl_queue, 2, dtype = int)
+        self.cl_prg.find_best(self.cl_queue, (2 * 8,), (8,), \
+                              scores_buf.data, \
+                              cl.LocalMemory(8 * 8), cl.LocalMemory(8 * 8), \
+                              best_score_buf.data, best_id_buf.data)
+        self.assertEquals(best_score_buf.get().tolist(), \
+                          [self.scores.min()] * 2)
+        self.assertEquals(best_id_buf.get().tolist(), \
+                          [np.argmin(self.scores), \
+                           np.argmin(self.scores[::-1])])
+
+    def testFindBestSinglePrecision(self):
+        cl_prg = self.build_program(["-DPRECISION=1", \
+                                     "-cl-single-precision-constant"])
+        scores_buf = self.to_device(self.scores.astype(np.float32))
+        best_score_buf = cl.array.zeros(self.cl_queue, 1, dtype = np.float32)
+        best_id_buf = cl.array.zeros(self.cl_queue, 1, dtype = int)
+        cl_prg.find_best(self.cl_queue, (8,), (8,), \
+                         scores_buf.data, \
+                         cl.LocalMemory(8 * 4), cl.LocalMemory(8 * 8), \
+                         best_score_buf.data, best_id_buf.data)
+        self.assertEquals(best_score_buf.get()[0], self.scores.min())
+        self.assertEquals(best_id_buf.get()[0], np.argmin(self.scores))
+
+    def testUpdateElite(self):
+        elite_scores_buf = self.to_device(np.array([float("inf")] * \
+                                                   self.ELITE_SIZE))
+        elite_individuals_buf = cl.array.zeros(self.cl_queue, \
+                                               (self.ELITE_SIZE, self.DNA_SIZE), \
+                                               dtype = float)
+        new_elite_scores_buf = elite_scores_buf.copy()
+        new_elite_individuals_buf = elite_individuals_buf.copy()
+        # Second population holds the first one in reverse order, shifted
+        # down by one so that some of its individuals make it
+        all_scores = np.concatenate((self.scores, self.scores[::-1] - 1.0))
+        all_individuals = np.concatenate((self.individuals, \
+                                          self.individuals[::-1]))
+        for scores, individuals in [(self.scores, self.individuals), \
+                                    (self.scores[::-1] - 1.0, \
+                                     self.individuals[::-1])]:
+            self.cl_prg.update_elite(self.cl_queue, \
+                                     (self.ELITE_SIZE + self.POPULATION_SIZE,), \
+                                     None, \
+                                     elite_scores_buf.data, \
+                                     elite_individuals_buf.data, \
+                                     self.to_device(scores).data, \
+                                     self.to_device(individuals).data, \
+                                     new_elite_scores_buf.data, \
+                                     new_elite_individuals_buf.data)
+            elite_scores_buf, new_elite_scores_buf = \
+                new_elite_scores_buf, elite_scores_buf
+            elite_individuals_buf, new_elite_individuals_buf = \
+                new_elite_individuals_buf, elite_individuals_buf
+
+        # Ties are kept in the order they were seen
+        elite_ids = np.argsort(all_scores, kind = 'mergesort')[:self.ELITE_SIZE]
+        self.assertEquals(elite_scores_buf.get().tolist(), \
+                          all_scores[elite_ids].tolist())
+        self.assertEquals(elite_individuals_buf.get().tolist(), \
+                          all_individuals[elite_ids].tolist())
+
+class GeneticAlgorithmOpenCLMapStorage(unittest.TestCase):
+    POPULATION_SIZE = 256
+    ATOM_TYPES = ['A', 'C', 'NA', 'OA', 'N', 'HD']
+
+    def setUp(self):
+        self.cl_ctx = cl.create_some_context(interactive = False)
+        self.cl_queue = cl.CommandQueue(self.cl_ctx)
+        dock = self.create_dock("buffer", True)
+        # Poses within 1 Angstrom of the grid center so that most of them lie
+        # inside the grid
+        rng = np.random.RandomState(2203)
+        center = np.array(dock.grid.field.center.xyz)
+        translations = center + rng.uniform(-1.0, 1.0, \
+                                            (self.POPULATION_SIZE, 3))
+        rotations = rng.normal(size = (self.POPULATION_SIZE, 4))
+        rotations /= np.sqrt(np.sum(rotations ** 2, axis = 1))[:, None]
+        torsions = rng.uniform(-np.pi, np.pi, (self.POPULATION_SIZE, \
+                                               dock.get_total_torsions()))
+        self.individuals = np.hstack((translations, rotations, torsions))
+
+    def create_dock(self, map_storage, map_filter_linear):
+        dock = DockOpenCL()
+        dock.cl_filename = "../OpenCL/Dock.cl"
+        dock.map_storage = map_storage
+        dock.map_filter_linear = map_filter_linear
+        dock.dps.calc_inter_elec_e = True
+        dock.bond.read("AD4.1_bound.dat")
+        dock.ligand.atom_types = list(self.ATOM_TYPES)
+        dock.bond.calc_internal_energy_tables(dock.ligand)
+
+        field = Field("./Parameters/hsg1_rigid.maps.fld")
+        dock.grid.field = field
+        dock.grid.maps['e'] = ElectrostaticMap("./Maps/hsg1_rigid.e.map", field).map
+        dock.grid.maps['d'] = DesolvationMap("./Maps/hsg1_rigid.d.map", field).map
+        for type in self.ATOM_TYPES:
+            dock.grid.maps[type] = \
+                AtomTypeMap("./Maps/hsg1_rigid.%s.map" % type, field).map
+
+        dock.ligand.read_pdbqt("./Inputs/ind.pdbqt")
+        dock.protein.read_flex_pdbqt("./Inputs/hsg1_flex.pdbqt")
+        about = Axis3(0.0, 0.0, 0.0)
+        about.xyz = [0.3689, -0.2148, -4.9865]
+        dock.ligand.about = about
+        for atom in dock.ligand.ori_atoms:
+            atom.tcoord -= about
+        dock.ligand.reset_atoms()
+        dock.get_non_bond_list()
+        return dock
+
+    # Total energies of the individuals scored with the given map storage, or
+    # None when the device stores the maps in a buffer instead
+    def score(self, map_storage, map_filter_linear):
+        dock = self.create_dock(map_storage, map_filter_linear)
+        dock.setup_opencl(self.cl_ctx, self.cl_queue)
+        dock.setup_opencl_buffer(self.POPULATION_SIZE, \
+                                 self.cl_ctx, self.cl_queue)
+        if dock.map_storage != map_storage:
+            return None
+        individuals_buf = cl.array.to_device(self.cl_queue, \
+                                             self.individuals.astype(float))
+        dock.reset_poses(self.POPULATION_SIZE, individuals_buf, \
+                         self.cl_ctx, self.cl_queue)
+        dock.calc_energy()
+        return dock.e_totals_buf.get()
+
+    # Largest error of the energies relative to the buffer energies, taken
+    # as absolute below 1 kcal/mol
+    def check_energies(self, e_totals, exp_e_totals, tolerance):
+        finite = np.isfinite(exp_e_totals)
+        self.assertTrue(np.any(finite))
+        self.assertEquals(np.isfinite(e_totals).tolist(), finite.tolist())
+        errors = np.abs(e_totals[finite] - exp_e_totals[finite]) / \
+                 np.maximum(1.0, np.abs(exp_e_totals[finite]))
+        self.assertTrue(np.max(errors) <= tolerance, \
+                        "relative error %g above %g" % (np.max(errors), \
+                                                         tolerance))
+
+    def testImageNearest(self):
+        e_totals = self.score("image", False)
+        if e_totals is None:
+            return
+        # Same map values as the buffer, only stored in single precision
+        self.check_energies(e_totals, self.score("buffer", True), 1e-7)
+
+    def testImageLinear(self):
+        e_totals = self.score("image", True)
+        if e_totals is None:
+            return
+        # Sampler interpolation in single precision. Devices filtering with
+        # reduced precision weights (8-bit fractions on many GPUs) need a
+        # wider bound.
+        self.check_energies(e_totals, self.score("buffer", True), 1e-5)
+
+class GeneticAlgorithmMultiDeviceSchedule(unittest.TestCase):
+    # Result read of a batch, completed once its worker is ready
+    class Event:
+        def __init__(self, worker):
+            self.worker = worker
+
+        @property
+        def command_execution_status(self):
+            if self.worker.ready:
+                return cl.command_execution_status.COMPLETE
+            return cl.command_execution_status.RUNNING
+
+        def set_callback(self, status, callback):
+            pass
+
+    # Device worker returning the community index as its scores and elite,
+    # taking one second per community
+    class Worker:
+        def __init__(self, ga, ready = True):
+            self.ga = ga
+            self.ready = ready
+            self.first_community_ids = []
+            self.queued = 0
+            self.max_queued = 0
+            # Worker made ready once a batch of this worker is collected
+            self.next_worker = None
+
+        def enqueue_batch(self, first_community_idx):
+            batch = GeneticAlgorithmOpenCL.Batch(first_community_idx, \
+                                                 min(self.ga.batch_size, \
+                                                     self.ga.community_size - \
+                                                     first_community_idx))
+            ids = np.arange(first_community_idx, \
+                            first_community_idx + self.ga.batch_size)
+            batch.elite_scores_np = ids[:, None].astype(float)
+            batch.elite_individuals_np = ids[:, None, None].astype(float)
+            batch.read_events = [GeneticAlgorithmMultiDeviceSchedule.Event(self)]
+            self.first_community_ids.append(first_community_idx)
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+            return batch
+
+        def collect_batch(self, batch):
+            self.queued -= 1
+            if self.next_worker is not None:
+                self.next_worker.ready = True
+            return [([float(batch.first_community_idx + idx)] * 2, 1.0) \
+                    for idx in xrange(batch.ttl_communities)]
+
+    def setUp(self):
+        self.ga = GeneticAlgorithmMultiDevice(None, None, [])
+        self.ga.community_size = 7
+        self.ga.batch_size = 2
+
+    def set_workers(self, workers, batch_times):
+        self.ga.workers = workers
+        self.ga.queued_batches = [[] for worker in workers]
+        self.ga.batch_times = batch_times
+        self.ga.free_times = [0.0] * len(workers)
+        self.ga.next_community_idx = 0
+
+    def testCompletionTime(self):
+        self.set_workers([self.Worker(self.ga), self.Worker(self.ga)], \
+                         [None, 2.0])
+        self.ga.free_times = [0.0, 15.0]
+        # Unmeasured worker takes a batch right away
+        self.assertEquals(self.ga.get_completion_time(0, 10.0), 10.0)
+        # Measured worker completes a batch after the ones enqueued
+        self.assertEquals(self.ga.get_completion_time(1, 10.0), 17.0)
+        self.assertEquals(self.ga.get_completion_time(1, 20.0), 22.0)
+        # Unmeasured worker takes no second batch
+        self.ga.queued_batches[0].append(None)
+        self.assertEquals(self.ga.get_completion_time(0, 10.0), float("inf"))
+
+    def testAssignProbeBatches(self):
+        workers = [self.Worker(self.ga), self.Worker(self.ga)]
+        self.set_workers(workers, [None, None])
+        self.ga.assign_batches()
+        self.assertEquals(workers[0].first_community_ids, [0])
+        self.assertEquals(workers[1].first_community_ids, [2])
+        # Measured worker fills its queue, the other still runs its probe
+        self.ga.batch_times[0] = 1.0
+        self.ga.assign_batches()
+        self.assertEquals(workers[0].first_community_ids, [0, 4])
+        self.assertEquals(workers[1].first_community_ids, [2])
+        self.assertEquals(self.ga.next_community_idx, 6)
+
+    def testAssignQueueLimit(self):
+        workers = [self.Worker(self.ga), self.Worker(self.ga)]
+        self.set_workers(workers, [1.0, 100.0])
+        self.ga.assign_batches()
+        # Slow worker stays idle once the fast worker has a full queue
+        self.assertEquals(len(self.ga.queued_batches[0]), \
+                          self.ga.MAX_QUEUED_BATCHES)
+        self.assertEquals(self.ga.queued_batches[1], [])
+
+    def testRunCommunitiesInOrder(self):
+        # First worker completes its probe batch only after the second one
+        # has completed a batch
+        workers = [self.Worker(self.ga, False), self.Worker(self.ga)]
+        workers[1].next_worker = workers[0]
+        self.ga.workers = workers
+        results = list(self.ga.run_communities())
+
+        self.assertEquals(workers[0].first_community_ids[0], 0)
+        self.assertEquals(workers[1].first_community_ids[:2], [2, 4])
+        for worker in workers:
+            self.assertTrue(worker.max_queued <= self.ga.MAX_QUEUED_BATCHES)
+        self.assertEquals([min_scores for min_scores, elapsed_time in results], \
+                          [[float(idx)] * 2 for idx in xrange(7)])
+        self.assertEquals([elite_scores.tolist() for elite_scores, \
+                           elite_individuals in self.ga.community_elites], \
+                          [[float(idx)] for idx in xrange(7)])
+
+def suite():
+    suite1 = unittest.makeSuite(GeneticAlgorithmSelect)
+    suite2 = unittest.makeSuite(GeneticAlgorithmReproduce)
+    suite3 = unittest.makeSuite(GeneticAlgorithmOpenCLElite)
+    suite4 = unittest.makeSuite(GeneticAlgorithmOpenCLMapStorage)
+    suite5 = unittest.makeSuite(GeneticAlgorithmMultiDeviceSchedule)
+    return unittest.TestSuite((suite1, suite2, suite3, suite4, suite5))
+
+if __name__ == '__main__':
+    unittest.main()
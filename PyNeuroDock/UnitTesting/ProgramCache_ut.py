@@ -0,0 +1,79 @@
+# Copyright (C) 2013 by Eka A. Kurniawan
+# eka.a.kurniawan(ta)gmail(tod)com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+import unittest
+import shutil
+import tempfile
+import numpy as np
+import pyopencl as cl
+import pyopencl.array
+from ProgramCache import ProgramCache
+
+CL_CODE = """
+__kernel void add_one(__global float *values)
+{
+    values[get_global_id(0)] += 1.0f;
+}
+"""
+
+class ProgramCacheBuild(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cl_ctx = cl.create_some_context(interactive = False)
+        self.cl_queue = cl.CommandQueue(self.cl_ctx)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def run_add_one(self, cl_prg):
+        values = cl.array.zeros(self.cl_queue, (4,), dtype = np.float32)
+        cl_prg.add_one(self.cl_queue, (4,), None, values.data)
+        return values.get().tolist()
+
+    def testBuild(self):
+        # First build compiles the source and stores the binaries
+        program_cache = ProgramCache(self.cache_dir)
+        cl_prg = program_cache.build(self.cl_ctx, CL_CODE, "add_one.cl")
+        self.assertEquals(program_cache.misses, 1)
+        self.assertEquals(program_cache.hits, 0)
+        self.assertEquals(self.run_add_one(cl_prg), [1.0, 1.0, 1.0, 1.0])
+
+        # Second build loads the binaries
+        program_cache = ProgramCache(self.cache_dir)
+        cl_prg = program_cache.build(self.cl_ctx, CL_CODE, "add_one.cl")
+        self.assertEquals(program_cache.misses, 0)
+        self.assertEquals(program_cache.hits, 1)
+        self.assertEquals(self.run_add_one(cl_prg), [1.0, 1.0, 1.0, 1.0])
+
+    def testKeyChanged(self):
+        program_cache = ProgramCache(self.cache_dir)
+        program_cache.build(self.cl_ctx, CL_CODE, "add_one.cl")
+
+        # Different build options or source need their own binaries
+        program_cache.build(self.cl_ctx, CL_CODE, "add_one.cl", ["-DUNUSED"])
+        self.assertEquals(program_cache.misses, 2)
+        program_cache.build(self.cl_ctx, CL_CODE + "\n", "add_one.cl")
+        self.assertEquals(program_cache.misses, 3)
+        program_cache.build(self.cl_ctx, CL_CODE, "add_one.cl", ["-DUNUSED"])
+        self.assertEquals(program_cache.hits, 1)
+
+def suite():
+    suite1 = unittest.makeSuite(ProgramCacheBuild)
+    return unittest.TestSuite((suite1, ))
+
+if __name__ == '__main__':
+    unittest.main()
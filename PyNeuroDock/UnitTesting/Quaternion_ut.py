@@ -16,6 +16,7 @@
 # 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
 import unittest
+import numpy as np
 from Quaternion import Quaternion
 from Axis3 import Axis3
 from LFSR import LFSR
@@ -140,6 +141,54 @@ class QuaternionTestConversion(unittest.TestCase):
         q.set_angle_axis(angle, axis)
         self.assertEquals(str(q), "Quaternion: 0.7074 + -0.2404i + -0.6647j + 0.0000k")
 
+class QuaternionTestInNumpy(unittest.TestCase):
+    def testUniform(self):
+        rng = LFSR(lfsr = 1070, bit_len = 16)
+        exp = []
+        q = Quaternion()
+        for i in xrange(9):
+            q.uniform(rng)
+            exp.append([q.a, q.b, q.c, q.d])
+
+        rng = LFSR(lfsr = 1070, bit_len = 16)
+        rotations = Quaternion.uniform_in_numpy(rng.zero_to_one_in_numpy((9, 3)))
+        self.assertEquals(rotations.tolist(), exp)
+
+    def testMultiplication(self):
+        rng = LFSR(lfsr = 1070, bit_len = 16)
+        q1s = Quaternion.uniform_in_numpy(rng.zero_to_one_in_numpy((5, 3)))
+        q2s = Quaternion.uniform_in_numpy(rng.zero_to_one_in_numpy((5, 3)))
+        qs = Quaternion.mul_in_numpy(q1s, q2s)
+        for q1, q2, q in zip(q1s.tolist(), q2s.tolist(), qs.tolist()):
+            exp = Quaternion(*q1) * Quaternion(*q2)
+            self.assertEquals(q, [exp.a, exp.b, exp.c, exp.d])
+
+    def testAngleAxisToQuaternion(self):
+        angles = np.array([[1.57, -0.3], [2.5, 0.0]])
+        axes = np.array([[[-0.340, -0.940, 0.000], [1.0, 2.0, 3.0]], \
+                         [[0.0, 0.0, 0.0], [0.5, -0.5, 0.25]]])
+        rotations = Quaternion.from_angle_axis_in_numpy(angles, axes)
+        for i in xrange(2):
+            for j in xrange(2):
+                q = Quaternion()
+                q.set_angle_axis(angles[i][j], Axis3(*axes[i][j].tolist()))
+                self.assertEquals(rotations[i][j].tolist(), [q.a, q.b, q.c, q.d])
+
+    def testTransform(self):
+        rng = LFSR(lfsr = 1070, bit_len = 16)
+        rotations = Quaternion.uniform_in_numpy(rng.zero_to_one_in_numpy((4, 3)))
+        translations = rng.zero_to_one_in_numpy((4, 3)) * 10.0
+        tcoords = rng.zero_to_one_in_numpy((4, 6, 3)) * 10.0
+        new_tcoords = Quaternion.transform_in_numpy(translations, rotations, \
+                                                    tcoords)
+        for i in xrange(4):
+            exp = Quaternion.transform(Axis3(*translations[i].tolist()), \
+                                       Quaternion(*rotations[i].tolist()), \
+                                       [Axis3(*tcoord) \
+                                        for tcoord in tcoords[i].tolist()])
+            self.assertEquals(new_tcoords[i].tolist(), \
+                              [tcoord.xyz for tcoord in exp])
+
 def suite():
     suite1 = unittest.makeSuite(QuaternionTestInit)
     suite2 = unittest.makeSuite(QuaternionTestCopy)
@@ -149,8 +198,9 @@ def suite():
     suite6 = unittest.makeSuite(QuaternionTestConjugate)
     suite7 = unittest.makeSuite(QuaternionTestIdentity)
     suite8 = unittest.makeSuite(QuaternionTestConversion)
+    suite9 = unittest.makeSuite(QuaternionTestInNumpy)
     return unittest.TestSuite((suite1, suite2, suite3, suite4, suite5, suite6, \
-                               suite7, suite8, ))
+                               suite7, suite8, suite9, ))
 
 if __name__ == '__main__':
     unittest.main()
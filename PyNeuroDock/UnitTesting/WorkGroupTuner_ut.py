@@ -0,0 +1,118 @@
+# Copyright (C) 2013 by Eka A. Kurniawan
+# eka.a.kurniawan(ta)gmail(tod)com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import pyopencl as cl
+import pyopencl.array
+from WorkGroupTuner import WorkGroupTuner
+
+# Launches of a tuned kernel have to give the same results when repeated
+CL_CODE = """
+__kernel void set_ids(__global float *values)
+{
+    values[get_global_id(0)] = (float)get_global_id(0);
+}
+"""
+
+class WorkGroupTunerProfile(unittest.TestCase):
+    GLOBAL_SIZE = 48
+
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+        self.profile_filename = os.path.join(self.profile_dir, \
+                                             "workgroups.json")
+        self.cl_ctx = cl.create_some_context(interactive = False)
+        self.cl_queue = cl.CommandQueue(self.cl_ctx)
+        self.cl_prg = cl.Program(self.cl_ctx, CL_CODE).build()
+        self.values = cl.array.zeros(self.cl_queue, (self.GLOBAL_SIZE,), \
+                                     dtype = np.float32)
+        self.launched_sizes = []
+
+    def tearDown(self):
+        shutil.rmtree(self.profile_dir)
+
+    def launch(self, local_size):
+        self.launched_sizes.append(local_size)
+        return self.cl_prg.set_ids(self.cl_queue, (self.GLOBAL_SIZE,), \
+                                   local_size and (local_size,), \
+                                   self.values.data)
+
+    def get_local_size(self, tuner):
+        kernel = self.cl_prg.set_ids
+        candidates = WorkGroupTuner.get_flat_candidates(kernel, \
+                                                        self.cl_queue.device, \
+                                                        self.GLOBAL_SIZE)
+        return tuner.get_local_size(self.cl_queue, kernel, self.GLOBAL_SIZE, \
+                                    candidates, self.launch)
+
+    def testCandidates(self):
+        kernel = self.cl_prg.set_ids
+        device = self.cl_queue.device
+        max_local_size = kernel.get_work_group_info( \
+                             cl.kernel_work_group_info.WORK_GROUP_SIZE, device)
+        candidates = WorkGroupTuner.get_flat_candidates(kernel, device, 48)
+        self.assertEquals(candidates[0], None)
+        for local_size in candidates[1:]:
+            self.assertEquals(48 % local_size, 0)
+            self.assertTrue(local_size <= max_local_size)
+        # Powers of two up to the first one covering all items, within local
+        # memory
+        self.assertEquals(WorkGroupTuner.get_group_candidates(kernel, device, 5), \
+                          [1, 2, 4, 8])
+        local_bytes = lambda local_size: local_size * \
+                                         (device.local_mem_size // 2)
+        self.assertEquals(WorkGroupTuner.get_group_candidates(kernel, device, \
+                                                              5, local_bytes), \
+                          [1, 2])
+
+    def testTuneOnce(self):
+        # First use times every candidate and stores the fastest one
+        tuner = WorkGroupTuner(self.profile_filename)
+        local_size = self.get_local_size(tuner)
+        self.assertEquals(tuner.tunings, 1)
+        self.assertTrue(local_size in self.launched_sizes)
+        self.assertTrue(os.path.exists(self.profile_filename))
+        self.assertEquals(self.values.get().tolist(), range(self.GLOBAL_SIZE))
+
+        # Later runs take it from the profile without launching
+        self.launched_sizes = []
+        tuner = WorkGroupTuner(self.profile_filename)
+        self.assertEquals(self.get_local_size(tuner), local_size)
+        self.assertEquals(tuner.tunings, 0)
+        self.assertEquals(tuner.hits, 1)
+        self.assertEquals(self.launched_sizes, [])
+
+    def testRetune(self):
+        tuner = WorkGroupTuner(self.profile_filename)
+        self.get_local_size(tuner)
+
+        # Retuning ignores the profile once per kernel and problem shape
+        tuner = WorkGroupTuner(self.profile_filename, retune = True)
+        self.get_local_size(tuner)
+        self.get_local_size(tuner)
+        self.assertEquals(tuner.tunings, 1)
+
+def suite():
+    suite1 = unittest.makeSuite(WorkGroupTunerProfile)
+    return unittest.TestSuite((suite1, ))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+# Copyright (C) 2013 by Eka A. Kurniawan
+# eka.a.kurniawan(ta)gmail(tod)com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+# References:
+#  - PyOpenCL Kernel (kernel_work_group_info) and Program (program_build_info)
+#    http://documen.tician.de/pyopencl/runtime.html
+
+import os
+import json
+from time import time
+import pyopencl as cl
+from CacheFile import make_dirs, write_atomic
+
+# OpenCL Work-group Size Tuner
+# ----------------------------
+# Kernels over all atoms or pairs of all poses leave the work-group (local)
+# size to the driver, and kernels running one work-group per pose use a fixed
+# number of work items per pose. Neither is the fastest on every device. The
+# tuner times candidate local sizes on the first launch of a kernel for a
+# problem shape and keeps the fastest one in a JSON profile, which later runs
+# reuse.
+#
+# Profile entries are keyed by device (platform, device name and driver
+# version), kernel name and problem shape, which is the build options of the
+# kernel program (holding the problem sizes) and the launch size:
+#   {device: {kernel: {shape: {"local_size": ..., "time": ..., ...}}}}
+# Local size of the driver's choice is stored as null.
+class WorkGroupTuner:
+    DEFAULT_PROFILE = "./OpenCL/Cache/workgroups.json"
+    # Timed launches of each candidate after a warm-up launch. The fastest
+    # one counts.
+    TRIALS = 3
+
+    def __init__(self, profile_filename = DEFAULT_PROFILE, retune = False):
+        self.profile_filename = profile_filename
+        # Tune every kernel again on its first use instead of taking the local
+        # size from the profile
+        self.retune = retune
+        self.profile = self.read_profile(profile_filename)
+        # Keys tuned by this process
+        self.tuned_keys = set()
+        # Tuner statistics
+        self.hits = 0
+        self.tunings = 0
+
+    @staticmethod
+    def read_profile(profile_filename):
+        try:
+            with open(profile_filename, 'r') as p_file:
+                return json.load(p_file)
+        except (IOError, ValueError):
+            return {}
+
+    # The profile on disk, possibly updated by other processes, is merged
+    # with the new entry before writing. The profile is not locked, so two
+    # processes tuning at the same time may drop each other's entries, which
+    # are then tuned again by a later run.
+    def write_profile(self, device_key, kernel_name, shape_key, entry):
+        make_dirs(os.path.dirname(self.profile_filename) or ".")
+        profile = self.read_profile(self.profile_filename)
+        profile.setdefault(device_key, {}).setdefault(kernel_name, {})
+        profile[device_key][kernel_name][shape_key] = entry
+        def write_func(p_file):
+            json.dump(profile, p_file, indent = 1, sort_keys = True)
+        write_atomic(self.profile_filename, write_func, 'w')
+
+    @staticmethod
+    def get_device_key(device):
+        return "%s %s / %s %s" % (device.platform.name, \
+                                  device.platform.version, \
+                                  device.name, \
+                                  device.driver_version)
+
+    @staticmethod
+    def get_shape_key(kernel, device, launch_size):
+        cl_prg = kernel.get_info(cl.kernel_info.PROGRAM)
+        options = cl_prg.get_build_info(device, cl.program_build_info.OPTIONS)
+        return "%s size=%d" % (options.strip(), launch_size)
+
+    # Local sizes of a kernel over global_size work items: the driver's
+    # choice (None) and powers of two dividing global_size up to the limit
+    # of the kernel on the device
+    @staticmethod
+    def get_flat_candidates(kernel, device, global_size):
+        max_local_size = kernel.get_work_group_info( \
+                             cl.kernel_work_group_info.WORK_GROUP_SIZE, \
+                             device)
+        candidates = [None]
+        local_size = 1
+        while local_size <= min(max_local_size, global_size):
+            if global_size % local_size == 0:
+                candidates.append(local_size)
+            local_size *= 2
+        return candidates
+
+    # Work-group sizes of a kernel running one work-group per pose (or
+    # community) whose work items share ttl_items atoms or pairs: powers of
+    # two up to the first one covering all items, limited by the kernel on
+    # the device and by local memory, local_bytes(local_size) bytes per
+    # work-group
+    @staticmethod
+    def get_group_candidates(kernel, device, ttl_items, local_bytes = None):
+        max_local_size = kernel.get_work_group_info( \
+                             cl.kernel_work_group_info.WORK_GROUP_SIZE, \
+                             device)
+        candidates = []
+        local_size = 1
+        while local_size <= max_local_size:
+            if local_bytes and local_bytes(local_size) > device.local_mem_size:
+                break
+            candidates.append(local_size)
+            if local_size >= ttl_items:
+                break
+            local_size *= 2
+        return candidates
+
+    # Local size of a kernel launch from the profile, tuned on first use.
+    # launch(local_size) enqueues the launch with the given local size and
+    # has to give the same results when repeated. Launch size is the global
+    # size, or the number of work-groups when the global size follows the
+    # local size.
+    def get_local_size(self, cl_queue, kernel, launch_size, candidates, \
+                       launch):
+        device = cl_queue.device
+        device_key = self.get_device_key(device)
+        kernel_name = kernel.function_name
+        shape_key = self.get_shape_key(kernel, device, launch_size)
+        key = (device_key, kernel_name, shape_key)
+        entry = self.profile.get(device_key, {}).get(kernel_name, {}) \
+                            .get(shape_key)
+        if entry is not None and (not self.retune or key in self.tuned_keys):
+            if key not in self.tuned_keys:
+                self.hits += 1
+                self.tuned_keys.add(key)
+            return entry['local_size']
+
+        # Candidates rejected by the device are skipped
+        cl_queue.finish()
+        times = {}
+        for local_size in candidates:
+            try:
+                launch(local_size)
+                cl_queue.finish()
+                best_time = float("inf")
+                for trial in xrange(self.TRIALS):
+                    tic = time()
+                    launch(local_size)
+                    cl_queue.finish()
+                    best_time = min(best_time, time() - tic)
+            except cl.Error:
+                continue
+            times[local_size] = best_time
+        local_size = min([local_size for local_size in candidates \
+                          if local_size in times], \
+                         key = lambda local_size: times[local_size])
+        entry = {'local_size': local_size, \
+                 'time': times[local_size], \
+                 'candidates': [[candidate, times[candidate]] \
+                                for candidate in candidates \
+                                if candidate in times]}
+        self.profile.setdefault(device_key, {}).setdefault(kernel_name, {})
+        self.profile[device_key][kernel_name][shape_key] = entry
+        self.write_profile(device_key, kernel_name, shape_key, entry)
+        self.tunings += 1
+        self.tuned_keys.add(key)
+        print "OpenCL work-group size tuned: %s %s (%.3f ms)" % \
+              (kernel_name, local_size, times[local_size] * 1000.0)
+        return local_size